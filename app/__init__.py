@@ -26,6 +26,15 @@ def create_app() -> Flask:
     )
     update_thread.start()
 
+    # планировщик мониторинга (циклы гоняет только один воркер, см. MonitorScheduler)
+    if ConfigStore.get().monitor.enabled:
+        from engine.monitor import MonitorScheduler
+        MonitorScheduler.start()
+
+    # периодический обход портов SOAX (если port_map.interval_sec > 0)
+    from providers.port_map import PortMapSweeper
+    PortMapSweeper.start_periodic()
+
     from .routes import bp as routes_bp
     app.register_blueprint(routes_bp)
 
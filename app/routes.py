@@ -3,15 +3,29 @@ from flask import (
     url_for, Response, jsonify, flash
 )
 from datetime import datetime
-import threading
+import time
+import json
 import shutil
+import tempfile
 import os
-from engine.orchestrator import start_run, get_run_state, start_dns_run
+from engine.dns_resolver import DnsResolver
+from engine.rdap_cache import RdapCache
+from engine.rdap_scheduler import RdapScheduler
+from engine.whois_store import WhoisStore
+from engine.geo_db import GeoDb
+from engine.orchestrator import start_run, get_run_state, start_dns_run, start_bulk_run, start_matrix_run, build_matrix
+from engine.run_registry import RunRegistry
+from engine.url_utils import parse_url_lines, parse_multi_geo_lines
+from engine.monitor import WatchlistStore, get_changes as get_monitor_changes
 from config.loader import ConfigStore
-from providers.soax import CatalogStore, refresh_catalog_data
+from providers.soax import CatalogStore
+from providers.catalog_refresh import CatalogRefresher
+from providers.proxy_health import ProxyHealth
+from providers.port_map import PortMapStore, PortMapSweeper
+from providers.port_allocator import parse_port_range
 from logging_.engine_logger import get_engine_logger
+from logging_.history_db import HistoryStore
 from .utils import render_markdown_file
-import urllib.parse
 
 log = get_engine_logger()
 
@@ -53,9 +67,8 @@ def launch_run():
         log.warning("Run rejected: No URLs provided.")
         return Response("No URLs provided", status=400)
 
-    # Приводим к lowercase, чистим пробелы и убираем дубликаты, сохраняя порядок
-    raw_list = [normalize_url_complex(u) for u in urls_raw.splitlines() if u.strip()]
-    urls = list(dict.fromkeys(raw_list))
+    # Приводим домен к lowercase, чистим пробелы и убираем дубликаты, сохраняя порядок
+    urls = parse_url_lines(urls_raw.splitlines())
 
     if not urls:
         log.warning("Run rejected: No valid URLs after normalization.")
@@ -104,34 +117,202 @@ def launch_run():
     return jsonify({"run_id": run_id}), 202 # 202 Accepted
 
 
+@bp.get("/runs/<run_id>")
+def run_status(run_id: str):
+    """Run status and totals (from memory or the on-disk archive)."""
+    state = get_run_state(run_id)
+    if state is None:
+        return jsonify({"error": "Run not found"}), 404
+    return jsonify(state)
+
+
+@bp.get("/runs/<run_id>/rows")
+def run_rows(run_id: str):
+    """
+    Paged incremental results.
+    /runs/<id>/rows?after=<cursor>&limit=N[&format=ndjson]
+    Cursor is the index of the next row; pass back `next_cursor` to continue.
+    """
+    state = get_run_state(run_id)
+    if state is None:
+        return jsonify({"error": "Run not found"}), 404
+
+    after = max(request.args.get("after", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", 500, type=int), 1), 5000)
+    rows = RunRegistry.get_rows(run_id, after, limit)
+    next_cursor = after + len(rows)
+    complete = state["status"] != "running" and next_cursor >= state["done"]
+
+    wants_ndjson = (
+        request.args.get("format") == "ndjson"
+        or request.accept_mimetypes.best == "application/x-ndjson"
+    )
+    if wants_ndjson:
+        body = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows)
+        resp = Response(body, mimetype="application/x-ndjson")
+        resp.headers["X-Next-Cursor"] = str(next_cursor)
+        resp.headers["X-Run-Status"] = state["status"]
+        resp.headers["X-Run-Complete"] = "1" if complete else "0"
+        return resp
+
+    return jsonify({
+        "run_id": run_id,
+        "status": state["status"],
+        "rows": rows,
+        "next_cursor": next_cursor,
+        "complete": complete,
+    })
+
+
+@bp.get("/api/monitor/watchlists")
+def api_monitor_list():
+    return jsonify(WatchlistStore.list())
+
+
+@bp.post("/api/monitor/watchlists")
+def api_monitor_create():
+    """
+    JSON body: {"name": "...", "targets": "url cc\\n..." | ["url cc", ...],
+                "interval_sec": 3600, "settings": {"proxy_type": "http", ...}}
+    """
+    body = request.get_json(silent=True) or {}
+    targets = body.get("targets") or []
+    if isinstance(targets, str):
+        targets = targets.splitlines()
+
+    try:
+        wl = WatchlistStore.create(
+            name=body.get("name") or "",
+            targets=targets,
+            interval_sec=int(body.get("interval_sec") or 3600),
+            settings=body.get("settings") or {},
+        )
+    except (ValueError, TypeError) as e:
+        log.warning(f"Watchlist rejected: {e}")
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(wl), 201
+
+
+@bp.delete("/api/monitor/watchlists/<wl_id>")
+def api_monitor_delete(wl_id: str):
+    if not WatchlistStore.delete(wl_id):
+        return jsonify({"error": "Watchlist not found"}), 404
+    return jsonify({"success": True})
+
+
+@bp.post("/api/monitor/watchlists/<wl_id>/run")
+def api_monitor_run_now(wl_id: str):
+    """Ставит watchlist в очередь планировщика немедленно."""
+    wl = WatchlistStore.patch(wl_id, next_run_at=0)
+    if wl is None:
+        return jsonify({"error": "Watchlist not found"}), 404
+    return jsonify(wl), 202
+
+
+@bp.get("/api/monitor/changes")
+def api_monitor_changes():
+    limit = max(1, min(request.args.get("limit", 200, type=int), 5000))
+    return jsonify(get_monitor_changes(request.args.get("watchlist") or None, limit,
+                                       request.args.get("since") or None))
+
+
+@bp.get("/api/proxy-health")
+def api_proxy_health():
+    """Circuit breaker state of proxy exits seen by this worker process."""
+    return jsonify(ProxyHealth.snapshot())
+
+
+@bp.get("/api/port-map")
+def api_port_map():
+    """Known port -> exit map (`?country=kz&ok=1`) plus sweep status of this worker."""
+    entries = PortMapStore.entries(request.args.get("country") or None, bool(request.args.get("ok")))
+    return jsonify({"sweep": PortMapSweeper.status(), "ports": entries})
+
+
+@bp.post("/api/port-map/sweep")
+def api_port_map_sweep():
+    """Starts a background probe sweep. Optional JSON body: {"ports": "9001-9100"}."""
+    body = request.get_json(silent=True) or {}
+    ports = None
+    if body.get("ports"):
+        try:
+            ports = parse_port_range(str(body["ports"]))
+        except ValueError:
+            return jsonify({"error": "Invalid port range"}), 400
+    if not PortMapSweeper.start(ports):
+        return jsonify({"error": "Sweep already running"}), 409
+    return jsonify({"started": True}), 202
+
+
+@bp.get("/history")
+def history():
+    """
+    Query check history from SQLite.
+    /history?host=mirror.com&country=ru&failed=1&days=30
+    """
+    try:
+        days = request.args.get("days", type=float)
+        since = request.args.get("since", type=float)
+        if since is None and days:
+            since = time.time() - days * 86400
+
+        rows = HistoryStore.query(
+            url=request.args.get("url") or None,
+            host=request.args.get("host") or None,
+            country=request.args.get("country") or None,
+            result=request.args.get("result") or None,
+            failed=request.args.get("failed") in ("1", "true", "yes"),
+            run_id=request.args.get("run_id") or None,
+            since=since,
+            until=request.args.get("until", type=float),
+            limit=max(1, min(request.args.get("limit", 500, type=int), 10000)),
+        )
+    except Exception as e:
+        log.error(f"History query failed: {e}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify({"count": len(rows), "rows": rows})
+
+
 @bp.get("/catalog")
 def catalog():
-    # используем get_countries() для загрузки всего кеша
+    # снимок каталога; с диска перечитывается, только если файл изменился
     return render_template(
         "catalog.html",
         active_page="catalog",
-        catalog=CatalogStore._load_or_cache(force_reload=True)
+        catalog=CatalogStore.load()
     )
 
 
 @bp.post("/catalog/refresh")
 def catalog_refresh():
     """
-    Запускает обновление каталога в фоновом потоке.
+    Запускает обновление каталога в фоне (все страны или одну - поле `country`).
+    Прогресс - /events/catalog (из любого воркера).
     """
-    log = get_engine_logger()
-    log.info("Received request to refresh catalog. Starting background thread...")
+    country = (request.form.get("country") or "").strip().lower()
+    if CatalogRefresher.start([country] if country else None):
+        flash(f"Catalog refresh started{f' for {country.upper()}' if country else ''}.", "catalog")
+    else:
+        flash("Catalog refresh is already running.", "catalog")
+    return redirect(url_for("routes.catalog"))
 
-    # запускаем тяжелую задачу в отдельном потоке
-    thread = threading.Thread(
-        target=refresh_catalog_data,
-        daemon=True
-    )
-    thread.start()
 
-    flash("Catalog refresh started in the background. It may take a minute.", "catalog")
+@bp.get("/api/catalog/refresh")
+def api_catalog_refresh_status():
+    """Progress of the current or last catalog refresh, whichever worker runs it."""
+    return jsonify(CatalogRefresher.status())
 
-    return redirect(url_for("routes.catalog"))
+
+@bp.post("/api/catalog/refresh")
+def api_catalog_refresh():
+    """Starts a catalog refresh. Optional JSON body: {"countries": ["kz", "az"]}."""
+    body = request.get_json(silent=True) or {}
+    countries = [str(c).strip().lower() for c in body.get("countries") or [] if str(c).strip()]
+    if not CatalogRefresher.start(countries or None):
+        return jsonify({"error": "Catalog refresh already running"}), 409
+    return jsonify({"started": True, "events": url_for("sse.catalog_events")}), 202
 
 
 @bp.post("/catalog/update-list")
@@ -214,7 +395,7 @@ def api_get_isps():
     country = request.args.get("country")
     if not country:
         return jsonify([])
-    return jsonify(CatalogStore.get_isps(country))
+    return jsonify(CatalogStore.get_isps(country, request.args.get("region"), request.args.get("city")))
 
 
 @bp.post("/logs/clear")
@@ -257,6 +438,49 @@ def clear_logs():
         return jsonify({"success": False, "message": str(e)}), 500
 
 
+@bp.get("/api/dns-resolver")
+def api_dns_resolver():
+    """DNS cache counters of this worker process."""
+    return jsonify(DnsResolver.stats())
+
+
+@bp.get("/api/rdap-cache")
+def api_rdap_cache():
+    """RDAP cache counters, or cached networks of one ASN (`?asn=13335`)."""
+    asn = request.args.get("asn")
+    if asn:
+        return jsonify({"asn": asn, "networks": RdapCache.by_asn(asn)})
+    return jsonify(RdapCache.stats())
+
+
+@bp.get("/api/rdap-scheduler")
+def api_rdap_scheduler():
+    """Per-registry RDAP pacing/backoff state of this worker process."""
+    return jsonify(RdapScheduler.stats())
+
+
+@bp.get("/api/geo-db")
+def api_geo_db():
+    """Local IP geo database status, or a lookup with `?ip=1.2.3.4`."""
+    ip = request.args.get("ip")
+    if ip:
+        return jsonify({"ip": ip, "result": GeoDb.lookup(ip)})
+    return jsonify(GeoDb.info())
+
+
+@bp.post("/api/geo-db/refresh")
+def api_geo_db_refresh():
+    """Rebuilds the local geo database from geo_db.csv_url / geo_db.csv_path."""
+    try:
+        stats = GeoDb.refresh()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        log.error(f"Geo DB refresh failed: {e}", exc_info=True)
+        return jsonify({"error": str(e)}), 502
+    return jsonify({"ok": True, **stats})
+
+
 @bp.get("/dns-checker")
 def dns_checker_page():
     return render_template(
@@ -310,6 +534,7 @@ def multi_geo_page():
             soax_port_default=cfg.soax.port_default_port,
             timeout_sec=cfg.execution.timeout_sec,
             screenshots_enabled=cfg.screenshots.enabled_default,
+            matrix_order=cfg.execution.matrix_order,
         ),
         logs_dir=cfg.paths.logs_dir,
     )
@@ -324,37 +549,7 @@ def launch_multi_geo_run():
         log.warning("Multi-Geo Run rejected: No input provided.")
         return Response("No URLs and countries provided", status=400)
 
-    tasks = []
-    seen_tasks = set()
-    seen_errors = set()
-
-    for line in lines:
-        parts = line.split()
-        if len(parts) >= 2:
-            # домен нормализуем, local path сохраняем
-            url = normalize_url_complex(parts[0])
-            country = parts[1].lower()  # гео в lower
-
-            task_key = (url, country)
-            if task_key not in seen_tasks:
-                tasks.append({
-                    "url": url,
-                    "country": country
-                })
-                seen_tasks.add(task_key)
-        else:
-            # Обработка ошибок формата
-            url_err = parts[0].lower() if parts else "Unknown"
-            err_msg = "Invalid format (expected: url cc)"
-
-            err_key = (url_err, err_msg)
-            if err_key not in seen_errors:
-                tasks.append({
-                    "url": url_err,
-                    "country": None,
-                    "parsing_error": err_msg
-                })
-                seen_errors.add(err_key)
+    tasks = parse_multi_geo_lines(lines)
 
     if not tasks:
         return Response("No valid tasks found", status=400)
@@ -381,35 +576,124 @@ def launch_multi_geo_run():
     return jsonify({"run_id": run_id}), 202
 
 
-def normalize_url_complex(raw_url: str) -> str:
+@bp.post("/run-matrix")
+def launch_matrix_run():
     """
-    Приводит домен к нижнему регистру, сохраняя регистр local path и параметров.
-    Domain.COM/LoCaL_PatH -> domain.com/LoCaL_PatH
+    URL x country matrix: `urls` - plain URL per line, `countries` - ISO-2 codes
+    separated by spaces/commas. Pairs are expanded lazily inside the engine.
     """
-    url = raw_url.strip()
-    if not url:
-        return ""
+    cfg = ConfigStore.get()
+    urls = parse_url_lines((request.form.get("urls") or "").splitlines())
+    countries_raw = (request.form.get("countries") or "").replace(",", " ").split()
+    countries = list(dict.fromkeys(c.lower() for c in countries_raw if len(c) == 2 and c.isalpha()))
+
+    if not urls or not countries:
+        log.warning("Matrix Run rejected: no URLs or no valid countries.")
+        return jsonify({"error": "Need at least one URL and one valid ISO-2 country"}), 400
 
-    # Добавляем временную схему, если её нет, для корректного парсинга
-    has_scheme = "://" in url
-    parse_url = url if has_scheme else f"http://{url}"
+    order = request.form.get("order") or cfg.execution.matrix_order
+    if order not in ("geo", "url"):
+        return jsonify({"error": "order must be 'geo' or 'url'"}), 400
 
+    run_params = {
+        "urls": urls,
+        "countries": countries,
+        "order": order,
+        "proxy_type": request.form.get("proxy_type") or "http",
+        "dns_mode": request.form.get("dns_mode") or "proxy",
+        "connection_type": request.form.get("connection_type") or "wifi",
+        "proxy_host": request.form.get("proxy_host") or None,
+        "proxy_port": request.form.get("proxy_port") or None,
+        "timeout_sec": int(request.form.get("timeout_sec") or 60),
+        "make_screenshot": bool(request.form.get("make_screenshot")),
+        "debug_mode": bool(request.form.get("debug_mode")),
+        "multi_geo": True
+    }
+
+    log.info(f"Accepted /run-matrix request: {len(urls)} URLs x {len(countries)} countries, order={order}.")
+    run_id = start_matrix_run(run_params)
+    return jsonify({"run_id": run_id}), 202
+
+
+@bp.get("/runs/<run_id>/whois/<path:domain>")
+def run_whois_record(run_id: str, domain: str):
+    """Raw RDAP record of one domain (its first IP) from a DNS run; `?ip=` picks another IP."""
+    record = WhoisStore.read(run_id, domain=domain, ip=request.args.get("ip") or None)
+    if record is None:
+        return jsonify({"error": "Whois record not found"}), 404
+    return jsonify(record)
+
+
+@bp.get("/runs/<run_id>/matrix")
+def run_matrix(run_id: str):
+    """Compact result matrix of a matrix run (cells[i][j] = result for urls[i] x countries[j])."""
+    st = get_run_state(run_id)
+    if st is None:
+        return jsonify({"error": "Run not found"}), 404
+    if st.get("kind") != "matrix":
+        return jsonify({"error": "Not a matrix run"}), 400
+    meta = st.get("meta") or {}
+    rows = RunRegistry.get_rows(run_id, 0, st.get("total") or 0)
+    matrix = build_matrix(meta.get("urls", []), meta.get("countries", []), rows)
+    return jsonify({"run_id": run_id, "status": st["status"], "done": st["done"], **matrix})
+
+
+@bp.post("/runs/bulk")
+def launch_bulk_run():
+    """
+    Streaming bulk upload for very large lists.
+    Body: NDJSON ({"url": "...", "country": "kz"} per line) or plain text
+    (`url` or `url cc` per line). Run settings go into the query string,
+    `country` is the default for lines without one.
+    The body is spooled to disk in chunks; parsing and dedup happen in the engine.
+    """
+    cfg = ConfigStore.get()
+    args = request.args
+
+    # параметры проверяем до записи тела на диск: ошибка в query string - 400 без spool-файла
     try:
-        parsed = urllib.parse.urlsplit(parse_url)
-        # собираем обратно: домен в lower, остальное как есть
-        netloc = parsed.netloc.lower()
-        path = parsed.path
-        query = parsed.query
-        fragment = parsed.fragment
-
-        # пересобираем без схемы, если её не было изначально
-        scheme = parsed.scheme + "://" if has_scheme else ""
-        new_url = f"{scheme}{netloc}{path}"
-        if query:
-            new_url += f"?{query}"
-        if fragment:
-            new_url += f"#{fragment}"
-        return new_url
-    except Exception:
-        # Если парсер упал, возвращаем как есть (fallback)
-        return url
+        timeout_sec = int(args.get("timeout_sec") or cfg.execution.timeout_sec)
+        proxy_port = int(args["proxy_port"]) if args.get("proxy_port") else None
+    except ValueError:
+        log.warning(f"Bulk run rejected: bad query params {dict(args)}")
+        return jsonify({"error": "timeout_sec and proxy_port must be integers"}), 400
+    if timeout_sec <= 0:
+        return jsonify({"error": "timeout_sec must be positive"}), 400
+    if proxy_port is not None and not 1 <= proxy_port <= 65535:
+        return jsonify({"error": "proxy_port must be in 1-65535"}), 400
+
+    spool_dir = os.path.join(cfg.paths.data_dir, "runs")
+    os.makedirs(spool_dir, exist_ok=True)
+
+    fd, spool_path = tempfile.mkstemp(dir=spool_dir, suffix=".ingest")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(request.stream, f, 64 * 1024)
+            size = f.tell()
+    except Exception as e:
+        os.unlink(spool_path)
+        log.error(f"Bulk upload failed: {e}", exc_info=True)
+        return jsonify({"error": f"Upload failed: {e}"}), 400
+
+    if size == 0:
+        os.unlink(spool_path)
+        log.warning("Bulk run rejected: empty body.")
+        return jsonify({"error": "Empty body"}), 400
+
+    run_params = {
+        "country": (args.get("country") or "").lower() or None,
+        "proxy_type": args.get("proxy_type") or "http",
+        "dns_mode": args.get("dns_mode") or "proxy",
+        "connection_type": args.get("connection_type") or "wifi",
+        "proxy_host": args.get("proxy_host") or None,
+        "proxy_port": proxy_port,
+        "timeout_sec": timeout_sec,
+        "make_screenshot": args.get("make_screenshot") in ("1", "true", "yes"),
+        "debug_mode": args.get("debug_mode") in ("1", "true", "yes"),
+    }
+
+    log.info(f"Accepted /runs/bulk upload ({size} bytes). Starting bulk run...")
+    run_id = start_bulk_run(run_params, spool_path)
+
+    return jsonify({"run_id": run_id}), 202
+
@@ -1,11 +1,75 @@
+import json, time
 from flask import Blueprint, Response
+from engine.monitor import changes_offsets, tail_changes
 from engine.orchestrator import sse_subscribe
+from providers.catalog_refresh import CatalogRefresher
 from logging_.engine_logger import get_engine_logger
 
 log = get_engine_logger()
 
 bp = Blueprint("sse", __name__, url_prefix="/events")
 
+# потоки, которые читают общие файлы (события пишет другой воркер): период опроса и keepalive
+_FILE_POLL_SEC = 2.0
+_KEEPALIVE_SEC = 15.0
+_CATALOG_TERMINAL = ("catalog_refresh_finished", "catalog_refresh_failed")
+
+
+@bp.get("/catalog")
+def catalog_events():
+    """
+    Прогресс обновления гео-каталога. События читаются из файла прогресса, который пишет
+    воркер, выполняющий refresh, поэтому поток отдаёт любой воркер. Закрывается, когда refresh закончен.
+    """
+    log.info("Client connected to catalog refresh SSE stream.")
+
+    def stream():
+        st = CatalogRefresher.status()
+        refresh_id, sent = st.get("id"), 0
+        while True:
+            events = st.get("events", [])
+            for ev in events[sent:]:
+                yield f"data: {json.dumps(ev, ensure_ascii=False)}\n\n"
+            sent = len(events)
+            if not st.get("running"):
+                if not events or events[-1].get("type") not in _CATALOG_TERMINAL:
+                    # воркер refresh умер, не дописав итог
+                    failed = {"type": "catalog_refresh_failed", "error": st.get("error") or "refresh is not running"}
+                    yield f"data: {json.dumps(failed, ensure_ascii=False)}\n\n"
+                return
+            time.sleep(_FILE_POLL_SEC)
+            st = CatalogRefresher.status()
+            if st.get("id") != refresh_id:
+                return  # уже следующий refresh
+
+    return Response(stream(), mimetype="text/event-stream")
+
+
+@bp.get("/monitor")
+def monitor_events():
+    """
+    Изменения watchlist'ов по мере появления. Читает changes-логи в data/monitor/,
+    а не очередь в памяти, поэтому работает в любом gunicorn-воркере и для любого числа клиентов.
+    """
+    log.info("Client connected to monitor SSE stream.")
+
+    def stream():
+        offsets = changes_offsets()
+        idle = 0.0
+        while True:
+            changes = tail_changes(offsets)
+            for ch in changes:
+                yield f"data: {json.dumps({'type': 'monitor_change', **ch}, ensure_ascii=False)}\n\n"
+            idle = 0.0 if changes else idle + _FILE_POLL_SEC
+            if idle >= _KEEPALIVE_SEC:
+                # комментарий SSE: так замечаем отключившегося клиента
+                yield ": keepalive\n\n"
+                idle = 0.0
+            time.sleep(_FILE_POLL_SEC)
+
+    return Response(stream(), mimetype="text/event-stream")
+
+
 @bp.get("/<run_id>")
 def events(run_id: str):
     log.info(f"[{run_id}] Client connected to SSE stream.")
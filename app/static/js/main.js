@@ -70,6 +70,40 @@ document.addEventListener("DOMContentLoaded", () => {
       });
     }
 
+    // города региона и ISP региона/города подгружаются лениво (сервер кэширует их с TTL)
+    let scopedGeoSeq = 0;
+    const refreshScoped = async (withCities) => {
+      const countryCode = countrySelect ? countrySelect.value : '';
+      if (!countryCode) { return; }
+      const seq = ++scopedGeoSeq;
+      const params = new URLSearchParams({ country: countryCode });
+      if (regionSelect && regionSelect.value) params.set('region', regionSelect.value);
+      const ispParams = new URLSearchParams(params);
+      if (!withCities && citySelect && citySelect.value) ispParams.set('city', citySelect.value);
+      try {
+        const requests = [fetch(`${geoUrls.isps}?${ispParams}`)];
+        if (withCities) requests.push(fetch(`${geoUrls.cities}?${params}`));
+        const responses = await Promise.all(requests);
+        if (responses.some(r => !r.ok)) {
+          console.error("Failed to fetch scoped geo data: One or more requests failed.");
+          return;
+        }
+        const [isps, cities] = await Promise.all(responses.map(r => r.json()));
+        if (seq !== scopedGeoSeq || countrySelect.value !== countryCode) { return; } // пользователь уже выбрал другое
+        const selectedIsp = ispSelect.value;
+        populateSelect(ispSelect, isps, 'isp');
+        if ([...ispSelect.options].some(o => o.value === selectedIsp)) ispSelect.value = selectedIsp;
+        if (withCities) populateSelect(citySelect, cities, 'city');
+      } catch (err) {
+        console.error("Failed to fetch scoped geo data:", err);
+      }
+    };
+
+    if (regionSelect && citySelect && ispSelect) {
+      regionSelect.addEventListener("change", () => refreshScoped(true));
+      citySelect.addEventListener("change", () => refreshScoped(false));
+    }
+
     // перехват формы и SSE
     const form = document.getElementById("check-form");
     const resetButton = document.getElementById("reset-form-button");
@@ -107,6 +141,9 @@ document.addEventListener("DOMContentLoaded", () => {
         const card = document.createElement("div");
         card.className = "result-card";
         card.id = getCardId(payload);
+        if (payload.idx !== undefined && payload.idx !== null) {
+            card.dataset.idx = payload.idx;
+        }
         let icon = "🔄";
         let statusClass = "";
         let statusText = payload.type === 'check_started' ? 'Running...' : payload.result;
@@ -116,6 +153,13 @@ document.addEventListener("DOMContentLoaded", () => {
             if (payload.result === 'success') {
                 icon = "✅"; statusClass = "status-success";
                 details = `HTTP ${payload.http_code || 200} | TTFB: ${payload.ttfb_ms || '-'} ms`;
+                if (payload.ext_ip && payload.ext_ip !== '-') {
+                    details += ` | Exit: ${payload.ext_ip}${payload.ext_country ? ` (${payload.ext_country.toUpperCase()})` : ''}`;
+                }
+                if (payload.geo_mismatch) {
+                    icon = "⚠️";
+                    details += ` | <span class="status-error">exit geo mismatch</span>`;
+                }
             } else {
                 icon = "❌"; statusClass = "status-error";
                 details = `Error: ${payload.result} ${payload.http_code ? `(${payload.http_code})` : ''} | ${payload.notes || ''}`;
@@ -156,6 +200,56 @@ document.addEventListener("DOMContentLoaded", () => {
         return header;
      };
 
+    // Multi-Geo выполняется сгруппированно по гео, а карточки показываем
+    // в исходном порядке ввода (payload.idx)
+    const insertCard = (card) => {
+        const idx = card.dataset.idx;
+        if (idx !== undefined) {
+            const next = Array.from(resultsContainer.querySelectorAll(".result-card[data-idx]"))
+                .find(el => Number(el.dataset.idx) > Number(idx));
+            if (next) {
+                resultsContainer.insertBefore(card, next);
+                return;
+            }
+        }
+        resultsContainer.append(card);
+    };
+
+    // Матричный режим: таблица URL x country, ячейки обновляются по matrix_cell
+    const renderMatrix = (payload) => {
+        // URL и страны - пользовательский ввод: только textContent, никакого innerHTML
+        const m = payload.settings.matrix;
+        const table = document.createElement("table");
+        table.className = "matrix-table";
+        table.id = `matrix-${payload.run_id}`;
+        const headRow = table.createTHead().insertRow();
+        headRow.appendChild(document.createElement("th")).textContent = "URL";
+        m.countries.forEach(c => { headRow.appendChild(document.createElement("th")).textContent = String(c).toUpperCase(); });
+        const tbody = table.createTBody();
+        m.urls.forEach((u, i) => {
+            const row = tbody.insertRow();
+            const urlCell = row.insertCell();
+            urlCell.className = "code";
+            urlCell.textContent = u;
+            m.countries.forEach((c, j) => {
+                const td = row.insertCell();
+                td.id = `cell-${payload.run_id}-${i}-${j}`;
+                td.className = "muted";
+                td.textContent = "…";
+            });
+        });
+        return table;
+    };
+
+    const updateMatrixCell = (payload) => {
+        const td = document.getElementById(`cell-${payload.run_id}-${payload.i}-${payload.j}`);
+        if (!td) return;
+        const ok = payload.result === 'success';
+        td.className = ok ? "status-success" : "status-error";
+        td.textContent = ok ? `✅ ${payload.http_code || 200}` : `❌ ${payload.result}`;
+        td.title = ok ? `TTFB: ${payload.ttfb_ms || '-'} ms` : (payload.notes || '');
+    };
+
     if (form && runButton) {
       form.addEventListener("submit", async (e) => {
         e.preventDefault();
@@ -164,9 +258,11 @@ document.addEventListener("DOMContentLoaded", () => {
         if (currentEventSource) { currentEventSource.close(); }
 
         const formData = new FormData(form);
+        const matrixCountries = document.getElementById("matrix_countries");
+        const matrixMode = !!(form.dataset.matrixAction && matrixCountries && matrixCountries.value.trim());
         let response;
         try {
-          response = await fetch(form.action, { method: "POST", body: formData });
+          response = await fetch(matrixMode ? form.dataset.matrixAction : form.action, { method: "POST", body: formData });
         } catch (err) {
           console.error("Fetch error:", err);
           resultsContainer.innerHTML = `<div class="result-card status-error">Network error submitting run.</div>`;
@@ -192,8 +288,13 @@ document.addEventListener("DOMContentLoaded", () => {
             const payload = JSON.parse(event.data);
             if (payload.type === 'run_started') {
                 resultsContainer.prepend(renderHeader(payload));
+                if (payload.settings?.matrix) { resultsContainer.append(renderMatrix(payload)); }
+            } else if (payload.type === 'matrix_cell') {
+                updateMatrixCell(payload);
+            } else if (matrixMode && (payload.type === 'check_started' || payload.type === 'check_finished')) {
+                // в матричном режиме карточки не рисуем, хватает таблицы
             } else if (payload.type === 'check_started') {
-                resultsContainer.append(renderCard(payload));
+                insertCard(renderCard(payload));
             } else if (payload.type === 'check_finished') {
                 const cardId = getCardId(payload);
 
@@ -201,13 +302,24 @@ document.addEventListener("DOMContentLoaded", () => {
             if (existingCard) {
                 existingCard.replaceWith(renderCard(payload));
             } else {
-                resultsContainer.append(renderCard(payload));
+                insertCard(renderCard(payload));
             }
         } else if (payload.type === 'run_finished') {
                 const statusEl = document.getElementById(`run-status-${payload.run_id}`);
                 if (statusEl) { statusEl.textContent = `(Finished in ${payload.totals.time_ms / 1000}s. OK: ${payload.totals.ok}, Err: ${payload.totals.err})`; }
                 runButton.disabled = false; runButton.textContent = "Run checks";
                 currentEventSource.close();
+            } else if (payload.type === 'run_failed') {
+                // запуск остановлен движком (например, 407 от прокси) - дальше проверять бессмысленно
+                const statusEl = document.getElementById(`run-status-${payload.run_id}`);
+                if (statusEl) {
+                    statusEl.textContent = `(Failed: ${payload.reason}. OK: ${payload.totals.ok}, Err: ${payload.totals.err})`;
+                    statusEl.classList.add("status-error");
+                }
+                resultsContainer.querySelectorAll(".result-card .status:not(.status-success):not(.status-error)")
+                    .forEach(el => { el.textContent = "aborted"; });
+                runButton.disabled = false; runButton.textContent = "Run checks";
+                currentEventSource.close();
             }
          };
         currentEventSource.onerror = (err) => {
@@ -306,10 +418,16 @@ document.addEventListener("DOMContentLoaded", () => {
                 } else {
                     ownerInfo = ownerText;
                 }
+                // несколько IP у разных владельцев -- показываем всех
+                if (payload.owners && payload.owners.length > 1) {
+                    ownerInfo = payload.owners.join(', ');
+                }
             }
 
-            // whois_log_path
-            if (payload.whois_log_path) {
+            // whois_url (архив запуска) или whois_log_path (старые запуски)
+            if (payload.whois_url) {
+                detailsButtonHtml = `<a href="${payload.whois_url}" target="_blank" rel="noopener noreferrer" class="btn-details">Details</a>`;
+            } else if (payload.whois_log_path) {
                 // Ссылка на статический файл, который отдает /logs/
                 const fileUrl = `/logs/${payload.whois_log_path}`;
                 detailsButtonHtml = `<a href="${fileUrl}" target="_blank" rel="noopener noreferrer" class="btn-details">Details</a>`;
@@ -402,10 +520,16 @@ document.addEventListener("DOMContentLoaded", () => {
                 } else {
                     dnsResultsContainer.append(renderDnsCard(payload));
                 }
+            } else if (payload.type === 'dns_retry_lane') {
+                const statusEl = document.getElementById(`dns-run-status-${payload.run_id}`);
+                if (statusEl) {
+                     statusEl.textContent = ` (Running... retrying ${payload.ips} IPs throttled by RDAP registries)`;
+                }
             } else if (payload.type === 'dns_run_finished') {
                 const statusEl = document.getElementById(`dns-run-status-${payload.run_id}`);
                 if (statusEl) {
-                     statusEl.textContent = ` (Finished in ${payload.totals.time_ms / 1000}s. OK: ${payload.totals.ok}, Err: ${payload.totals.err})`;
+                     const uniqueIps = payload.totals.unique_ips !== undefined ? `, unique IPs: ${payload.totals.unique_ips}` : '';
+                     statusEl.textContent = ` (Finished in ${payload.totals.time_ms / 1000}s. OK: ${payload.totals.ok}, Err: ${payload.totals.err}${uniqueIps})`;
                 }
                 dnsRunButton.disabled = false; dnsRunButton.textContent = "Run DNS check";
                 dnsEventSource.close();
@@ -420,4 +544,73 @@ document.addEventListener("DOMContentLoaded", () => {
          };
       });
     }
+
+    // прогресс обновления гео-каталога (страница Geo Catalog):
+    // поток событий открываем, только пока refresh идёт, и закрываем по его окончании
+    const catalogProgress = document.getElementById("catalog-refresh-progress");
+    if (catalogProgress) {
+      const watchCatalogRefresh = () => {
+        const catalogEvents = new EventSource(catalogProgress.dataset.eventsUrl);
+        catalogEvents.onmessage = (event) => {
+          const payload = JSON.parse(event.data);
+          if (payload.type === 'catalog_refresh_started') {
+            catalogProgress.textContent = `Refreshing ${payload.total} countries...`;
+          } else if (payload.type === 'catalog_country_done') {
+            const what = payload.error ? `failed: ${payload.error}`
+                       : (payload.changed.length ? `updated ${payload.changed.join(', ')}` : 'unchanged');
+            catalogProgress.textContent = `${payload.done}/${payload.total} — ${payload.code.toUpperCase()} ${what}`;
+          } else if (payload.type === 'catalog_refresh_finished') {
+            catalogProgress.textContent = `Refresh finished in ${payload.duration_sec}s: ${payload.changed} changed, ` +
+              `${payload.failed} failed of ${payload.total}. ` + (payload.changed ? 'Reload the page to see the new data.' : '');
+            catalogEvents.close();
+          } else if (payload.type === 'catalog_refresh_failed') {
+            catalogProgress.textContent = `Refresh not completed: ${payload.error}`;
+            catalogEvents.close();
+          }
+        };
+        catalogEvents.onerror = () => catalogEvents.close();
+      };
+
+      fetch(catalogProgress.dataset.statusUrl)
+        .then(res => res.ok ? res.json() : null)
+        .then(st => {
+          if (st && st.running) {
+            catalogProgress.textContent = st.total ? `Refreshing: ${st.done}/${st.total} countries...` : 'Refreshing...';
+            watchCatalogRefresh();
+          }
+        })
+        .catch(err => console.error("Failed to fetch catalog refresh status:", err));
+    }
+
+    // изменения watchlist'ов (страница Multi-Geo): последние из /api/monitor/changes,
+    // дальше живые из /events/monitor. Значения - пользовательские, поэтому только textContent
+    const monitorChanges = document.getElementById("monitor-changes");
+    if (monitorChanges) {
+      const MAX_MONITOR_CHANGES = 50;
+      const addMonitorChange = (ch) => {
+        const placeholder = monitorChanges.querySelector("p.muted");
+        if (placeholder) placeholder.remove();
+        const fields = Object.entries(ch.changes || {})
+          .map(([field, [before, after]]) => `${field}: ${before ?? '—'} → ${after ?? '—'}`).join("; ");
+        const line = document.createElement("div");
+        line.className = "code";
+        line.textContent = `${ch.ts} [${ch.watchlist || ch.watchlist_id}] ${ch.url} ${String(ch.country).toUpperCase()} — ${fields}`;
+        monitorChanges.prepend(line);
+        while (monitorChanges.children.length > MAX_MONITOR_CHANGES) {
+          monitorChanges.lastElementChild.remove();
+        }
+      };
+
+      fetch(monitorChanges.dataset.changesUrl)
+        .then(res => res.ok ? res.json() : [])
+        .then(changes => changes.forEach(addMonitorChange))
+        .catch(err => console.error("Failed to fetch watchlist changes:", err))
+        .finally(() => {
+          const monitorEvents = new EventSource(monitorChanges.dataset.eventsUrl);
+          monitorEvents.onmessage = (event) => {
+            const payload = JSON.parse(event.data);
+            if (payload.type === 'monitor_change') addMonitorChange(payload);
+          };
+        });
+    }
   });
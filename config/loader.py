@@ -25,6 +25,9 @@ class PathsCfg:
 class ExecCfg:
     max_concurrency: int
     timeout_sec: int
+    geo_affinity: bool = True
+    matrix_order: str = "geo"  # geo | url
+    fatal_proxy_error_limit: int = 2  # после стольких 407/quota запуск прерывается (0 - не прерывать)
 
 
 @dataclass
@@ -33,6 +36,7 @@ class ProxyCfg:
     dns_mode: str
     sticky_policy: str
     sticky_ttl_sec: int
+    exit_ip_lookup: bool = True  # определять exit IP/страну sticky-сессий
 
 
 @dataclass
@@ -55,6 +59,9 @@ class SoaxCfg:
     session_password: str | None
     api_key: str | None
     package_key: str | None
+    port_range: str | None = None          # "9001-9100" - раскидывать Port-mode проверки по портам
+    port_strategy: str = "least_loaded"    # least_loaded | hash | map
+    port_max_inflight: int = 0             # одновременных проверок на порт (0 - без лимита)
 
 
 @dataclass
@@ -70,6 +77,97 @@ class DnsCheckerCfg:
     provider_keywords: Dict[str, List[str]] = field(default_factory=dict)
 
 
+@dataclass
+class DnsResolverCfg:
+    nameservers: List[str] = field(default_factory=list)  # пусто - из /etc/resolv.conf
+    timeout_sec: float = 3.0     # на один запрос к одному nameserver'у
+    lifetime_sec: float = 8.0    # на весь lookup (с повторами по nameserver'ам)
+    max_workers: int = 32        # отдельный пул под DNS, не из max_concurrency
+    record_types: List[str] = field(default_factory=lambda: ["A", "AAAA"])
+    cache_max_entries: int = 20000
+    min_ttl_sec: int = 30
+    max_ttl_sec: int = 3600
+    negative_ttl_sec: int = 300  # NXDOMAIN / нет записей
+
+
+@dataclass
+class RdapCacheCfg:
+    enabled: bool = True
+    ttl_sec: int = 7 * 86400     # сколько RDAP-ответ по сети считается актуальным
+    max_entries: int = 50000     # сетей в файле кэша
+    flush_interval_sec: int = 30
+
+
+@dataclass
+class RdapSchedulerCfg:
+    rate_per_sec: float = 2.0    # HTTP-запросов в секунду на реестр
+    registries: Dict[str, float] = field(default_factory=lambda: {"ripencc": 1.0})  # свои лимиты
+    burst: int = 2
+    concurrency: int = 2         # одновременных lookup'ов на реестр
+    timeout_sec: int = 10
+    retry_count: int = 1         # повторы ipwhois на сетевые ошибки
+    base_backoff_sec: int = 5    # первый backoff после 429 без Retry-After, дальше x2
+    max_backoff_sec: int = 300
+    main_max_wait_sec: int = 10  # дольше ждать в основной полосе нельзя -> retry-полоса
+    retry_attempts: int = 3
+
+
+@dataclass
+class GeoDbCfg:
+    path: str | None = None        # по умолчанию <data_dir>/catalog/ip_geo.bin
+    csv_path: str | None = None    # источник для refresh (CSV или .csv.gz)
+    csv_url: str | None = None     # или скачивать отсюда
+    http_fallback: bool = True     # geolocation-db.com, если IP нет в локальной базе
+    fallback_timeout_sec: int = 5
+
+
+@dataclass
+class RunsCfg:
+    recent_max_runs: int = 20
+    recent_max_age_sec: int = 3600
+    memory_budget_mb: int = 64
+    active_rows_window: int = 2000
+    archive_retention_days: int = 30
+
+
+@dataclass
+class MonitorCfg:
+    enabled: bool = True
+    min_interval_sec: int = 300
+    tick_sec: int = 15
+
+
+@dataclass
+class ProxyHealthCfg:
+    enabled: bool = True
+    window: int = 20            # сколько последних исходов учитываем
+    min_samples: int = 5        # раньше этого circuit не открывается
+    failure_ratio: float = 0.6  # доля прокси-ошибок для открытия
+    cooldown_sec: int = 60
+    max_cooldown_sec: int = 600
+
+
+@dataclass
+class PortMapCfg:
+    port_range: str | None = None   # диапазон для обхода (по умолчанию soax.port_range)
+    probe_password: str = "wifi;;;;"  # Port-mode пароль для проб (без гео - "какой exit у порта")
+    rate_per_sec: float = 5.0
+    concurrency: int = 10
+    timeout_sec: int = 15
+    interval_sec: int = 0           # периодический обход (0 - только вручную)
+    max_age_sec: int = 3600         # более старые записи не используются для выбора порта
+
+
+@dataclass
+class CatalogRefreshCfg:
+    concurrency: int = 6        # стран одновременно
+    rate_per_sec: float = 10.0  # запросов к SOAX API в секунду (на весь refresh)
+    conn_type: str = "wifi"     # conn_type для списков регионов/городов
+    scoped_ttl_sec: int = 86400       # города региона / ISP города (лениво из UI)
+    scoped_max_entries: int = 5000    # на каждый вид (cities, isps)
+    scoped_timeout_sec: int = 10      # таймаут такого запроса к API (UI ждёт ответ)
+
+
 @dataclass
 class RootCfg:
     app: AppCfg
@@ -81,11 +179,21 @@ class RootCfg:
     soax: SoaxCfg
     http_client: HttpCfg
     dns_checker: DnsCheckerCfg
+    dns_resolver: DnsResolverCfg
+    rdap_cache: RdapCacheCfg
+    rdap_scheduler: RdapSchedulerCfg
+    geo_db: GeoDbCfg
+    runs: RunsCfg
+    monitor: MonitorCfg
+    proxy_health: ProxyHealthCfg
+    port_map: PortMapCfg
+    catalog_refresh: CatalogRefreshCfg
 
 
 class ConfigStore:
     _cfg: RootCfg = None
     _yaml_text: str = ""
+    _version: int = 0  # растёт при каждой (пере)загрузке - для кэшей, зависящих от конфига
 
     @classmethod
     def init(cls):
@@ -143,13 +251,49 @@ class ConfigStore:
             # Заглушка для обратной совместимости, если http_client есть, а ключа нет
             data["http_client"]["custom_headers"] = {}
 
-            # default для dns_checker
-            if "dns_checker" not in data:
-                data["dns_checker"] = {
-                    "provider_keywords": {}
-                }
-            elif "provider_keywords" not in data["dns_checker"]:
-                data["dns_checker"]["provider_keywords"] = {}
+        # default для dns_checker
+        if "dns_checker" not in data:
+            data["dns_checker"] = {
+                "provider_keywords": {}
+            }
+        elif "provider_keywords" not in data["dns_checker"]:
+            data["dns_checker"]["provider_keywords"] = {}
+
+        # defaults для DNS-резолвера
+        if "dns_resolver" not in data:
+            data["dns_resolver"] = {}
+
+        # defaults для кэша RDAP
+        if "rdap_cache" not in data:
+            data["rdap_cache"] = {}
+
+        # defaults для лимитов RDAP по реестрам
+        if "rdap_scheduler" not in data:
+            data["rdap_scheduler"] = {}
+
+        # defaults для локальной гео-базы IP
+        if "geo_db" not in data:
+            data["geo_db"] = {}
+
+        # defaults для реестра запусков
+        if "runs" not in data:
+            data["runs"] = {}
+
+        # defaults для мониторинга
+        if "monitor" not in data:
+            data["monitor"] = {}
+
+        # defaults для circuit breaker'а прокси
+        if "proxy_health" not in data:
+            data["proxy_health"] = {}
+
+        # defaults для карты порт -> exit
+        if "port_map" not in data:
+            data["port_map"] = {}
+
+        # defaults для обновления гео-каталога SOAX
+        if "catalog_refresh" not in data:
+            data["catalog_refresh"] = {}
 
         cls._cfg = RootCfg(
             app=AppCfg(**data["app"]),
@@ -160,10 +304,20 @@ class ConfigStore:
             screenshots=ShotsCfg(**data["screenshots"]),
             soax=SoaxCfg(**data["soax"]),
             http_client=HttpCfg(**data["http_client"]),
-            dns_checker=DnsCheckerCfg(**data["dns_checker"])
+            dns_checker=DnsCheckerCfg(**data["dns_checker"]),
+            dns_resolver=DnsResolverCfg(**data["dns_resolver"]),
+            rdap_cache=RdapCacheCfg(**data["rdap_cache"]),
+            rdap_scheduler=RdapSchedulerCfg(**data["rdap_scheduler"]),
+            geo_db=GeoDbCfg(**data["geo_db"]),
+            runs=RunsCfg(**data["runs"]),
+            monitor=MonitorCfg(**data["monitor"]),
+            proxy_health=ProxyHealthCfg(**data["proxy_health"]),
+            port_map=PortMapCfg(**data["port_map"]),
+            catalog_refresh=CatalogRefreshCfg(**data["catalog_refresh"])
         )
 
         cls._override_from_env(cls._cfg)
+        cls._version += 1
 
         os.makedirs(cls._cfg.paths.data_dir, exist_ok=True)
         os.makedirs(cls._cfg.paths.logs_dir, exist_ok=True)
@@ -183,6 +337,7 @@ class ConfigStore:
             "DNS_MODE": (cfg.proxy, "dns_mode"),
             "STICKY_POLICY": (cfg.proxy, "sticky_policy"),
             "STICKY_TTL_SEC": (cfg.proxy, "sticky_ttl_sec", int),
+            "EXIT_IP_LOOKUP": (cfg.proxy, "exit_ip_lookup", lambda v: v.lower() in ("1", "true", "yes")),
             "MAX_SCREENSHOT_WORKERS": (cfg.screenshots, "max_workers", int),
             "SCREENSHOT_TIMEOUT_SEC": (cfg.screenshots, "timeout_sec", int),
             "SCREENSHOT_WAIT_AFTER_LOAD_SEC": (cfg.screenshots, "wait_after_load_sec", int),
@@ -195,7 +350,20 @@ class ConfigStore:
             "SOAX_SESSION_PASSWORD": (cfg.soax, "session_password"),
             "SOAX_API_KEY": (cfg.soax, "api_key"),
             "SOAX_PACKAGE_KEY": (cfg.soax, "package_key"),
+            "SOAX_PORT_RANGE": (cfg.soax, "port_range"),
+            "SOAX_PORT_STRATEGY": (cfg.soax, "port_strategy"),
+            "SOAX_PORT_MAX_INFLIGHT": (cfg.soax, "port_max_inflight", int),
             "USER_AGENT": (cfg.http_client, "user_agent"),
+            "CATALOG_REFRESH_RATE": (cfg.catalog_refresh, "rate_per_sec", float),
+            "DNS_NAMESERVERS": (cfg.dns_resolver, "nameservers", lambda v: [x.strip() for x in v.split(",") if x.strip()]),
+            "DNS_MAX_WORKERS": (cfg.dns_resolver, "max_workers", int),
+            "RDAP_CACHE_TTL_SEC": (cfg.rdap_cache, "ttl_sec", int),
+            "GEO_DB_CSV_URL": (cfg.geo_db, "csv_url"),
+            "GEO_HTTP_FALLBACK": (cfg.geo_db, "http_fallback", lambda v: v.lower() in ("1", "true", "yes")),
+            "RUNS_RECENT_MAX": (cfg.runs, "recent_max_runs", int),
+            "RUNS_MEMORY_BUDGET_MB": (cfg.runs, "memory_budget_mb", int),
+            "MONITOR_ENABLED": (cfg.monitor, "enabled", lambda v: v.lower() in ("1", "true", "yes")),
+            "PROXY_HEALTH_ENABLED": (cfg.proxy_health, "enabled", lambda v: v.lower() in ("1", "true", "yes")),
         }
 
         for env_key, info in env_map.items():
@@ -215,6 +383,11 @@ class ConfigStore:
             cls.init()
         return cls._cfg
 
+    @classmethod
+    def version(cls) -> int:
+        cls.get()
+        return cls._version
+
     @classmethod
     def raw_yaml(cls) -> str:
         return cls._yaml_text
@@ -41,6 +41,7 @@ proxy:
   dns_mode: proxy
   sticky_policy: auto
   sticky_ttl_sec: 360
+  exit_ip_lookup: true
 screenshots:
   enabled_default: false
   max_workers: 1
@@ -57,6 +58,9 @@ soax:
   session_password: null
   api_key: null
   package_key: null
+  port_range: null          # e.g. "9001-9100": spread Port-mode checks over these ports
+  port_strategy: least_loaded   # least_loaded | hash | map
+  port_max_inflight: 0      # concurrent checks per port, 0 = unlimited
 http_client:
   user_agent: "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/143.0.0.0 Safari/537.36"
   accept: "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8"
@@ -69,6 +73,72 @@ http_client:
     #  X-CF-Bypass: "MySecretToken123"
     #  Another-Header: "SomeValue"
     #  User-Referer: "https://example.com/"
+runs:
+  # in-memory window of finished runs (older ones are read from /data/runs)
+  recent_max_runs: 20
+  recent_max_age_sec: 3600
+  memory_budget_mb: 64
+  active_rows_window: 2000
+  archive_retention_days: 30
+monitor:
+  enabled: true
+  min_interval_sec: 300
+  tick_sec: 15
+port_map:
+  port_range: null          # defaults to soax.port_range
+  probe_password: "wifi;;;;"
+  rate_per_sec: 5
+  concurrency: 10
+  timeout_sec: 15
+  interval_sec: 0           # periodic sweep, 0 = manual only
+  max_age_sec: 3600
+catalog_refresh:
+  concurrency: 6            # countries fetched in parallel
+  rate_per_sec: 10          # SOAX API requests per second
+  conn_type: wifi
+  scoped_ttl_sec: 86400     # region/city-scoped cities and ISPs, fetched on first use
+  scoped_max_entries: 5000
+  scoped_timeout_sec: 10
+proxy_health:
+  enabled: true
+  window: 20
+  min_samples: 5
+  failure_ratio: 0.6
+  cooldown_sec: 60
+  max_cooldown_sec: 600
+dns_resolver:
+  nameservers: []           # e.g. ["1.1.1.1", "8.8.8.8"]; empty = system resolv.conf
+  timeout_sec: 3
+  lifetime_sec: 8
+  max_workers: 32           # DNS pool, separate from execution.max_concurrency
+  record_types: ["A", "AAAA"]
+  cache_max_entries: 20000
+  min_ttl_sec: 30
+  max_ttl_sec: 3600
+  negative_ttl_sec: 300
+rdap_cache:
+  enabled: true
+  ttl_sec: 604800           # RDAP answer per network, 7 days
+  max_entries: 50000
+  flush_interval_sec: 30
+rdap_scheduler:
+  rate_per_sec: 2           # RDAP requests per second per registry
+  registries:               # per-registry overrides (arin, ripencc, apnic, lacnic, afrinic)
+    ripencc: 1
+  burst: 2
+  concurrency: 2            # concurrent lookups per registry
+  timeout_sec: 10
+  retry_count: 1
+  base_backoff_sec: 5       # after a 429 without Retry-After, doubled up to max
+  max_backoff_sec: 300
+  main_max_wait_sec: 10     # longer waits go to the retry lane after the main pass
+  retry_attempts: 3
+geo_db:
+  path: null                # default: /data/catalog/ip_geo.bin
+  csv_path: null            # CSV (or .csv.gz) to build from on refresh
+  csv_url: null             # or download it from here
+  http_fallback: true       # ask geolocation-db.com when the IP is not in the local DB
+  fallback_timeout_sec: 5
 dns_checker:
   # key: Canonical name (displayed in the UI)
   # value: List of keywords for Whois/RDAP search
@@ -1,37 +1,45 @@
-import socket
+import ipaddress
 import requests
 import json
 import os
+import threading
 from datetime import datetime
-from ipwhois import IPWhois
+from typing import Dict
 from ipwhois.exceptions import BaseIpwhoisException
 from logging_.engine_logger import get_engine_logger
 from config.loader import ConfigStore
 from logging_.md_writer import ensure_day_dir, unique_file_path
+from .dns_resolver import DnsResolver
+from .rdap_cache import RdapCache, networks_of
+from .geo_db import GeoDb
+from .provider_matcher import ProviderMatcher
+from .rdap_scheduler import RdapDeferred, RdapScheduler
+from .whois_store import WhoisStore
 
 log = get_engine_logger()
 
 
-def _parse_owner_from_whois_data(data: dict, provider_map: dict) -> str:
+def _parse_owner_from_whois_data(data: dict) -> tuple[str, list]:
     """
-    Parses RDAP/Whois data and checks against the provider keywords map.
+    Parses RDAP/Whois data and checks it against the compiled provider keywords.
+    Returns (owner, matches), matches = [{provider, keyword, start, end}].
     """
-    if not data or not provider_map:
-        return "Unknown"
+    if not data:
+        return "Unknown", []
 
     search_text_parts = []
 
     net = data.get('network', {})
-    search_text_parts.append(str(net.get('name', '')).lower())
-    search_text_parts.append(str(net.get('remarks', '')).lower())
-    search_text_parts.append(str(data.get('asn_description', '')).lower())
+    search_text_parts.append(str(net.get('name', '')))
+    search_text_parts.append(str(net.get('remarks', '')))
+    search_text_parts.append(str(data.get('asn_description', '')))
 
     entities = data.get('entities', [])
     for entity in entities:
         if isinstance(entity, dict):
             contact = entity.get('contact', {})
-            search_text_parts.append(str(contact.get('name', '')).lower())
-            search_text_parts.append(str(contact.get('organization', '')).lower())
+            search_text_parts.append(str(contact.get('name', '')))
+            search_text_parts.append(str(contact.get('organization', '')))
 
             email = contact.get('email', '')
             if email:
@@ -42,116 +50,239 @@ def _parse_owner_from_whois_data(data: dict, provider_map: dict) -> str:
                     pass
 
         elif isinstance(entity, str):
-            search_text_parts.append(entity.lower())
+            search_text_parts.append(entity)
 
     full_text = " | ".join(search_text_parts)
     log.debug(f"Whois searchable text: {full_text[:500]}...")
 
-    for provider_name, keywords in provider_map.items():
-        for keyword in keywords:
-            if keyword.lower() in full_text:
-                log.debug(f"Found keyword '{keyword}', identified as '{provider_name}'")
-                return provider_name
+    owner, matches = ProviderMatcher.classify(full_text)
+    if matches:
+        log.debug(f"Matched providers {sorted({m['provider'] for m in matches})}, identified as '{owner}'")
+    else:
+        log.debug("No provider keywords matched.")
+    return owner, matches
 
-    log.debug("No provider keywords matched.")
-    return "Unknown"
 
-
-def check_domain_dns_whois(domain: str) -> dict:
+def resolve_domain(domain: str) -> dict:
     """
-    Performs DNS lookup and RDAP/whois query using ipwhois.
-    Saves raw whois data to a file.
+    Stage 1 of a DNS check: A/AAAA через кэширующий резолвер.
+    Returns {domain, ips, cname, error}.
     """
-    ips = []
-    owner = "Unknown"
+    try:
+        resolved = DnsResolver.resolve(domain)
+    except Exception as e:
+        log.error(f"Unexpected error during DNS lookup for {domain}: {e}", exc_info=True)
+        return {'domain': domain, 'ips': [], 'cname': [], 'error': f"Error: {e}"}
+
     error_msg = None
-    raw_whois_text = ""
-    geo_data = {}
-    whois_log_path = None
-    cfg = ConfigStore.get()
+    if resolved["error"]:
+        log.warning(f"DNS lookup failed for {domain}: {resolved['error']}")
+        error_msg = "DNS lookup failed" if resolved["error"] in ("nxdomain", "no_address") \
+            else f"DNS lookup failed ({resolved['error']})"
+    else:
+        log.debug(f"DNS lookup for {domain} successful: IPs {resolved['ips']}"
+                  f"{' (cached)' if resolved['cached'] else ''}")
+    return {'domain': domain, 'ips': resolved["ips"], 'cname': resolved["cname"], 'error': error_msg}
 
-    try:
-        provider_map = cfg.dns_checker.provider_keywords
-    except Exception:
-        log.error("Failed to load provider_keywords from ConfigStore. DNS check might fail.")
-        provider_map = {}
 
-    try:
-        # DNS Lookup (first step)
-        hostname, aliases, ipaddrlist = socket.gethostbyname_ex(domain)
-        ips.extend(ipaddrlist)
-        log.debug(f"DNS lookup for {domain} successful: IPs {ips}")
-
-        # geolocation & RDAP/Whois Lookup (только если DNS Lookup успешен)
-        if ips:
-            first_ip = ips[0]
-            geo_data = _get_geolocation(first_ip)
-
-            try:
-                obj = IPWhois(first_ip)
-                data = obj.lookup_rdap(depth=1, inc_raw=True)
-                raw_data = data.get('raw')
-
-                file_content = ""
-                file_ext = "txt"
-                if isinstance(raw_data, dict):
-                    file_content = json.dumps(raw_data, indent=2)
-                    file_ext = "json"
-                elif isinstance(raw_data, str):
-                    file_content = raw_data
-                else:
-                    file_content = "No raw data returned from ipwhois."
-
-                ts = datetime.now().strftime("%H-%M-%S")
-                base_name = f"{ts}_{domain}"
-                day_dir = ensure_day_dir(cfg.paths.logs_dir)
-                log_file = unique_file_path(day_dir, base_name, f"whois.{file_ext}")
-
-                with open(log_file, "w", encoding="utf-8") as f:
-                    f.write(file_content)
-
-                whois_log_path = os.path.relpath(log_file, cfg.paths.logs_dir)
-                whois_log_path = whois_log_path.replace(os.path.sep, '/')
+def _network_key(ip: str) -> str:
+    """/24 (IPv4) или /48 (IPv6): IP одного блока почти всегда в одной RDAP-сети."""
+    addr = ipaddress.ip_address(ip)
+    return str(ipaddress.ip_network(f"{ip}/{24 if addr.version == 4 else 48}", strict=False))
+
+
+class IpEnricher:
+    """
+    Stage 2 of a DNS run: geolocation + RDAP/whois once per unique IP.
+    IP одного /24 (/48) обрабатываются по очереди, поэтому второй и следующие
+    получают RDAP-ответ сети из RdapCache, а не живым запросом.
+    Один экземпляр на запуск; enrich() потокобезопасен и никогда не бросает.
+
+    RDAP идёт через RdapScheduler: в основной полосе (lane="main") IP, чей реестр
+    сейчас троттлит, возвращается как {'ip', 'deferred': True} и не запоминается -
+    его нужно дообогатить с lane="retry" после основного прохода.
+    """
+
+    def __init__(self, store: WhoisStore | None = None):
+        self.store = store
+        self._results: Dict[str, dict] = {}
+        self._geo: Dict[str, dict] = {}
+        self._net_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def known(self, ip: str) -> dict | None:
+        with self._lock:
+            return self._results.get(ip)
+
+    def _net_lock(self, ip: str) -> threading.Lock:
+        key = _network_key(ip)
+        with self._lock:
+            lock = self._net_locks.get(key)
+            if lock is None:
+                lock = self._net_locks[key] = threading.Lock()
+            return lock
+
+    def enrich(self, ip: str, lane: str = "main") -> dict:
+        known = self.known(ip)
+        if known is not None:
+            return known
+        try:
+            with self._net_lock(ip):
+                info = self._enrich(ip, lane)
+            if info.get('deferred'):
+                return info
+        except Exception as e:
+            log.error(f"Unexpected error enriching {ip}: {e}", exc_info=True)
+            info = {'ip': ip, 'owner': "Whois Parse Error", 'raw_whois_text': str(e), 'whois_log_path': None,
+                    'country_name': None, 'city': None, 'asn': None}
+        with self._lock:
+            self._results[ip] = info
+        return info
+
+    def _enrich(self, ip: str, lane: str) -> dict:
+        cfg = ConfigStore.get()
+        owner = "Unknown"
+        owner_matches = []
+        raw_whois_text = ""
+        whois_log_path = None
+        geo_data = self._geo.get(ip)
+        if geo_data is None:
+            # отложенный IP не должен второй раз ходить в HTTP-геолокацию
+            geo_data = self._geo[ip] = _get_geolocation(ip)
+        asn = geo_data.get('asn')
+
+        try:
+            # ответ по сети из кэша, иначе живой RDAP-запрос
+            data = RdapCache.lookup(ip)
+            cached = data is not None
+            if not cached:
+                data = RdapScheduler.lookup(ip, lane=lane, depth=1)
+                RdapCache.put(data)
+            else:
+                log.debug(f"RDAP for {ip} answered from cache.")
+            asn = asn or data.get('asn')
+            # в кэше нет сырого ответа: он сохранён, когда сеть запрашивали вживую
+            raw_data = data.get('raw')
+            nets = networks_of(data)
+
+            if self.store is not None:
+                # один gzip-NDJSON на запуск (engine/whois_store.py)
+                self.store.append(ip, raw_data, str(nets[0]) if nets else None, cached)
+                raw_whois_text = f"Stored in run archive{' (cached)' if cached else ''}"
+            elif cached:
+                raw_whois_text = f"Answered from RDAP cache (network {nets[0] if nets else 'N/A'})"
+            else:
+                # без хранилища запуска (одиночная проверка) - отдельный файл в логах дня
+                whois_log_path = _save_whois_file(cfg.paths.logs_dir, ip, raw_data)
                 raw_whois_text = f"Saved to {whois_log_path}"
 
-                owner = _parse_owner_from_whois_data(data, provider_map)
+            owner, owner_matches = _parse_owner_from_whois_data(data)
 
-            except BaseIpwhoisException as e:
-                log.warning(f"ipwhois lookup failed for {first_ip} (from {domain}): {e}")
-                owner = "Whois Error"
-                raw_whois_text = getattr(e, 'message', str(e))
-            except Exception as e:
-                log.error(f"Unexpected error during ipwhois parse for {first_ip}: {e}", exc_info=True)
-                owner = "Whois Parse Error"
-                raw_whois_text = str(e)
+        except RdapDeferred as e:
+            log.debug(f"RDAP for {ip} deferred to the retry lane ({e.registry}).")
+            return {'ip': ip, 'deferred': True}
+        except BaseIpwhoisException as e:
+            log.warning(f"ipwhois lookup failed for {ip}: {e}")
+            owner = "Whois Error"
+            raw_whois_text = getattr(e, 'message', str(e))
+        except Exception as e:
+            log.error(f"Unexpected error during ipwhois parse for {ip}: {e}", exc_info=True)
+            owner = "Whois Parse Error"
+            raw_whois_text = str(e)
 
-    except socket.gaierror:
-        log.warning(f"DNS lookup failed for {domain}: Name or service not known")
-        error_msg = "DNS lookup failed"
-    except Exception as e:
-        log.error(f"Unexpected error during DNS lookup for {domain}: {e}", exc_info=True)
-        error_msg = f"Error: {e}"
+        return {
+            'ip': ip,
+            'owner': owner,
+            'owner_matches': owner_matches,
+            'raw_whois_text': raw_whois_text,
+            'whois_log_path': whois_log_path,
+            'country_name': geo_data.get('country_name'),
+            'city': geo_data.get('city'),
+            'asn': asn
+        }
+
+
+def _save_whois_file(logs_dir: str, ip: str, raw_data) -> str:
+    """Пишет сырой whois в файл дня, возвращает путь относительно logs_dir."""
+    file_content = ""
+    file_ext = "txt"
+    if isinstance(raw_data, dict):
+        file_content = json.dumps(raw_data, indent=2)
+        file_ext = "json"
+    elif isinstance(raw_data, str):
+        file_content = raw_data
+    else:
+        file_content = "No raw data returned from ipwhois."
+
+    ts = datetime.now().strftime("%H-%M-%S")
+    base_name = f"{ts}_{ip.replace(':', '-')}"
+    day_dir = ensure_day_dir(logs_dir)
+    log_file = unique_file_path(day_dir, base_name, f"whois.{file_ext}")
+
+    with open(log_file, "w", encoding="utf-8") as f:
+        f.write(file_content)
 
+    whois_log_path = os.path.relpath(log_file, logs_dir)
+    return whois_log_path.replace(os.path.sep, '/')
+
+
+def join_domain(resolved: dict, infos: Dict[str, dict]) -> dict:
+    """
+    Stage 3: собирает строку результата домена из сведений по его IP.
+    owner/geo/whois - по первому IP (как раньше), owners - по всем.
+    """
+    ips = resolved['ips']
+    primary = infos.get(ips[0], {}) if ips else {}
+    owners = list(dict.fromkeys(infos[ip]['owner'] for ip in ips if ip in infos))
+    if len(owners) > 1:
+        owners = [o for o in owners if o != "Unknown"]
     return {
-        'domain': domain,
+        'domain': resolved['domain'],
         'ips': ips,
-        'owner': owner,
-        'error': error_msg,
-        'raw_whois_text': raw_whois_text,
-        'whois_log_path': whois_log_path,
-        'country_name': geo_data.get('country_name'),
-        'city': geo_data.get('city')
+        'cname': resolved['cname'],
+        'owner': primary.get('owner', "Unknown"),
+        'owners': owners,
+        'owner_matches': primary.get('owner_matches', []),
+        'error': resolved['error'],
+        'raw_whois_text': primary.get('raw_whois_text', ""),
+        'whois_log_path': primary.get('whois_log_path'),
+        'country_name': primary.get('country_name'),
+        'city': primary.get('city'),
+        'asn': primary.get('asn'),
+        'ip_info': [
+            {k: infos[ip].get(k) for k in ('ip', 'owner', 'country_name', 'city', 'asn')}
+            for ip in ips if ip in infos
+        ]
     }
 
 
+def check_domain_dns_whois(domain: str, enricher: IpEnricher | None = None) -> dict:
+    """
+    Performs DNS lookup and RDAP/whois query (ipwhois) for every resolved IP
+    of a single domain. Saves raw whois data to files.
+    DNS-запуски используют стадии по отдельности (см. orchestrator._run_dns_checks_async).
+    """
+    resolved = resolve_domain(domain)
+    enricher = enricher or IpEnricher()
+    infos = {ip: enricher.enrich(ip, lane="retry") for ip in resolved['ips']}
+    return join_domain(resolved, infos)
+
+
 def _get_geolocation(ip: str) -> dict:
     """
-    Gets geolocation data from geolocation-db.com.
+    Gets geolocation data from the local IP database (engine/geo_db.py),
+    falling back to geolocation-db.com if enabled and the IP is not there.
     """
     if not ip:
         return {}
+    local = GeoDb.lookup(ip)
+    if local is not None:
+        return local
+    geo_cfg = ConfigStore.get().geo_db
+    if not geo_cfg.http_fallback:
+        return {}
     try:
-        response = requests.get(f"https://geolocation-db.com/json/{ip}", timeout=5)
+        response = requests.get(f"https://geolocation-db.com/json/{ip}", timeout=geo_cfg.fallback_timeout_sec)
         response.raise_for_status()
         data = response.json()
         log.debug(f"Geolocation data for {ip}: {data}")
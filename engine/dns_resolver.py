@@ -0,0 +1,198 @@
+from __future__ import annotations
+import threading, time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+import dns.exception
+import dns.rdatatype
+import dns.resolver
+from config.loader import ConfigStore
+from logging_.engine_logger import get_engine_logger
+
+log = get_engine_logger()
+
+# nameservers, если resolv.conf недоступен (например, в урезанном контейнере)
+_FALLBACK_NAMESERVERS = ["1.1.1.1", "8.8.8.8"]
+
+
+class _Entry:
+    __slots__ = ("expires", "records", "cnames", "error")
+
+    def __init__(self, expires: float, records: List[str], cnames: List[str], error: str | None):
+        self.expires = expires
+        self.records = records
+        self.cnames = cnames
+        self.error = error
+
+
+class DnsResolver:
+    """
+    Кэширующий резолвер на dnspython для DNS-проверок.
+
+    - A/AAAA (record_types) запрашиваются параллельно в собственном пуле
+      (dns_resolver.max_workers), а не в пуле проверок max_concurrency;
+    - положительные ответы кэшируются на TTL записи (в пределах min/max_ttl_sec),
+      NXDOMAIN и "нет записей" - на negative_ttl_sec;
+    - одновременные запросы одного имени схлопываются в один lookup;
+    - nameservers задаются в конфиге (пусто - системный resolv.conf).
+    Таймауты/SERVFAIL не кэшируются.
+    """
+    _cache: "OrderedDict[Tuple[str, str], _Entry]" = OrderedDict()
+    _inflight: Dict[Tuple[str, str], Future] = {}
+    _lock = threading.Lock()
+    _pool: ThreadPoolExecutor | None = None
+    _pool_size = 0
+    _resolver: dns.resolver.Resolver | None = None
+    _resolver_key: tuple | None = None
+    _stats = {"hits": 0, "misses": 0, "negative_hits": 0}
+
+    @classmethod
+    def _get_resolver(cls) -> dns.resolver.Resolver:
+        rc = ConfigStore.get().dns_resolver
+        key = (tuple(rc.nameservers), rc.timeout_sec, rc.lifetime_sec)
+        with cls._lock:
+            if cls._resolver is None or cls._resolver_key != key:
+                if rc.nameservers:
+                    res = dns.resolver.Resolver(configure=False)
+                    res.nameservers = list(rc.nameservers)
+                else:
+                    try:
+                        res = dns.resolver.Resolver()
+                    except dns.resolver.NoResolverConfiguration:
+                        log.warning(f"[dns] No system resolver configuration, using {_FALLBACK_NAMESERVERS}.")
+                        res = dns.resolver.Resolver(configure=False)
+                        res.nameservers = list(_FALLBACK_NAMESERVERS)
+                res.timeout = rc.timeout_sec
+                res.lifetime = rc.lifetime_sec
+                cls._resolver, cls._resolver_key = res, key
+                log.info(f"[dns] Resolver configured: nameservers={res.nameservers}")
+            return cls._resolver
+
+    @classmethod
+    def _get_pool(cls) -> ThreadPoolExecutor:
+        size = max(1, ConfigStore.get().dns_resolver.max_workers)
+        with cls._lock:
+            if cls._pool is None or cls._pool_size != size:
+                old = cls._pool
+                cls._pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix="dns")
+                cls._pool_size = size
+                if old is not None:
+                    old.shutdown(wait=False)
+            return cls._pool
+
+    @classmethod
+    def _query(cls, name: str, rdtype: str) -> _Entry:
+        rc = ConfigStore.get().dns_resolver
+        now = time.monotonic()
+        try:
+            answer = cls._get_resolver().resolve(name, rdtype, raise_on_no_answer=False)
+        except dns.resolver.NXDOMAIN:
+            return _Entry(now + rc.negative_ttl_sec, [], [], "nxdomain")
+        except (dns.resolver.LifetimeTimeout, dns.exception.Timeout):
+            return _Entry(0, [], [], "timeout")
+        except dns.resolver.NoNameservers:
+            return _Entry(0, [], [], "servfail")
+        except dns.exception.DNSException as e:
+            log.debug(f"[dns] {rdtype} {name} failed: {e}")
+            return _Entry(0, [], [], "dns_error")
+
+        cnames = [str(rr.target).rstrip(".") for rrset in answer.chaining_result.cnames for rr in rrset]
+        if answer.rrset is None:
+            return _Entry(now + rc.negative_ttl_sec, [], cnames, None)
+        ttl = min(max(answer.rrset.ttl, rc.min_ttl_sec), rc.max_ttl_sec)
+        records = [rr.to_text() for rr in answer.rrset]
+        return _Entry(now + ttl, records, cnames, None)
+
+    @classmethod
+    def _store(cls, key: Tuple[str, str], entry: _Entry):
+        max_entries = max(1, ConfigStore.get().dns_resolver.cache_max_entries)
+        with cls._lock:
+            cls._inflight.pop(key, None)
+            if entry.expires <= 0:
+                return
+            cls._cache[key] = entry
+            cls._cache.move_to_end(key)
+            while len(cls._cache) > max_entries:
+                cls._cache.popitem(last=False)
+
+    @classmethod
+    def _lookup(cls, name: str, rdtype: str) -> Tuple[Future, bool]:
+        """Future с _Entry: из кэша, уже идущего запроса или нового. (future, from_cache)."""
+        key = (name, rdtype)
+        with cls._lock:
+            entry = cls._cache.get(key)
+            if entry is not None:
+                if entry.expires > time.monotonic():
+                    cls._stats["hits"] += 1
+                    if entry.error or not entry.records:
+                        cls._stats["negative_hits"] += 1
+                    fut: Future = Future()
+                    fut.set_result(entry)
+                    return fut, True
+                del cls._cache[key]
+            fut = cls._inflight.get(key)
+            if fut is not None:
+                return fut, False
+            cls._stats["misses"] += 1
+
+        def task() -> _Entry:
+            entry = _Entry(0, [], [], "dns_error")
+            try:
+                entry = cls._query(name, rdtype)
+            finally:
+                cls._store(key, entry)
+            return entry
+
+        pool = cls._get_pool()
+        with cls._lock:
+            # могли опередить, пока создавали пул
+            fut = cls._inflight.get(key)
+            if fut is None:
+                fut = cls._inflight[key] = pool.submit(task)
+        return fut, False
+
+    @classmethod
+    def resolve(cls, domain: str) -> Dict[str, Any]:
+        """
+        {domain, ipv4, ipv6, ips, cname, error, cached}.
+        ips - сначала IPv4, потом IPv6; cname - цепочка CNAME до канонического имени.
+        error: None | nxdomain | no_address | timeout | servfail | dns_error.
+        """
+        name = domain.strip().rstrip(".").lower()
+        rtypes = [t.upper() for t in ConfigStore.get().dns_resolver.record_types] or ["A"]
+        lookups = {t: cls._lookup(name, t) for t in rtypes}
+        entries = {t: fut.result() for t, (fut, _c) in lookups.items()}
+
+        ipv4 = entries["A"].records if "A" in entries else []
+        ipv6 = entries["AAAA"].records if "AAAA" in entries else []
+        cnames: List[str] = []
+        for e in entries.values():
+            if len(e.cnames) > len(cnames):
+                cnames = e.cnames
+
+        error = None
+        if not ipv4 and not ipv6:
+            errors = [e.error for e in entries.values() if e.error]
+            # nxdomain важнее таймаута по соседнему типу записи
+            error = "nxdomain" if "nxdomain" in errors else (errors[0] if errors else "no_address")
+
+        return {
+            "domain": domain,
+            "ipv4": ipv4,
+            "ipv6": ipv6,
+            "ips": ipv4 + ipv6,
+            "cname": cnames,
+            "error": error,
+            "cached": all(c for _f, c in lookups.values()),
+        }
+
+    @classmethod
+    def stats(cls) -> Dict[str, Any]:
+        with cls._lock:
+            return {**cls._stats, "entries": len(cls._cache), "inflight": len(cls._inflight),
+                    "nameservers": list(cls._resolver.nameservers) if cls._resolver else None}
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._cache.clear()
@@ -0,0 +1,31 @@
+from __future__ import annotations
+import fcntl, os
+from contextlib import contextmanager
+from config.loader import ConfigStore
+
+
+def _locks_dir() -> str:
+    path = os.path.join(ConfigStore.get().paths.data_dir, "locks")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextmanager
+def file_lock(name: str, blocking: bool = True):
+    """
+    Межпроцессная блокировка `<data_dir>/locks/<name>` (gunicorn запускает несколько воркеров).
+    yield True, если блокировка получена; с blocking=False - False, если её держит кто-то другой.
+    """
+    fh = open(os.path.join(_locks_dir(), name), "a")
+    try:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+    finally:
+        fh.close()
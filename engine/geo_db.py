@@ -0,0 +1,320 @@
+from __future__ import annotations
+import csv, gzip, heapq, io, ipaddress, json, mmap, os, struct, sys, threading
+from array import array
+from bisect import bisect_right
+from typing import Any, Dict, Iterable, List, Tuple
+import requests
+from config.loader import ConfigStore
+from logging_.engine_logger import get_engine_logger
+
+log = get_engine_logger()
+
+# Формат файла (все числа little-endian):
+#   header  "<8sIII": magic, n4, n6, длина JSON-таблицы записей
+#   v4      starts[n4] u32, ends[n4] u32, rec[n4] u32
+#   v6      starts[n6] 16 байт big-endian, ends[n6] 16 байт, rec[n6] u32
+#   records JSON [[country_code, country_name, city, asn, as_org], ...]
+# Диапазоны внутри версии отсортированы по start и не пересекаются.
+_MAGIC = b"IPGEODB1"
+_HEADER = struct.Struct("<8sIII")
+_COLUMNS = ("start", "end", "country_code", "country_name", "city", "asn", "as_org")
+# синонимы заголовков распространённых выгрузок (DB-IP, IP2Location, MaxMind-lite)
+_HEADER_ALIASES = {
+    "ip_start": "start", "start_ip": "start", "ip_from": "start", "first": "start",
+    "ip_end": "end", "end_ip": "end", "ip_to": "end", "last": "end",
+    "network": "start", "cidr": "start",
+    "country": "country_code", "country_iso_code": "country_code", "cc": "country_code",
+    "city_name": "city",
+    "as_number": "asn", "autonomous_system_number": "asn",
+    "as_name": "as_org", "as_organization": "as_org", "autonomous_system_organization": "as_org", "org": "as_org",
+}
+
+
+def _db_path() -> str:
+    path = ConfigStore.get().geo_db.path
+    if path:
+        return path
+    return os.path.join(ConfigStore.get().paths.data_dir, "catalog", "ip_geo.bin")
+
+
+class _U128Seq:
+    """Последовательность 128-битных чисел поверх mmap (для bisect по IPv6)."""
+
+    def __init__(self, mv: memoryview, n: int):
+        self._mv, self._n = mv, n
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i: int) -> int:
+        return int.from_bytes(self._mv[16 * i:16 * i + 16], "big")
+
+
+def _parse_range(start: str, end: str | None) -> Tuple[int, int, int]:
+    """(version, start, end) из "a.b.c.d", "a.b.c.d/nn" или десятичного числа."""
+    start = start.strip()
+    if "/" in start:
+        net = ipaddress.ip_network(start, strict=False)
+        return net.version, int(net.network_address), int(net.broadcast_address)
+    if start.isdigit():
+        lo, hi = int(start), int((end or start).strip())
+        return (4 if hi < 2 ** 32 else 6), lo, hi
+    a = ipaddress.ip_address(start)
+    b = ipaddress.ip_address((end or start).strip())
+    return a.version, int(a), int(b)
+
+
+def _iter_rows(fh: io.TextIOBase) -> Iterable[Dict[str, str]]:
+    reader = csv.reader(fh)
+    first = next(reader, None)
+    if first is None:
+        return
+    names = [_HEADER_ALIASES.get(c.strip().lower(), c.strip().lower()) for c in first]
+    if "start" in names:
+        columns = names
+    else:
+        columns = list(_COLUMNS)
+        yield dict(zip(columns, first))
+    for row in reader:
+        if row and not row[0].startswith("#"):
+            yield dict(zip(columns, row))
+
+
+def _flatten(sec) -> Tuple[tuple, int]:
+    """
+    Делает диапазоны секции непересекающимися (вход отсортирован по start).
+    Там, где диапазоны накладываются (вложенные подсети, слитые выгрузки),
+    побеждает самый узкий, более широкий режется на части. Соседние куски
+    с одной записью склеиваются. Возвращает (секция, число наложившихся диапазонов).
+    """
+    starts, ends, recs = sec
+    overlaps = 0
+    reach = -1
+    for lo, hi in zip(starts, ends):
+        if lo <= reach:
+            overlaps += 1
+        reach = max(reach, hi)
+    if not overlaps:
+        return sec, 0
+
+    out = (type(starts)(starts.typecode) if isinstance(starts, array) else [],
+           type(ends)(ends.typecode) if isinstance(ends, array) else [],
+           array("I"))
+    active: List[Tuple[int, int]] = []  # heap (длина, индекс) покрывающих pos диапазонов
+    n, i, pos = len(starts), 0, 0
+    while i < n or active:
+        if not active:
+            pos = max(pos, starts[i])
+        while i < n and starts[i] <= pos:
+            heapq.heappush(active, (ends[i] - starts[i], i))
+            i += 1
+        while active and ends[active[0][1]] < pos:
+            heapq.heappop(active)
+        if not active:
+            continue
+        best = active[0][1]
+        seg_end = min(ends[best], starts[i] - 1) if i < n else ends[best]
+        if out[0] and out[1][-1] + 1 == pos and out[2][-1] == recs[best]:
+            out[1][-1] = seg_end
+        else:
+            out[0].append(pos)
+            out[1].append(seg_end)
+            out[2].append(recs[best])
+        pos = seg_end + 1
+    return out, overlaps
+
+
+def build(csv_source: str, out_path: str | None = None) -> Dict[str, int]:
+    """
+    Собирает бинарную базу из CSV (файл или .gz). Колонки: start, end, country_code,
+    country_name, city, asn, as_org - по заголовку или по порядку; start может быть CIDR.
+    Пересекающиеся диапазоны режутся так, что побеждает самый узкий (см. _flatten).
+    Запись атомарная: tmp + os.replace, читатели подхватят файл по mtime.
+    """
+    out_path = out_path or _db_path()
+    records: List[list] = []
+    rec_ids: Dict[tuple, int] = {}
+    v4 = (array("I"), array("I"), array("I"))
+    v6: Tuple[List[int], List[int], array] = ([], [], array("I"))
+    skipped = 0
+
+    opener = gzip.open if csv_source.endswith(".gz") else open
+    with opener(csv_source, "rt", encoding="utf-8", newline="") as fh:
+        for row in _iter_rows(fh):
+            try:
+                version, lo, hi = _parse_range(row.get("start") or "", row.get("end") or None)
+            except ValueError:
+                skipped += 1
+                continue
+            asn = (row.get("asn") or "").strip().upper().removeprefix("AS") or None
+            cc = (row.get("country_code") or "").strip().upper() or None
+            rec = (cc, (row.get("country_name") or "").strip() or cc, (row.get("city") or "").strip() or None,
+                   asn, (row.get("as_org") or "").strip() or None)
+            rid = rec_ids.get(rec)
+            if rid is None:
+                rid = rec_ids[rec] = len(records)
+                records.append(list(rec))
+            target = v4 if version == 4 else v6
+            target[0].append(lo)
+            target[1].append(hi)
+            target[2].append(rid)
+
+    def sort_section(sec):
+        starts = sec[0]
+        if all(starts[i] <= starts[i + 1] for i in range(len(starts) - 1)):
+            return sec
+        order = sorted(range(len(starts)), key=starts.__getitem__)
+        return tuple(type(col)(col.typecode, (col[i] for i in order)) if isinstance(col, array)
+                     else [col[i] for i in order] for col in sec)
+
+    v4, overlaps4 = _flatten(sort_section(v4))
+    v6, overlaps6 = _flatten(sort_section(v6))
+    if overlaps4 or overlaps6:
+        log.warning(f"[geo-db] {csv_source}: {overlaps4 + overlaps6} overlapping ranges split, "
+                    f"the most specific range wins.")
+    blob = json.dumps(records, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(v4[0]), len(v6[0]), len(blob)))
+        for col in v4:
+            if sys.byteorder != "little":
+                col = array("I", col)
+                col.byteswap()
+            f.write(col.tobytes())
+        for col in v6[:2]:
+            f.write(b"".join(x.to_bytes(16, "big") for x in col))
+        rec6 = v6[2]
+        if sys.byteorder != "little":
+            rec6 = array("I", rec6)
+            rec6.byteswap()
+        f.write(rec6.tobytes())
+        f.write(blob)
+    os.replace(tmp, out_path)
+    stats = {"v4_ranges": len(v4[0]), "v6_ranges": len(v6[0]), "records": len(records), "skipped": skipped,
+             "overlaps": overlaps4 + overlaps6}
+    log.info(f"[geo-db] Built {out_path}: {stats}")
+    return stats
+
+
+class GeoDb:
+    """
+    Локальная база IP-диапазонов -> страна/город/ASN. Файл отображается в память
+    (mmap), поиск - bisect по отсортированным началам диапазонов; сеть не нужна.
+    Перечитывается при изменении mtime (refresh из любого воркера).
+    """
+    _mm: mmap.mmap | None = None
+    _mtime = 0.0
+    _v4: Tuple[Any, Any, Any] | None = None
+    _v6: Tuple[Any, Any, Any] | None = None
+    _records: List[list] = []
+    _lock = threading.Lock()
+    _missing_logged = False
+
+    @classmethod
+    def _ensure_loaded(cls) -> bool:
+        path = _db_path()
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            if not cls._missing_logged:
+                log.info(f"[geo-db] {path} not found, local geolocation disabled.")
+                cls._missing_logged = True
+            return False
+        if cls._mm is not None and mtime == cls._mtime:
+            return True
+        with cls._lock:
+            if cls._mm is not None and mtime == cls._mtime:
+                return True
+            try:
+                cls._open(path)
+                cls._mtime = mtime
+            except Exception as e:
+                log.error(f"[geo-db] Failed to open {path}: {e}")
+                return cls._mm is not None
+        return True
+
+    @classmethod
+    def _open(cls, path: str):
+        if sys.byteorder != "little":
+            raise RuntimeError("geo db reader supports little-endian hosts only")
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n4, n6, blob_len = _HEADER.unpack_from(mm, 0)
+        if magic != _MAGIC:
+            mm.close()
+            raise ValueError("bad magic")
+        mv = memoryview(mm)
+        off = _HEADER.size
+        v4 = []
+        for _ in range(3):
+            v4.append(mv[off:off + 4 * n4].cast("I"))
+            off += 4 * n4
+        v6 = []
+        for _ in range(2):
+            v6.append(_U128Seq(mv[off:off + 16 * n6], n6))
+            off += 16 * n6
+        v6.append(mv[off:off + 4 * n6].cast("I"))
+        off += 4 * n6
+        records = json.loads(bytes(mv[off:off + blob_len]).decode("utf-8"))
+        # старый mmap не закрываем: на его memoryview могут смотреть параллельные lookup'ы
+        cls._mm, cls._v4, cls._v6, cls._records = mm, tuple(v4), tuple(v6), records
+        log.info(f"[geo-db] Loaded {path}: {n4} IPv4 / {n6} IPv6 ranges, {len(records)} records.")
+
+    @classmethod
+    def lookup(cls, ip: str) -> Dict[str, Any] | None:
+        """{country_code, country_name, city, asn, as_org} или None (нет базы / IP вне диапазонов)."""
+        if not cls._ensure_loaded():
+            return None
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        starts, ends, recs = cls._v4 if addr.version == 4 else cls._v6
+        num = int(addr)
+        i = bisect_right(starts, num) - 1
+        if i < 0 or ends[i] < num:
+            return None
+        cc, name, city, asn, org = cls._records[recs[i]]
+        return {"country_code": cc, "country_name": name, "city": city, "asn": asn, "as_org": org}
+
+    @classmethod
+    def info(cls) -> Dict[str, Any]:
+        loaded = cls._ensure_loaded()
+        return {
+            "path": _db_path(),
+            "loaded": loaded,
+            "v4_ranges": len(cls._v4[0]) if loaded else 0,
+            "v6_ranges": len(cls._v6[0]) if loaded else 0,
+            "records": len(cls._records) if loaded else 0,
+        }
+
+    @classmethod
+    def refresh(cls) -> Dict[str, int]:
+        """Пересобирает базу из geo_db.csv_url (скачивание) или geo_db.csv_path."""
+        gc = ConfigStore.get().geo_db
+        if gc.csv_url:
+            suffix = ".csv.gz" if gc.csv_url.split("?")[0].endswith(".gz") else ".csv"
+            dl = _db_path() + ".download" + suffix
+            log.info(f"[geo-db] Downloading {gc.csv_url} ...")
+            with requests.get(gc.csv_url, stream=True, timeout=60) as r:
+                r.raise_for_status()
+                with open(dl, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=1 << 20):
+                        f.write(chunk)
+            try:
+                return build(dl)
+            finally:
+                os.remove(dl)
+        if gc.csv_path:
+            return build(gc.csv_path)
+        raise ValueError("geo_db.csv_url / geo_db.csv_path is not configured")
+
+
+if __name__ == "__main__":
+    # python -m engine.geo_db <file.csv[.gz]> [out.bin]
+    if len(sys.argv) < 2:
+        print("usage: python -m engine.geo_db <file.csv[.gz]> [out.bin]", file=sys.stderr)
+        sys.exit(2)
+    print(build(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None))
@@ -0,0 +1,313 @@
+from __future__ import annotations
+import json, os, threading, time, uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+from config.loader import ConfigStore
+from logging_.engine_logger import get_engine_logger
+from .filelock import file_lock
+from .orchestrator import start_multi_geo_run
+from .url_utils import parse_multi_geo_lines
+
+log = get_engine_logger()
+
+# поля строки результата, изменение которых считается "изменением состояния"
+_WATCH_FIELDS = ("result", "final_url", "geo_mismatch")
+
+
+def _monitor_dir() -> str:
+    path = os.path.join(ConfigStore.get().paths.data_dir, "monitor")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _watchlists_path() -> str:
+    return os.path.join(_monitor_dir(), "watchlists.json")
+
+
+def _state_path(wl_id: str) -> str:
+    return os.path.join(_monitor_dir(), f"{wl_id}.state.json")
+
+
+_CHANGES_SUFFIX = ".changes.ndjson"
+
+
+def _changes_path(wl_id: str) -> str:
+    return os.path.join(_monitor_dir(), f"{wl_id}{_CHANGES_SUFFIX}")
+
+
+def _write_json_atomic(path: str, data: Any):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _task_key(url: str, country: str | None) -> str:
+    return f"{url} {country or '-'}"
+
+
+class WatchlistStore:
+    """
+    Watchlist'ы мониторинга в `<data_dir>/monitor/watchlists.json`.
+    Все изменения идут через read-modify-write под файловой блокировкой.
+    """
+
+    @classmethod
+    def _read(cls) -> List[dict]:
+        try:
+            with open(_watchlists_path(), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            log.error(f"Failed to read watchlists: {e}")
+            return []
+
+    @classmethod
+    def _update(cls, fn: Callable[[List[dict]], Any]) -> Any:
+        with file_lock("monitor_watchlists.lock"):
+            items = cls._read()
+            result = fn(items)
+            _write_json_atomic(_watchlists_path(), items)
+            return result
+
+    @classmethod
+    def list(cls) -> List[dict]:
+        return cls._read()
+
+    @classmethod
+    def get(cls, wl_id: str) -> dict | None:
+        return next((w for w in cls._read() if w["id"] == wl_id), None)
+
+    @classmethod
+    def create(cls, name: str, targets: List[str], interval_sec: int,
+               settings: Dict[str, Any] | None = None) -> dict:
+        """
+        targets: строки `url cc` (как в Multi-Geo).
+        Ошибочные строки отбрасываются, пустой список -> ValueError.
+        """
+        tasks = [t for t in parse_multi_geo_lines(targets) if "parsing_error" not in t]
+        if not tasks:
+            raise ValueError("Watchlist has no valid 'url cc' targets")
+
+        min_interval = ConfigStore.get().monitor.min_interval_sec
+        wl = {
+            "id": uuid.uuid4().hex[:12],
+            "name": name or "watchlist",
+            "tasks": tasks,
+            "interval_sec": max(int(interval_sec), min_interval),
+            "settings": settings or {},
+            "enabled": True,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "last_run_at": None,
+            "next_run_at": time.time(),
+        }
+        cls._update(lambda items: items.append(wl))
+        log.info(f"[monitor] Watchlist {wl['id']} created: {len(tasks)} targets, every {wl['interval_sec']}s.")
+        return wl
+
+    @classmethod
+    def delete(cls, wl_id: str) -> bool:
+        def _del(items):
+            before = len(items)
+            items[:] = [w for w in items if w["id"] != wl_id]
+            return len(items) != before
+        return cls._update(_del)
+
+    @classmethod
+    def patch(cls, wl_id: str, **fields) -> dict | None:
+        def _patch(items):
+            for w in items:
+                if w["id"] == wl_id:
+                    w.update(fields)
+                    return w
+            return None
+        return cls._update(_patch)
+
+
+def _snapshot(row: dict) -> dict:
+    return {f: row.get(f) for f in _WATCH_FIELDS}
+
+
+def _diff(prev: dict, cur: dict) -> Dict[str, list]:
+    # поле, которого не было в прошлом снимке (добавлено позже), изменением не считаем
+    return {f: [prev.get(f), cur.get(f)] for f in _WATCH_FIELDS if f in prev and prev.get(f) != cur.get(f)}
+
+
+def run_cycle(wl: dict) -> List[dict]:
+    """
+    Один цикл watchlist'а: прогоняет все (url, country) через оркестратор,
+    сравнивает с предыдущим циклом и дописывает в changes-лог только изменения.
+    Первый цикл задаёт базовую линию и изменений не порождает.
+    """
+    wl_id = wl["id"]
+    try:
+        with open(_state_path(wl_id), "r", encoding="utf-8") as f:
+            prev_state: Dict[str, dict] = json.load(f)
+    except FileNotFoundError:
+        prev_state = {}
+
+    cur_state: Dict[str, dict] = {}
+
+    def on_row(row: dict):
+        cur_state[_task_key(row.get("url"), row.get("country"))] = _snapshot(row)
+
+    cfg = ConfigStore.get()
+    settings = wl.get("settings") or {}
+    run_params = {
+        "tasks": wl["tasks"],
+        "proxy_type": settings.get("proxy_type") or cfg.proxy.type,
+        "dns_mode": settings.get("dns_mode") or cfg.proxy.dns_mode,
+        "connection_type": settings.get("connection_type") or "wifi",
+        "proxy_host": settings.get("proxy_host"),
+        "proxy_port": settings.get("proxy_port"),
+        "timeout_sec": int(settings.get("timeout_sec") or cfg.execution.timeout_sec),
+        "make_screenshot": False,
+        "debug_mode": False,
+        "multi_geo": True,
+        "run_kind": "monitor",
+        "persist": False,  # храним только изменения, без архива строк/истории/.md
+        "monitor_id": wl_id,
+    }
+
+    log.info(f"[monitor] Cycle started for watchlist {wl_id} ({len(wl['tasks'])} targets).")
+    run_id = start_multi_geo_run(run_params, on_row=on_row, background=False)
+
+    changes = []
+    ts = datetime.now().isoformat(timespec="seconds")
+    for key, cur in cur_state.items():
+        prev = prev_state.get(key)
+        if prev is None:
+            continue
+        diff = _diff(prev, cur)
+        if diff:
+            url, _, country = key.rpartition(" ")
+            changes.append({
+                "ts": ts, "watchlist_id": wl_id, "watchlist": wl.get("name"),
+                "run_id": run_id, "url": url, "country": country, "changes": diff,
+            })
+
+    # цели, которые в этом цикле не отработали, сохраняют прошлое состояние
+    _write_json_atomic(_state_path(wl_id), {**prev_state, **cur_state})
+
+    if changes:
+        with open(_changes_path(wl_id), "a", encoding="utf-8") as f:
+            for ch in changes:
+                f.write(json.dumps(ch, ensure_ascii=False) + "\n")
+        log.info(f"[monitor] Watchlist {wl_id}: {len(changes)} state change(s) in run {run_id}.")
+    else:
+        log.info(f"[monitor] Watchlist {wl_id}: no changes in run {run_id}.")
+
+    return changes
+
+
+def get_changes(wl_id: str | None = None, limit: int = 200, since: str | None = None) -> List[dict]:
+    """
+    Последние изменения (новые в конце) по одному или всем watchlist'ам.
+    since - ISO-время: только изменения позже него (для опроса из любого воркера).
+    """
+    ids = [wl_id] if wl_id else [w["id"] for w in WatchlistStore.list()]
+    out: List[dict] = []
+    for i in ids:
+        try:
+            with open(_changes_path(i), "r", encoding="utf-8") as f:
+                out.extend(json.loads(line) for line in f if line.strip())
+        except FileNotFoundError:
+            continue
+    if since:
+        out = [c for c in out if c["ts"] > since]
+    out.sort(key=lambda c: c["ts"])
+    return out[-limit:]
+
+
+def changes_offsets() -> Dict[str, int]:
+    """Текущие размеры changes-логов всех watchlist'ов: точка, с которой tail_changes() отдаёт новое."""
+    out = {}
+    for name in os.listdir(_monitor_dir()):
+        if name.endswith(_CHANGES_SUFFIX):
+            out[name] = os.path.getsize(os.path.join(_monitor_dir(), name))
+    return out
+
+
+def tail_changes(offsets: Dict[str, int]) -> List[dict]:
+    """
+    Изменения, дописанные в changes-логи после `offsets` (обновляется на месте).
+    Логи общие для всех воркеров, поэтому подписчик видит изменения, кто бы ни гонял цикл.
+    Лог нового watchlist'а читается с начала, недописанная последняя строка - в следующий раз.
+    """
+    out: List[dict] = []
+    for name in os.listdir(_monitor_dir()):
+        if not name.endswith(_CHANGES_SUFFIX):
+            continue
+        path = os.path.join(_monitor_dir(), name)
+        pos = offsets.get(name, 0)
+        try:
+            if os.path.getsize(path) < pos:
+                pos = 0  # лог пересоздан
+            with open(path, "rb") as f:
+                f.seek(pos)
+                chunk = f.read()
+        except FileNotFoundError:
+            offsets.pop(name, None)
+            continue
+        complete = chunk[:chunk.rfind(b"\n") + 1]
+        offsets[name] = pos + len(complete)
+        for line in complete.splitlines():
+            if line.strip():
+                try:
+                    out.append(json.loads(line))
+                except ValueError as e:
+                    log.warning(f"[monitor] Bad line in {name} skipped: {e}")
+    out.sort(key=lambda c: c["ts"])
+    return out
+
+
+class MonitorScheduler:
+    """
+    Встроенный планировщик. В каждом gunicorn-воркере стартует поток,
+    но циклы гоняет только тот, кто держит `scheduler.lock`, остальные
+    периодически пробуют перехватить блокировку (если владелец умер).
+    Циклы выполняются последовательно, чтобы не умножать нагрузку на прокси.
+    """
+    _started = False
+    _lock = threading.Lock()
+
+    @classmethod
+    def start(cls):
+        with cls._lock:
+            if cls._started:
+                return
+            cls._started = True
+        threading.Thread(target=cls._loop, daemon=True).start()
+
+    @classmethod
+    def _loop(cls):
+        while True:
+            try:
+                with file_lock("monitor_scheduler.lock", blocking=False) as acquired:
+                    if acquired:
+                        log.info("[monitor] Scheduler lock acquired, this worker runs watchlists.")
+                        cls._run_forever()
+            except Exception as e:
+                log.error(f"[monitor] Scheduler crashed: {e}", exc_info=True)
+            time.sleep(60)
+
+    @classmethod
+    def _run_forever(cls):
+        while True:
+            tick = ConfigStore.get().monitor.tick_sec
+            now = time.time()
+            for wl in WatchlistStore.list():
+                if not wl.get("enabled", True) or (wl.get("next_run_at") or 0) > now:
+                    continue
+                started = time.time()
+                try:
+                    run_cycle(wl)
+                except Exception as e:
+                    log.error(f"[monitor] Cycle failed for watchlist {wl['id']}: {e}", exc_info=True)
+                WatchlistStore.patch(
+                    wl["id"],
+                    last_run_at=datetime.now().isoformat(timespec="seconds"),
+                    next_run_at=started + wl["interval_sec"],
+                )
+            time.sleep(tick)
@@ -1,19 +1,36 @@
 from __future__ import annotations
-import json, queue, threading, uuid, os, time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import json, queue, threading, uuid, os, time, hashlib
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, Callable, Iterable, Iterator
 from config.loader import ConfigStore
 from logging_.engine_logger import get_engine_logger
 from .worker import execute_check
-from .dns_checker import check_domain_dns_whois
+from .dns_checker import IpEnricher, resolve_domain, join_domain
+from .rdap_cache import RdapCache
+from .whois_store import WhoisStore
+from .run_registry import RunRegistry
+from logging_.history_db import HistoryStore
+from .url_utils import normalize_url_complex
 
 _engine_logger = get_engine_logger()
 
-_runs_state: Dict[str, Dict[str, Any]] = {}
 _sse_queues: Dict[str, "queue.Queue[str]"] = {}
+_row_listeners: Dict[str, Callable[[dict], None]] = {}
 _lock = threading.Lock()
 
+# сколько задач держим "в полёте" на один воркер пула
+_SUBMIT_WINDOW_PER_WORKER = 2
+
+# результаты, после которых прокси не пропустит ни одну проверку запуска
+_FATAL_PROXY_RESULTS = {
+    "proxy_auth_error": "Proxy authentication failed (407): check SOAX_PORT_LOGIN / SOAX_SESSION_PASSWORD",
+    "proxy_quota_exceeded": "Proxy traffic quota exhausted",
+}
+# run_id -> {"stop": Event, "fatal": int, "reason": str | None}
+_run_guards: Dict[str, dict] = {}
+
 
 def _sse_emit(run_id: str, payload: dict):
     msg = json.dumps(payload, ensure_ascii=False)
@@ -46,9 +63,183 @@ def sse_unsubscribe(run_id: str):
         _sse_queues.pop(run_id, None)
 
 
-def get_run_state(run_id: str):
+def get_run_state(run_id: str) -> dict | None:
+    """Статус и счётчики запуска (из памяти или из архива). None, если запуск неизвестен."""
+    return RunRegistry.get(run_id)
+
+
+def _iter_bounded(pool: ThreadPoolExecutor, fn: Callable, items: Iterable,
+                  window: int, stop: threading.Event | None = None) -> Iterator[Future]:
+    """
+    Отдаёт завершённые Future по мере готовности, держа в пуле не больше
+    `window` задач одновременно. Вход читается лениво, поэтому память и время
+    до первого результата не зависят от длины списка.
+    Если выставлен `stop`, новые задачи не подаются, ещё не начатые отменяются,
+    а уже выполняющиеся дожидаемся.
+    """
+    it = iter(items)
+    pending: set[Future] = set()
+    exhausted = False
+    while True:
+        if stop is not None and stop.is_set():
+            exhausted = True
+            pending = {f for f in pending if not f.cancel()}
+
+        while not exhausted and len(pending) < window:
+            try:
+                item = next(it)
+            except StopIteration:
+                exhausted = True
+                break
+            pending.add(pool.submit(fn, item))
+
+        if not pending:
+            return
+
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        yield from done
+
+
+def _submit_window(cfg) -> int:
+    return max(cfg.execution.max_concurrency * _SUBMIT_WINDOW_PER_WORKER, 1)
+
+
+def _redirect_target(res: dict) -> str | None:
+    """Куда в итоге увела цепочка редиректов (None, если редиректов не было)."""
+    redirects = res.get("redirects") or []
+    if not redirects:
+        return None
+    _code, frm, to = redirects[-1]
+    return urllib.parse.urljoin(frm, to) if to else frm
+
+
+def _record_check_row(run_id: str, kind: str, row: dict, history: bool = True):
+    """Сохраняет строку результата проверки в реестр запуска и (history=True) в SQLite-историю."""
+    RunRegistry.append_row(run_id, row, row.get("result") == "success")
+    if history:
+        HistoryStore.record_row(run_id, kind, row)
+
+    listener = _row_listeners.get(run_id)
+    if listener:
+        try:
+            listener(row)
+        except Exception as e:
+            _engine_logger.error(f"[{run_id}] Row listener failed: {e}", exc_info=True)
+
+    _watch_fatal(run_id, row)
+
+
+def _stop_event(run_id: str) -> threading.Event | None:
+    guard = _run_guards.get(run_id)
+    return guard["stop"] if guard else None
+
+
+def _watch_fatal(run_id: str, row: dict):
+    """
+    Считает фатальные ответы прокси (407, кончился трафик). После
+    `execution.fatal_proxy_error_limit` таких строк останавливает подачу задач.
+    """
+    reason = _FATAL_PROXY_RESULTS.get(row.get("result"))
+    guard = _run_guards.get(run_id)
+    if reason is None or guard is None:
+        return
+    limit = ConfigStore.get().execution.fatal_proxy_error_limit
+    if limit <= 0:
+        return
+    guard["fatal"] += 1
+    if guard["fatal"] >= limit and not guard["stop"].is_set():
+        guard["reason"] = reason
+        guard["stop"].set()
+        _engine_logger.error(f"[{run_id}] Aborting run after {guard['fatal']} fatal proxy error(s): {reason}")
+
+
+def _finish_run(run_id: str, **extra) -> dict:
+    """
+    Завершает запуск: run_finished, либо run_failed с причиной, если он был
+    остановлен из-за фатальной ошибки прокси. Закрывает SSE.
+    """
+    guard = _run_guards.get(run_id)
+    reason = guard["reason"] if guard else None
+    if reason:
+        st = RunRegistry.finish(run_id, status="failed", reason=reason)
+        event_type = "run_failed"
+    else:
+        st = RunRegistry.finish(run_id)
+        event_type = "run_finished"
+
+    payload = {
+        "type": event_type,
+        "run_id": run_id,
+        "totals": {
+            **st["totals"],
+            "time_ms": int((st["finished_at"] - st["started_at"]) * 1000)
+        },
+        **extra
+    }
+    if reason:
+        payload["reason"] = reason
+    _sse_emit(run_id, payload)
+    _engine_logger.info(f"[{run_id}] '{event_type}' emitted. Unsubscribing SSE.")
+    _close_sse(run_id)
+    return st
+
+
+def _launch(target: Callable, args: tuple, run_id: str,
+            on_row: Callable[[dict], None] | None, background: bool):
+    """
+    Запускает тело запуска в фоновом потоке (веб) или прямо в текущем (CLI).
+    on_row вызывается для каждой готовой строки из потока запуска.
+    """
+    if on_row:
+        with _lock:
+            _row_listeners[run_id] = on_row
+    _run_guards[run_id] = {"stop": threading.Event(), "fatal": 0, "reason": None}
+
+    def body():
+        try:
+            target(*args)
+        finally:
+            with _lock:
+                _row_listeners.pop(run_id, None)
+            _run_guards.pop(run_id, None)
+
+    if not background:
+        body()
+        return
+
+    _engine_logger.info(f"[{run_id}] Spawning background thread...")
+    thread = threading.Thread(
+        target=body,
+        daemon=True  # Поток умрет, если gunicorn (parent поток) умрет
+    )
+    thread.start()
+
+
+def _close_sse(run_id: str):
+    """Сигналит обработчику SSE, что пора закрываться, и отписывает очередь."""
     with _lock:
-        return _runs_state.get(run_id, {"total": 0, "done": 0})
+        q = _sse_queues.get(run_id)
+    if q:
+        try:
+            q.put(None, block=False)  # отправляем None как сигнал
+        except queue.Full:
+            _engine_logger.warning(f"SSE queue full when trying to send None sentinel for run_id {run_id}")
+
+    # отписываемся от SSE, чтобы позволить Response() завершиться
+    sse_unsubscribe(run_id)
+
+
+def _resolve_sticky(run_params: dict[str, Any], n_checks: int | None) -> bool:
+    """
+    Sticky для всего запуска: "on" - всегда, "off" - никогда,
+    "auto" - если проверок больше одной (n_checks=None - заранее неизвестно, bulk).
+    """
+    policy = run_params.get("sticky_policy") or ConfigStore.get().proxy.sticky_policy
+    if policy == "on":
+        return True
+    if policy == "auto":
+        return n_checks is None or n_checks > 1
+    return False
 
 
 def _run_checks_async(run_params: dict[str, Any], run_id: str):
@@ -62,14 +253,10 @@ def _run_checks_async(run_params: dict[str, Any], run_id: str):
     cfg = ConfigStore.get()
     urls = run_params.get("urls", [])
 
-    # Определяем sticky для всего запуска
-    sticky_policy = run_params.get("sticky_policy", "auto")
-    sticky = (sticky_policy == "on") or (sticky_policy == "auto" and len(urls) > 1)
-
     # Добавляем run_id и sticky в params для воркера
     task_params = run_params.copy()
     task_params["run_id"] = run_id
-    task_params["sticky"] = sticky
+    task_params["sticky"] = _resolve_sticky(run_params, len(urls))
 
     def worker_task(u: str):
         # log: задача взята в пул.
@@ -119,8 +306,11 @@ def _run_checks_async(run_params: dict[str, Any], run_id: str):
             "http_code": res.get("http_code"),
             "ttfb_ms": res.get("timings", {}).get("ttfb_ms"),
             "ext_ip": res.get("proxy_ext_ip") or "-",
+            "ext_country": res.get("proxy_ext_country"),
+            "geo_mismatch": res.get("geo_mismatch", False),
             "md_name": os.path.basename(res["md_path"]),
             "png_name": png_relative_path if png_relative_path else "",
+            "final_url": _redirect_target(res),
             "notes": res.get("notes")  # Передаем 'notes' в UI
         }
         _sse_emit(run_id, {"type": "check_finished", "run_id": run_id, **row})
@@ -130,20 +320,15 @@ def _run_checks_async(run_params: dict[str, Any], run_id: str):
     with ThreadPoolExecutor(max_workers=cfg.execution.max_concurrency) as pool:
         _engine_logger.debug(
             f"[{run_id}] Submitting {len(urls)} tasks to ThreadPoolExecutor (max_workers={cfg.execution.max_concurrency}).")
-        futs = [pool.submit(worker_task, u) for u in urls]
-        for fut in as_completed(futs):
+        for fut in _iter_bounded(pool, worker_task, urls, _submit_window(cfg), _stop_event(run_id)):
             try:
                 row = fut.result()
-                with _lock:
-                    st = _runs_state[run_id]
-                    st["rows"].append(row)
-                    st["done"] += 1
+                _record_check_row(run_id, "std", row)
             except Exception as e:
                 _engine_logger.error(f"[{run_id}] Future failed: {e}", exc_info=True)
 
     # завершение запуска
     _engine_logger.info(f"[{run_id}] All tasks finished.")
-    st = _runs_state[run_id]
 
     # try:
         # summary_path = write_run_summary(cfg.paths.logs_dir, st["rows"])
@@ -153,31 +338,15 @@ def _run_checks_async(run_params: dict[str, Any], run_id: str):
     #     summary_name = "error.md"
     summary_name = None
 
-    _sse_emit(run_id, {"type": "run_finished", "run_id": run_id,
-                       "totals": {"ok": sum(1 for r in st["rows"] if r["result"] == "success"),
-                                  "err": sum(1 for r in st["rows"] if r["result"] != "success"),
-                                  "time_ms": int((time.time() - st["started_at"]) * 1000)},
-                       "summary": summary_name})
+    _finish_run(run_id, summary=summary_name)
 
-    _engine_logger.info(f"[{run_id}] 'run_finished' emitted. Unsubscribing SSE.")
 
-    # сигналим обработчику SSE, что пора закрываться
-    with _lock:
-        q = _sse_queues.get(run_id)
-    if q:
-        try:
-            q.put(None, block=False)  # отправляем None как сигнал
-        except queue.Full:
-            _engine_logger.warning(f"SSE queue full when trying to send None sentinel for run_id {run_id}")
-
-    # отписываемся от SSE, чтобы позволить Response() завершиться
-    sse_unsubscribe(run_id)
-
-
-def start_run(run_params: dict[str, Any]) -> str:
+def start_run(run_params: dict[str, Any], on_row: Callable[[dict], None] | None = None,
+              background: bool = True) -> str:
     """
     Вызывается из /run (HTTP).
     Должен вернуться НЕМЕДЛЕННО.
+    С background=False (CLI) выполняется синхронно и без SSE.
     """
     run_id = uuid.uuid4().hex[:12]
     total = len(run_params.get("urls", []))
@@ -187,118 +356,143 @@ def start_run(run_params: dict[str, Any]) -> str:
 
     _engine_logger.info(f"[{run_id}] Creating run state (Total: {total} URLs).")
 
-    state = {
-        "run_id": run_id,
-        "total": total,
-        "done": 0,
-        "rows": [],
-        "started_at": time.time(),
-    }
-    with _lock:
-        _runs_state[run_id] = state
-
     # Удаляем 'urls' из настроек, которые пойдут в SSE
     settings_for_sse = {k: v for k, v in run_params.items() if k != 'urls'}
 
+    RunRegistry.create(run_id, "std", total, meta=settings_for_sse)
+
     # Создаем очередь SSE _до_ запуска потока
-    sse_subscribe(run_id)
+    if background:
+        sse_subscribe(run_id)
 
     _sse_emit(run_id, {"type": "run_started", "run_id": run_id, "ts": datetime.now().isoformat(timespec="seconds"),
                        "settings": settings_for_sse})
 
     # запук в фоновом потоке
-    _engine_logger.info(f"[{run_id}] Spawning background thread...")
-    thread = threading.Thread(
-        target=_run_checks_async,
-        args=(run_params, run_id),
-        daemon=True  # Поток умрет, если gunicorn (parent поток) умрет
-    )
-    thread.start()
+    _launch(_run_checks_async, (run_params, run_id), run_id, on_row, background)
 
     return run_id
 
 
-def dns_worker_task(domain: str, run_id: str):
-    """Worker task for a single DNS/Whois check."""
-    _engine_logger.info(f"[{run_id}] DNS task started for domain: {domain}")
-
-    _sse_emit(run_id, {
-        "type": "dns_check_started",
-        "run_id": run_id,
-        "domain": domain,
-    })
-
-    try:
-        res = check_domain_dns_whois(domain)
-        _engine_logger.debug(f"[{run_id}] check_domain_dns_whois finished for {domain}.")
-
-    except Exception as e:
-        _engine_logger.error(
-            f"[{run_id}] Unhandled exception in dns_worker_task for {domain}: {e}",
-            exc_info=True
-        )
-        res = {  # Создаем 'error' результат
-            'domain': domain,
-            'ips': [],
-            'owner': None,
-            'error': f"Worker failed: {e}"
-        }
-
-    # Отправляем результат через SSE
-    _sse_emit(run_id, {"type": "dns_check_finished", "run_id": run_id, **res})
-    return res
+def _emit_dns_row(run_id: str, row: dict):
+    RunRegistry.append_row(run_id, row, not row.get('error'))
+    _sse_emit(run_id, {"type": "dns_check_finished", "run_id": run_id, **row})
 
 
 def _run_dns_checks_async(domains: list[str], run_id: str):
-    """Runs DNS/Whois checks in background threads."""
+    """
+    DNS run pipeline: resolve -> dedupe IPs -> enrich (geo + RDAP) once per
+    unique IP -> join back to domains. Строка домена уходит в SSE, как только
+    готовы все его IP, поэтому работа растёт с числом разных IP/сетей, а не доменов.
+    """
     _engine_logger.info(f"[{run_id}] DNS Background thread started.")
 
-    cfg = ConfigStore.get()  # Используем тот же max_concurrency
-
-    results = []  # Будем собирать результаты для возможного summary в будущем
-
-    # Пул потоков для DNS проверок
+    cfg = ConfigStore.get()
+    store = WhoisStore(run_id)
+    enricher = IpEnricher(store)
+    waiting: dict[str, list[dict]] = {}   # ip -> resolved-домены, ждущие этот IP
+    left: dict[str, int] = {}             # domain -> сколько его IP ещё не готово
+    stats = {"domains": 0, "ips": 0}
+
+    def finish_domain(resolved: dict):
+        infos = {ip: enricher.known(ip) for ip in resolved['ips']}
+        row = join_domain(resolved, {ip: i for ip, i in infos.items() if i})
+        primary = row['ips'][0] if row['ips'] else None
+        if primary and store.has(primary):
+            store.link(row['domain'], primary)
+            row['whois_url'] = f"/runs/{run_id}/whois/{row['domain']}"
+        _emit_dns_row(run_id, row)
+
+    def resolve_one(domain: str) -> dict:
+        _sse_emit(run_id, {"type": "dns_check_started", "run_id": run_id, "domain": domain})
+        return resolve_domain(domain)
+
+    def unique_ips():
+        """
+        Stage 1 + 2: резолвит домены (не больше _submit_window одновременно, как и
+        остальной конвейер) и отдаёт только новые IP в порядке готовности.
+        """
+        with ThreadPoolExecutor(max_workers=cfg.execution.max_concurrency,
+                                thread_name_prefix="dns-resolve") as resolve_pool:
+            for rfut in _iter_bounded(resolve_pool, resolve_one, domains, _submit_window(cfg)):
+                resolved = rfut.result()
+                stats["domains"] += 1
+                key = f"{stats['domains']}:{resolved['domain']}"
+                pending = [ip for ip in dict.fromkeys(resolved['ips']) if enricher.known(ip) is None]
+                if not pending:
+                    finish_domain(resolved)
+                    continue
+                left[key] = len(pending)
+                resolved['_key'] = key
+                for ip in pending:
+                    first = ip not in waiting
+                    waiting.setdefault(ip, []).append(resolved)
+                    if first:
+                        stats["ips"] += 1
+                        yield ip
+
+    deferred: list[str] = []  # IP, чей RDAP-реестр троттлил в основном проходе
+
+    def ip_done(fut: Future):
+        try:
+            info = fut.result()
+        except Exception as e:
+            _engine_logger.error(f"[{run_id}] DNS enrichment future failed: {e}", exc_info=True)
+            return
+        if info.get('deferred'):
+            deferred.append(info['ip'])
+            return
+        for resolved in waiting.pop(info['ip'], []):
+            key = resolved['_key']
+            left[key] -= 1
+            if left[key] == 0:
+                del left[key]
+                resolved.pop('_key')
+                finish_domain(resolved)
+
+    # Пул потоков для обогащения (whois + geo)
     with ThreadPoolExecutor(max_workers=cfg.execution.max_concurrency) as pool:
         _engine_logger.debug(
-            f"[{run_id}] Submitting {len(domains)} DNS tasks to ThreadPoolExecutor "
-            f"(max_workers={cfg.execution.max_concurrency})."
+            f"[{run_id}] Running DNS pipeline for {len(domains)} domains "
+            f"(enrichment max_workers={cfg.execution.max_concurrency})."
         )
-        # Передаем run_id в каждую задачу
-        futs = [pool.submit(dns_worker_task, d, run_id) for d in domains]
-
-        for fut in as_completed(futs):
-            try:
-                result_row = fut.result()
-                results.append(result_row)
-                # Логируем завершение задачи, если нужно (уже есть в dns_worker_task)
-            except Exception as e:
-                _engine_logger.error(f"[{run_id}] DNS Future failed: {e}", exc_info=True)
-
-    _engine_logger.info(f"[{run_id}] All DNS tasks finished.")
+        for fut in _iter_bounded(pool, enricher.enrich, unique_ips(), _submit_window(cfg)):
+            ip_done(fut)
+
+        # retry-полоса: отложенные из-за 429 IP, с ожиданием backoff'а реестра
+        if deferred:
+            retry, deferred = deferred, []
+            _engine_logger.info(f"[{run_id}] RDAP retry lane: {len(retry)} IPs deferred by registry throttling.")
+            _sse_emit(run_id, {"type": "dns_retry_lane", "run_id": run_id, "ips": len(retry)})
+            for fut in _iter_bounded(pool, lambda ip: enricher.enrich(ip, lane="retry"), retry, _submit_window(cfg)):
+                ip_done(fut)
+
+    # enrich() не бросает, но на всякий случай не теряем домены
+    for ip, group in waiting.items():
+        for resolved in group:
+            if left.pop(resolved.get('_key'), None) is not None:
+                resolved.pop('_key')
+                finish_domain(resolved)
+
+    _engine_logger.info(
+        f"[{run_id}] All DNS tasks finished: {stats['domains']} domains, {stats['ips']} unique IPs enriched."
+    )
+    store.close()
+    RdapCache.flush()
+    st = RunRegistry.finish(run_id)
 
     _sse_emit(run_id, {
         "type": "dns_run_finished",
         "run_id": run_id,
         "totals": {
-            "ok": sum(1 for r in results if not r.get('error')),
-            "err": sum(1 for r in results if r.get('error')),
-            "time_ms": int((time.time() - _runs_state[run_id]["started_at"]) * 1000)  # Используем время старта
+            **st["totals"],
+            "unique_ips": stats["ips"],
+            "time_ms": int((st["finished_at"] - st["started_at"]) * 1000)
         }
     })
 
     _engine_logger.info(f"[{run_id}] 'dns_run_finished' emitted. Unsubscribing SSE.")
-
-    # сигналим обработчику SSE, что пора закрываться
-    with _lock:
-        q = _sse_queues.get(run_id)
-    if q:
-        try:
-            q.put(None, block=False)  # отправляем None как сигнал
-        except queue.Full:
-            _engine_logger.warning(f"SSE queue full when trying to send None sentinel for DNS run_id {run_id}")
-
-    # Отписываемся от SSE
-    sse_unsubscribe(run_id)
+    _close_sse(run_id)
 
 
 def start_dns_run(domains: list[str]) -> str:
@@ -311,16 +505,7 @@ def start_dns_run(domains: list[str]) -> str:
 
     _engine_logger.info(f"[{run_id}] Creating DNS run state (Total: {total} domains).")
 
-    # Сохраняем базовое состояние (время старта нужно для финального события)
-    state = {
-        "run_id": run_id,
-        "total": total,
-        "done": 0,  # Пока не используем done для DNS, но структура та же
-        "rows": [],  # Пока не используем rows для DNS, но структура та же
-        "started_at": time.time(),
-    }
-    with _lock:
-        _runs_state[run_id] = state
+    RunRegistry.create(run_id, "dns", total)
 
     # Создаем очередь SSE _до_ запуска потока
     sse_subscribe(run_id)
@@ -345,29 +530,26 @@ def start_dns_run(domains: list[str]) -> str:
     return run_id
 
 
-def start_multi_geo_run(run_params: dict[str, Any]) -> str:
+def start_multi_geo_run(run_params: dict[str, Any], on_row: Callable[[dict], None] | None = None,
+                        background: bool = True) -> str:
     run_id = uuid.uuid4().hex[:12]
     tasks = run_params.get("tasks", [])
     total = len(tasks)
 
     _engine_logger.info(f"[{run_id}] Creating Multi-Geo run state (Total: {total} tasks).")
 
+    ts_folder = datetime.now().strftime("%H-%M-%S") + "_multi-geo"
+    run_params["subfolder"] = ts_folder  # Передадим это воркеру
+
     # Инициализируем состояние запуска
-    state = {
-        "run_id": run_id,
-        "total": total,
-        "done": 0,
-        "rows": [],
-        "started_at": time.time(),
-    }
-    with _lock:
-        _runs_state[run_id] = state
+    # persist=False (мониторинг): без архива строк, истории и .md-карточек
+    RunRegistry.create(run_id, run_params.get("run_kind", "multi_geo"), total,
+                       meta={k: v for k, v in run_params.items() if k != 'tasks'},
+                       archive=run_params.get("persist", True))
 
     # Подписываемся на SSE
-    sse_subscribe(run_id)
-
-    ts_folder = datetime.now().strftime("%H-%M-%S") + "_multi-geo"
-    run_params["subfolder"] = ts_folder  # Передадим это воркеру
+    if background:
+        sse_subscribe(run_id)
 
     # Стартовое событие для фронта
     _sse_emit(run_id, {
@@ -381,105 +563,305 @@ def start_multi_geo_run(run_params: dict[str, Any]) -> str:
     })
 
     # Запуск фонового процесса
-    thread = threading.Thread(
-        target=_run_multi_geo_async,
-        args=(run_params, run_id),
-        daemon=True
-    )
-    thread.start()
+    _launch(_run_multi_geo_async, (run_params, run_id), run_id, on_row, background)
 
     return run_id
 
 
-def _run_multi_geo_async(run_params: dict[str, Any], run_id: str):
-    _engine_logger.info(f"[{run_id}] Multi-Geo background thread started.")
-    cfg = ConfigStore.get()
-    tasks = run_params.get("tasks", [])
+def _group_by_geo(tasks: list[dict], connection_type: str) -> list[dict]:
+    """
+    Переупорядочивает задачи так, чтобы проверки одного (country, connection_type)
+    шли подряд: одинаковый гео-пароль -> тёплые сессии/туннели из HttpSessionPool.
+    Группы идут в порядке первого появления, внутри группы - порядок вставки.
+    Исходная позиция сохраняется в "idx" для упорядочивания в UI.
+    """
+    groups: Dict[tuple, list[dict]] = {}
+    for i, t in enumerate(tasks):
+        item = {**t, "idx": i}
+        groups.setdefault((t.get("country"), connection_type), []).append(item)
+    return [t for group in groups.values() for t in group]
 
-    def worker_task(task_item: dict):
-        url = task_item["url"]
-        country = task_item.get("country")
 
-        if "parsing_error" in task_item:
-            row = {
-                "url": url,
-                "country": country,
-                "result": "error",
-                "notes": task_item["parsing_error"]
-            }
-            _sse_emit(run_id, {"type": "check_finished", "run_id": run_id, **row})
-            return row
+def _run_geo_task(run_params: dict[str, Any], run_id: str, task_item: dict) -> dict:
+    """Одна проверка пары (url, country). Общая для Multi-Geo и bulk-запусков."""
+    cfg = ConfigStore.get()
+    url = task_item["url"]
+    country = task_item.get("country")
+    idx = task_item.get("idx")
 
-        task_specific = run_params.copy()
-        task_specific.update({
+    if "parsing_error" in task_item:
+        row = {
+            "idx": idx,
             "url": url,
             "country": country,
-            "run_id": run_id,
-            "region_code": None,
-            "city": None,
-            "isp": None
-        })
+            "result": "error",
+            "notes": task_item["parsing_error"]
+        }
+        _sse_emit(run_id, {"type": "check_finished", "run_id": run_id, **row})
+        return row
 
-        _sse_emit(run_id, {
-            "type": "check_started",
-            "run_id": run_id, "url": url, "country": country
-        })
+    task_specific = run_params.copy()
+    task_specific.update({
+        "url": url,
+        "country": country,
+        "run_id": run_id,
+        "region_code": None,
+        "city": None,
+        "isp": None
+    })
+
+    _sse_emit(run_id, {
+        "type": "check_started",
+        "run_id": run_id, "idx": idx, "url": url, "country": country
+    })
 
+    try:
+        res = execute_check(task_specific)
+    except Exception as e:
+        _engine_logger.error(f"[{run_id}] Worker failed for {url}: {e}")
+        # АХТУНГ! Нужно вернуть _полную_ структуру, чтобы не упасть ниже
+        res = {
+            "classification": "connect_error",
+            "notes": f"Worker failed: {e}",
+            "timings": {},
+            "md_path": "error.md",
+            "proxy_ext_ip": None,
+            "png_path": None,
+        }
+
+    png_relative_path = ""
+    if res.get("png_path"):
         try:
-            res = execute_check(task_specific)
-        except Exception as e:
-            _engine_logger.error(f"[{run_id}] Worker failed for {url}: {e}")
-            # АХТУНГ! Нужно вернуть _полную_ структуру, чтобы не упасть ниже
-            res = {
-                "classification": "connect_error",
-                "notes": f"Worker failed: {e}",
-                "timings": {},
-                "md_path": "error.md",
-                "proxy_ext_ip": None,
-                "png_path": None,
-            }
+            png_relative_path = os.path.relpath(res["png_path"], cfg.paths.logs_dir)
+            png_relative_path = png_relative_path.replace(os.path.sep, '/')
+        except Exception:
+            png_relative_path = os.path.basename(res["png_path"])
+
+    row = {
+        "idx": idx,
+        "url": url,
+        "country": country,
+        "result": res["classification"],
+        "http_code": res.get("http_code"),
+        "ttfb_ms": res.get("timings", {}).get("ttfb_ms"),
+        "ext_ip": res.get("proxy_ext_ip") or "-",
+        "ext_country": res.get("proxy_ext_country"),
+        "geo_mismatch": res.get("geo_mismatch", False),
+        "md_name": os.path.basename(res.get("md_path") or ""),
+        "png_name": png_relative_path,
+        "final_url": _redirect_target(res),
+        "notes": res.get("notes")
+    }
+    _sse_emit(run_id, {"type": "check_finished", "run_id": run_id, **row})
+    return row
 
-        png_relative_path = ""
-        if res.get("png_path"):
-            try:
-                png_relative_path = os.path.relpath(res["png_path"], cfg.paths.logs_dir)
-                png_relative_path = png_relative_path.replace(os.path.sep, '/')
-            except Exception:
-                png_relative_path = os.path.basename(res["png_path"])
 
-        row = {
-            "url": url,
-            "country": country,
-            "result": res["classification"],
-            "http_code": res.get("http_code"),
-            "ttfb_ms": res.get("timings", {}).get("ttfb_ms"),
-            "ext_ip": res.get("proxy_ext_ip") or "-",
-            "md_name": os.path.basename(res.get("md_path", "")),
-            "png_name": png_relative_path,
-            "notes": res.get("notes")
-        }
-        _sse_emit(run_id, {"type": "check_finished", "run_id": run_id, **row})
-        return row
+def _run_multi_geo_async(run_params: dict[str, Any], run_id: str):
+    _engine_logger.info(f"[{run_id}] Multi-Geo background thread started.")
+    cfg = ConfigStore.get()
+    tasks = run_params.get("tasks", [])
+    if cfg.execution.geo_affinity:
+        tasks = _group_by_geo(tasks, run_params.get("connection_type", "wifi"))
+    else:
+        tasks = [{**t, "idx": i} for i, t in enumerate(tasks)]
+    run_params["sticky"] = _resolve_sticky(run_params, len(tasks))
 
     with ThreadPoolExecutor(max_workers=cfg.execution.max_concurrency) as pool:
-        futs = [pool.submit(worker_task, t) for t in tasks]
-        for fut in as_completed(futs):
+        worker_task = lambda t: _run_geo_task(run_params, run_id, t)
+        for fut in _iter_bounded(pool, worker_task, tasks, _submit_window(cfg), _stop_event(run_id)):
             try:
                 row = fut.result()
-                with _lock:
-                    _runs_state[run_id]["rows"].append(row)
-                    _runs_state[run_id]["done"] += 1
+                _record_check_row(run_id, run_params.get("run_kind", "multi_geo"), row,
+                                  history=run_params.get("persist", True))
             except Exception as e:
                 _engine_logger.error(f"[{run_id}] Multi-Geo Future fatal: {e}")
 
-    st = _runs_state[run_id]
+    _finish_run(run_id)
+
+
+def _iter_matrix_tasks(urls: list[str], countries: list[str], order: str) -> Iterator[dict]:
+    """
+    Лениво разворачивает матрицу URL x country в задачи.
+    order="geo": все URL для первой страны, потом для второй... (дружит с пулом сессий)
+    order="url": все страны для первого URL, потом для второго...
+    """
+    if order == "url":
+        for i, url in enumerate(urls):
+            for j, country in enumerate(countries):
+                yield {"url": url, "country": country, "idx": i * len(countries) + j, "cell": (i, j)}
+    else:
+        for j, country in enumerate(countries):
+            for i, url in enumerate(urls):
+                yield {"url": url, "country": country, "idx": i * len(countries) + j, "cell": (i, j)}
+
+
+def build_matrix(urls: list[str], countries: list[str], rows: Iterable[dict]) -> dict:
+    """Компактная матрица результатов: cells[i][j] = result для urls[i] x countries[j]."""
+    cells: list[list[str | None]] = [[None] * len(countries) for _ in urls]
+    for row in rows:
+        cell = row.get("cell")
+        if cell:
+            cells[cell[0]][cell[1]] = row.get("result")
+    return {"urls": urls, "countries": countries, "cells": cells}
+
+
+def _run_matrix_async(run_params: dict[str, Any], run_id: str):
+    _engine_logger.info(f"[{run_id}] Matrix background thread started.")
+    cfg = ConfigStore.get()
+    urls = run_params["urls"]
+    countries = run_params["countries"]
+    tasks = _iter_matrix_tasks(urls, countries, run_params.get("order", "geo"))
+    cells: list[list[str | None]] = [[None] * len(countries) for _ in urls]
+    run_params["sticky"] = _resolve_sticky(run_params, len(urls) * len(countries))
+
+    def worker_task(t: dict) -> dict:
+        return {**_run_geo_task(run_params, run_id, t), "cell": list(t["cell"])}
+
+    with ThreadPoolExecutor(max_workers=cfg.execution.max_concurrency) as pool:
+        for fut in _iter_bounded(pool, worker_task, tasks, _submit_window(cfg), _stop_event(run_id)):
+            try:
+                row = fut.result()
+            except Exception as e:
+                _engine_logger.error(f"[{run_id}] Matrix Future fatal: {e}")
+                continue
+            _record_check_row(run_id, "matrix", row)
+            i, j = row["cell"]
+            cells[i][j] = row["result"]
+            _sse_emit(run_id, {
+                "type": "matrix_cell", "run_id": run_id, "i": i, "j": j,
+                "url": row["url"], "country": row["country"], "result": row["result"],
+                "http_code": row.get("http_code"), "ttfb_ms": row.get("ttfb_ms"),
+                "notes": row.get("notes"),
+            })
+
+    _finish_run(run_id, matrix={"urls": urls, "countries": countries, "cells": cells})
+
+
+def start_matrix_run(run_params: dict[str, Any], on_row: Callable[[dict], None] | None = None,
+                     background: bool = True) -> str:
+    """
+    Матричный запуск: run_params["urls"] x run_params["countries"].
+    Пары не разворачиваются заранее - это делает движок по мере подачи в пул.
+    """
+    run_id = uuid.uuid4().hex[:12]
+    urls = run_params["urls"]
+    countries = run_params["countries"]
+    total = len(urls) * len(countries)
+    run_params["subfolder"] = datetime.now().strftime("%H-%M-%S") + "_matrix"
+
+    _engine_logger.info(
+        f"[{run_id}] Creating matrix run state ({len(urls)} URLs x {len(countries)} countries, "
+        f"order={run_params.get('order', 'geo')})."
+    )
+    RunRegistry.create(run_id, "matrix", total, meta=dict(run_params))
+
+    if background:
+        sse_subscribe(run_id)
+
     _sse_emit(run_id, {
-        "type": "run_finished",
+        "type": "run_started",
         "run_id": run_id,
-        "totals": {
-            "ok": sum(1 for r in st["rows"] if r.get("result") == "success"),
-            "err": sum(1 for r in st["rows"] if r.get("result") != "success"),
-            "time_ms": int((time.time() - st["started_at"]) * 1000)
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "settings": {
+            "country": "MATRIX",
+            "matrix": {"urls": urls, "countries": countries, "order": run_params.get("order", "geo")},
         }
     })
-    sse_unsubscribe(run_id)
+
+    _launch(_run_matrix_async, (run_params, run_id), run_id, on_row, background)
+    return run_id
+
+
+def _parse_bulk_line(line: str, default_country: str | None) -> dict:
+    """
+    Одна строка bulk-загрузки -> задача.
+    NDJSON: {"url": "...", "country": "kz"}; текст: "url" или "url cc".
+    """
+    if line.startswith("{"):
+        try:
+            obj = json.loads(line)
+            raw_url = str(obj.get("url") or "")
+            country = obj.get("country") or default_country
+        except ValueError:
+            return {"url": line[:200], "country": None, "parsing_error": "Invalid JSON line"}
+    else:
+        parts = line.split()
+        raw_url = parts[0]
+        country = parts[1] if len(parts) >= 2 else default_country
+
+    url = normalize_url_complex(raw_url)
+    if not url:
+        return {"url": line[:200], "country": None, "parsing_error": "Empty URL"}
+    if not country:
+        return {"url": url, "country": None, "parsing_error": "Missing country (expected: url cc)"}
+    return {"url": url, "country": str(country).lower()}
+
+
+def _iter_bulk_tasks(spool_path: str, default_country: str | None, run_id: str) -> Iterator[dict]:
+    """
+    Лениво читает загруженный файл и убирает дубликаты (url, country).
+    Для дедупликации храним 8-байтовые хеши, а не сами строки.
+    """
+    seen: set[bytes] = set()
+    found = 0
+    with open(spool_path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            task = _parse_bulk_line(line, default_country)
+            key = hashlib.blake2b(
+                f"{task['url']}\t{task.get('country')}".encode("utf-8"), digest_size=8
+            ).digest()
+            if key in seen:
+                continue
+            seen.add(key)
+            task["idx"] = found
+            found += 1
+            RunRegistry.set_total(run_id, found)
+            yield task
+
+
+def _run_bulk_async(run_params: dict[str, Any], run_id: str, spool_path: str):
+    _engine_logger.info(f"[{run_id}] Bulk background thread started.")
+    cfg = ConfigStore.get()
+    tasks = _iter_bulk_tasks(spool_path, run_params.get("country"), run_id)
+    run_params["sticky"] = _resolve_sticky(run_params, None)
+
+    try:
+        with ThreadPoolExecutor(max_workers=cfg.execution.max_concurrency) as pool:
+            worker_task = lambda t: _run_geo_task(run_params, run_id, t)
+            for fut in _iter_bounded(pool, worker_task, tasks, _submit_window(cfg), _stop_event(run_id)):
+                try:
+                    row = fut.result()
+                    _record_check_row(run_id, "bulk", row)
+                except Exception as e:
+                    _engine_logger.error(f"[{run_id}] Bulk Future fatal: {e}")
+    finally:
+        try:
+            os.unlink(spool_path)
+        except OSError:
+            pass
+
+    st = _finish_run(run_id)
+    _engine_logger.info(f"[{run_id}] Bulk run {st['status']}: {st['done']} checks.")
+
+
+def start_bulk_run(run_params: dict[str, Any], spool_path: str) -> str:
+    """
+    Запускает проверку списка, уже выгруженного на диск (spool_path).
+    Парсинг, дедупликация и подача задач в пул идут потоково в фоне,
+    total растёт по мере чтения файла.
+    """
+    run_id = uuid.uuid4().hex[:12]
+    run_params["subfolder"] = datetime.now().strftime("%H-%M-%S") + "_bulk"
+
+    _engine_logger.info(f"[{run_id}] Creating bulk run state (spool: {spool_path}).")
+    RunRegistry.create(run_id, "bulk", 0, meta=dict(run_params))
+
+    # SSE-очередь не создаём заранее: bulk-запуски обычно опрашивают через /runs/<id>,
+    # а подписчик, если появится, получит события с момента подключения.
+    # через _launch: регистрируется _run_guards, т.е. работает fast-fail по 407/квоте
+    _launch(_run_bulk_async, (run_params, run_id, spool_path), run_id, None, background=True)
+
+    return run_id
@@ -0,0 +1,78 @@
+from __future__ import annotations
+import re, threading
+from typing import Dict, List, Tuple
+from config.loader import ConfigStore
+from logging_.engine_logger import get_engine_logger
+
+log = get_engine_logger()
+
+
+class ProviderMatcher:
+    """
+    dns_checker.provider_keywords, скомпилированные в одну regex-альтернацию.
+    Пересобирается лениво, когда меняется ConfigStore.version() (save_yaml -> init).
+
+    Поиск - lookahead на каждой позиции, т.е. находятся и перекрывающиеся
+    вхождения: на позиции берётся самое длинное ключевое слово, а более короткие,
+    являющиеся его префиксом, добавляются из заранее посчитанной таблицы.
+    Семантика та же, что у прежнего `keyword.lower() in text`.
+    """
+    _version = -1
+    _regex: re.Pattern | None = None
+    _providers: Dict[str, List[str]] = {}   # keyword (lower) -> провайдеры в порядке конфига
+    _prefixes: Dict[str, List[str]] = {}    # keyword -> более короткие keywords-префиксы
+    _order: Dict[str, int] = {}             # провайдер -> приоритет (порядок в конфиге)
+    _lock = threading.Lock()
+
+    @classmethod
+    def _compile(cls):
+        version = ConfigStore.version()
+        if version == cls._version:
+            return
+        with cls._lock:
+            if version == cls._version:
+                return
+            provider_map = ConfigStore.get().dns_checker.provider_keywords or {}
+            providers: Dict[str, List[str]] = {}
+            order: Dict[str, int] = {}
+            for name, keywords in provider_map.items():
+                order.setdefault(name, len(order))
+                for kw in keywords or []:
+                    kw = str(kw).lower()
+                    if kw and name not in providers.setdefault(kw, []):
+                        providers[kw].append(name)
+            keywords = sorted(providers, key=len, reverse=True)
+            prefixes = {kw: [k for k in keywords if len(k) < len(kw) and kw.startswith(k)] for kw in keywords}
+            regex = re.compile("(?=(" + "|".join(map(re.escape, keywords)) + "))") if keywords else None
+            cls._regex, cls._providers, cls._prefixes, cls._order = regex, providers, prefixes, order
+            cls._version = version
+            log.debug(f"Provider matcher compiled: {len(order)} providers, {len(keywords)} keywords.")
+
+    @classmethod
+    def find(cls, text: str) -> List[Dict[str, object]]:
+        """Все вхождения: [{provider, keyword, start, end}] по возрастанию позиции."""
+        cls._compile()
+        regex, providers, prefixes = cls._regex, cls._providers, cls._prefixes
+        if regex is None or not text:
+            return []
+        text = text.lower()
+        out = []
+        for m in regex.finditer(text):
+            start = m.start()
+            longest = m.group(1)
+            for kw in (longest, *prefixes[longest]):
+                for provider in providers[kw]:
+                    out.append({"provider": provider, "keyword": kw, "start": start, "end": start + len(kw)})
+        return out
+
+    @classmethod
+    def classify(cls, text: str) -> Tuple[str, List[Dict[str, object]]]:
+        """
+        (провайдер, все вхождения). Провайдер - первый по порядку в конфиге
+        среди найденных (как раньше), "Unknown" - если ничего не нашлось.
+        """
+        matches = cls.find(text)
+        if not matches:
+            return "Unknown", []
+        best = min({m["provider"] for m in matches}, key=lambda p: cls._order.get(p, 0))
+        return best, matches
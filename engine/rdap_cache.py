@@ -0,0 +1,259 @@
+from __future__ import annotations
+import ipaddress, json, os, threading, time
+from typing import Any, Dict, List, Tuple
+from config.loader import ConfigStore
+from logging_.engine_logger import get_engine_logger
+from .filelock import file_lock
+
+log = get_engine_logger()
+
+_Net = ipaddress.IPv4Network | ipaddress.IPv6Network
+
+
+def _cache_dir() -> str:
+    path = os.path.join(ConfigStore.get().paths.data_dir, "whois")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _cache_path() -> str:
+    return os.path.join(_cache_dir(), "rdap_cache.json")
+
+
+def networks_of(data: dict) -> List[_Net]:
+    """
+    CIDR'ы сети из RDAP-ответа ipwhois: network.cidr ("a/b, c/d"),
+    а если его нет - asn_cidr (BGP-префикс).
+    """
+    raw = ((data or {}).get("network") or {}).get("cidr") or (data or {}).get("asn_cidr") or ""
+    nets = []
+    for part in str(raw).split(","):
+        part = part.strip()
+        if not part or part.upper() == "NA":
+            continue
+        try:
+            nets.append(ipaddress.ip_network(part, strict=False))
+        except ValueError:
+            log.debug(f"[rdap-cache] Unparsable CIDR '{part}' skipped.")
+    return nets
+
+
+def slim_rdap(data: dict) -> dict:
+    """
+    То, что нужно кэшу и _parse_owner_from_whois_data: сеть (name/remarks/cidr), ASN и
+    имена/организации/почта контактов. Сырой ответ (`raw`) в кэш не попадает - он уже
+    сохранён в WhoisStore запуска или в логах дня.
+    """
+    net = (data or {}).get("network") or {}
+    entities = []
+    for entity in (data or {}).get("entities") or []:
+        if isinstance(entity, dict):
+            contact = entity.get("contact") or {}
+            entities.append({"contact": {k: contact[k] for k in ("name", "organization", "email")
+                                         if k in contact}})
+        elif isinstance(entity, str):
+            entities.append(entity)
+    return {
+        # ключи копируются как есть (и с None): текст для ProviderMatcher должен совпасть с живым ответом
+        "network": {k: net[k] for k in ("name", "remarks", "cidr") if k in net},
+        "asn": data.get("asn"),
+        "asn_cidr": data.get("asn_cidr"),
+        "asn_description": data.get("asn_description"),
+        "entities": entities,
+    }
+
+
+class RdapCache:
+    """
+    Кэш RDAP-ответов (урезанных slim_rdap) по сети: ответ для одного IP отвечает на все IP его
+    network.cidr (и индексируется по ASN). Поиск IP - по префиксному индексу
+    {(версия, длина префикса): {номер сети: ключ записи}}, от самого длинного
+    префикса к короткому, т.е. выигрывает самая узкая сеть.
+
+    Файл `<data_dir>/whois/rdap_cache.json` общий для gunicorn-воркеров:
+    перечитывается при изменении mtime, новые записи сливаются в него
+    под файловой блокировкой не чаще flush_interval_sec (и в конце DNS-запуска).
+    """
+    _entries: Dict[str, dict] = {}   # key (первый CIDR) -> {fetched_at, asn, cidrs, data (slim)}
+    _index: Dict[Tuple[int, int], Dict[int, str]] = {}
+    _by_asn: Dict[str, set] = {}
+    _dirty: Dict[str, dict] = {}
+    _mtime = 0.0
+    _last_flush = 0.0
+    _lock = threading.RLock()
+    _stats = {"hits": 0, "misses": 0}
+
+    # ---- индекс ----
+
+    @classmethod
+    def _add(cls, key: str, entry: dict):
+        old = cls._entries.get(key)
+        if old is not None:
+            cls._drop(key, old)
+        cls._entries[key] = entry
+        for cidr in entry["cidrs"]:
+            net = ipaddress.ip_network(cidr, strict=False)
+            bucket = cls._index.setdefault((net.version, net.prefixlen), {})
+            bucket[int(net.network_address) >> (net.max_prefixlen - net.prefixlen)] = key
+        if entry.get("asn"):
+            cls._by_asn.setdefault(str(entry["asn"]), set()).add(key)
+
+    @classmethod
+    def _drop(cls, key: str, entry: dict):
+        cls._entries.pop(key, None)
+        for cidr in entry["cidrs"]:
+            net = ipaddress.ip_network(cidr, strict=False)
+            bucket = cls._index.get((net.version, net.prefixlen))
+            if bucket is not None:
+                num = int(net.network_address) >> (net.max_prefixlen - net.prefixlen)
+                if bucket.get(num) == key:
+                    del bucket[num]
+                if not bucket:
+                    del cls._index[(net.version, net.prefixlen)]
+        keys = cls._by_asn.get(str(entry.get("asn")))
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del cls._by_asn[str(entry.get("asn"))]
+
+    @classmethod
+    def _fresh(cls, entry: dict, now: float) -> bool:
+        return now - entry.get("fetched_at", 0) < ConfigStore.get().rdap_cache.ttl_sec
+
+    # ---- диск ----
+
+    @classmethod
+    def _reload(cls):
+        """
+        Подхватывает записи, которые сохранили другие воркеры. Файл разбирается
+        без cls._lock, под блокировкой только слияние, чтобы не стопорить lookup'ы.
+        """
+        path = _cache_path()
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime == cls._mtime:
+            return
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                disk = json.load(f).get("entries", {})
+        except Exception as e:
+            log.error(f"[rdap-cache] Failed to load {path}: {e}")
+            return
+        with cls._lock:
+            if mtime == cls._mtime:
+                return
+            cls._mtime = mtime
+            for key, entry in disk.items():
+                mine = cls._entries.get(key)
+                if mine is None or mine.get("fetched_at", 0) < entry.get("fetched_at", 0):
+                    if "raw" in entry.get("data", {}):
+                        entry["data"] = slim_rdap(entry["data"])  # файл старого формата
+                    cls._add(key, entry)
+
+    @classmethod
+    def flush(cls, force: bool = True):
+        """Сливает новые записи в файл; протухшие и лишние (max_entries) выбрасывает."""
+        rc = ConfigStore.get().rdap_cache
+        with cls._lock:
+            now = time.time()
+            if not cls._dirty or (not force and now - cls._last_flush < rc.flush_interval_sec):
+                return
+            dirty, cls._dirty = cls._dirty, {}
+            cls._last_flush = now
+
+        path = _cache_path()
+        try:
+            with file_lock("rdap_cache.lock"):
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        entries = json.load(f).get("entries", {})
+                except FileNotFoundError:
+                    entries = {}
+                except Exception as e:
+                    log.error(f"[rdap-cache] {path} is unreadable, starting a new one: {e}")
+                    entries = {}
+                for key, entry in dirty.items():
+                    if entries.get(key, {}).get("fetched_at", 0) < entry["fetched_at"]:
+                        entries[key] = entry
+                for entry in entries.values():
+                    if "raw" in entry.get("data", {}):
+                        entry["data"] = slim_rdap(entry["data"])  # файл старого формата
+                entries = {k: e for k, e in entries.items() if now - e.get("fetched_at", 0) < rc.ttl_sec}
+                if len(entries) > rc.max_entries:
+                    newest = sorted(entries.items(), key=lambda kv: kv[1].get("fetched_at", 0))[-rc.max_entries:]
+                    entries = dict(newest)
+                tmp = path + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump({"entries": entries}, f, ensure_ascii=False)
+                os.replace(tmp, path)
+            log.debug(f"[rdap-cache] Flushed {len(dirty)} new networks ({len(entries)} total).")
+        except Exception as e:
+            log.error(f"[rdap-cache] Flush failed: {e}", exc_info=True)
+            with cls._lock:
+                for key, entry in dirty.items():
+                    cls._dirty.setdefault(key, entry)
+
+    # ---- API ----
+
+    @classmethod
+    def lookup(cls, ip: str) -> dict | None:
+        """Урезанный (slim_rdap) RDAP-ответ для сети, содержащей ip, или None."""
+        if not ConfigStore.get().rdap_cache.enabled:
+            return None
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        num = int(addr)
+        bits = addr.max_prefixlen
+        now = time.time()
+        cls._reload()
+        with cls._lock:
+            lengths = sorted((plen for ver, plen in cls._index if ver == addr.version), reverse=True)
+            for plen in lengths:
+                key = cls._index[(addr.version, plen)].get(num >> (bits - plen))
+                if key is None:
+                    continue
+                entry = cls._entries[key]
+                if cls._fresh(entry, now):
+                    cls._stats["hits"] += 1
+                    return entry["data"]
+            cls._stats["misses"] += 1
+        return None
+
+    @classmethod
+    def put(cls, data: dict):
+        """Запоминает RDAP-ответ для всех его сетей."""
+        if not ConfigStore.get().rdap_cache.enabled or not data:
+            return
+        nets = networks_of(data)
+        if not nets:
+            return
+        cidrs = [str(n) for n in nets]
+        entry = {"fetched_at": time.time(), "asn": data.get("asn"), "cidrs": cidrs, "data": slim_rdap(data)}
+        with cls._lock:
+            cls._add(cidrs[0], entry)
+            cls._dirty[cidrs[0]] = entry
+        cls.flush(force=False)
+
+    @classmethod
+    def by_asn(cls, asn: str) -> List[dict]:
+        """Свежие записи кэша для ASN: [{cidrs, fetched_at, asn_description}]."""
+        now = time.time()
+        cls._reload()
+        with cls._lock:
+            out = []
+            for key in sorted(cls._by_asn.get(str(asn), ())):
+                e = cls._entries[key]
+                if cls._fresh(e, now):
+                    out.append({"cidrs": e["cidrs"], "fetched_at": e["fetched_at"],
+                                "asn_description": e["data"].get("asn_description")})
+            return out
+
+    @classmethod
+    def stats(cls) -> Dict[str, Any]:
+        with cls._lock:
+            return {**cls._stats, "networks": len(cls._entries), "asns": len(cls._by_asn),
+                    "pending_flush": len(cls._dirty)}
@@ -0,0 +1,226 @@
+from __future__ import annotations
+import threading, time
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict
+from urllib.request import BaseHandler, OpenerDirector, ProxyHandler, build_opener
+from ipwhois import IPWhois
+from ipwhois.exceptions import HTTPRateLimitError
+from ipwhois.nir import NIRWhois
+from ipwhois.rdap import RDAP
+from config.loader import ConfigStore
+from logging_.engine_logger import get_engine_logger
+from .ratelimit import TokenBucket
+
+log = get_engine_logger()
+
+# RDAP-хосты -> реестр (имена как в asn_registry у ipwhois)
+_REGISTRY_HOSTS = {
+    "rdap.arin.net": "arin",
+    "rdap.db.ripe.net": "ripencc",
+    "rdap.apnic.net": "apnic",
+    "rdap.lacnic.net": "lacnic",
+    "rdap.afrinic.net": "afrinic",
+}
+
+
+# полоса текущего lookup'а (для pace(): основная полоса не спит на заблокированном реестре)
+_local = threading.local()
+
+
+def registry_for_host(host: str) -> str:
+    host = (host or "").split(":")[0].lower()
+    return _REGISTRY_HOSTS.get(host, host or "unknown")
+
+
+def _parse_retry_after(value: str | None) -> float | None:
+    """Retry-After: секунды или HTTP-дата."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RdapThrottled(HTTPRateLimitError):
+    """429 от RDAP-сервера реестра (наследник HTTPRateLimitError - ipwhois пробрасывает его как есть)."""
+
+    def __init__(self, registry: str, retry_after: float | None):
+        super().__init__(f"RDAP rate limit at {registry}"
+                         f"{f', retry after {retry_after:.0f}s' if retry_after is not None else ''}")
+        self.registry = registry
+        self.retry_after = retry_after
+
+
+class RdapDeferred(Exception):
+    """Реестр сейчас в backoff/перегружен: lookup отложен в retry-полосу."""
+
+    def __init__(self, registry: str):
+        super().__init__(f"RDAP lookup deferred, {registry} is throttled")
+        self.registry = registry
+
+
+class _RdapHandler(BaseHandler):
+    """
+    urllib-обработчик для opener'а ipwhois: темп каждого HTTP-запроса по реестру
+    (token bucket) и перехват 429 до встроенного sleep(rate_limit_timeout) в ipwhois.
+    """
+
+    def http_request(self, req):
+        RdapScheduler.pace(registry_for_host(req.host))
+        return req
+
+    https_request = http_request
+
+    def http_error_429(self, req, fp, code, msg, hdrs):
+        registry = registry_for_host(req.host)
+        retry_after = _parse_retry_after(hdrs.get("Retry-After"))
+        fp.close()
+        RdapScheduler.throttled(registry, retry_after)
+        raise RdapThrottled(registry, retry_after)
+
+
+class _Registry:
+    def __init__(self, name: str, rate: float, burst: int, concurrency: int):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = threading.BoundedSemaphore(max(1, concurrency))
+        self.blocked_until = 0.0
+        self.backoff = 0.0
+        self.requests = 0
+        self.throttled = 0
+        self.deferred = 0
+
+
+class RdapScheduler:
+    """
+    RDAP-запросы с лимитами по реестрам (ARIN, RIPE, APNIC, ...):
+    - token bucket на каждый HTTP-запрос к реестру (rdap_scheduler.rate_per_sec / registries);
+    - не больше `concurrency` одновременных lookup'ов на реестр;
+    - после 429 реестр блокируется на Retry-After (или экспоненциальный backoff);
+    - основная полоса (lane="main") не ждёт заблокированный реестр дольше
+      main_max_wait_sec, а бросает RdapDeferred - такие IP DNS-запуск
+      догоняет retry-полосой (lane="retry") после основного прохода.
+    """
+    _registries: Dict[str, _Registry] = {}
+    _lock = threading.Lock()
+    _opener: OpenerDirector | None = None
+
+    @classmethod
+    def _get(cls, name: str) -> _Registry:
+        with cls._lock:
+            reg = cls._registries.get(name)
+            if reg is None:
+                sc = ConfigStore.get().rdap_scheduler
+                rate = float(sc.registries.get(name, sc.rate_per_sec))
+                reg = cls._registries[name] = _Registry(name, rate, sc.burst, sc.concurrency)
+            return reg
+
+    @classmethod
+    def opener(cls) -> OpenerDirector:
+        with cls._lock:
+            if cls._opener is None:
+                cls._opener = build_opener(ProxyHandler(), _RdapHandler())
+            return cls._opener
+
+    @classmethod
+    def pace(cls, registry: str):
+        reg = cls._get(registry)
+        wait = reg.blocked_until - time.monotonic()
+        if wait > 0:
+            if getattr(_local, "lane", None) == "main" and wait > ConfigStore.get().rdap_scheduler.main_max_wait_sec:
+                raise RdapThrottled(registry, wait)
+            time.sleep(wait)
+        reg.bucket.acquire()
+        reg.requests += 1
+
+    @classmethod
+    def throttled(cls, registry: str, retry_after: float | None):
+        sc = ConfigStore.get().rdap_scheduler
+        reg = cls._get(registry)
+        with cls._lock:
+            reg.throttled += 1
+            reg.backoff = min(sc.max_backoff_sec, reg.backoff * 2 if reg.backoff else sc.base_backoff_sec)
+            delay = retry_after if retry_after is not None else reg.backoff
+            reg.blocked_until = max(reg.blocked_until, time.monotonic() + min(delay, sc.max_backoff_sec))
+        log.warning(f"[rdap] {registry} throttled (429), backing off {delay:.0f}s.")
+
+    @classmethod
+    def _succeeded(cls, registry: str):
+        reg = cls._get(registry)
+        with cls._lock:
+            reg.backoff = 0.0
+
+    @classmethod
+    def lookup(cls, ip: str, lane: str = "main", depth: int = 1) -> Dict[str, Any]:
+        """
+        Аналог IPWhois(ip).lookup_rdap(depth, inc_raw=True, inc_nir=True), но с
+        ASN-шагом отдельно: по asn_registry выбирается очередь реестра.
+        lane="main": RdapDeferred, если реестр занят/заблокирован;
+        lane="retry": ждёт, до retry_attempts попыток, затем RdapThrottled.
+        """
+        sc = ConfigStore.get().rdap_scheduler
+        _local.lane = lane
+        obj = IPWhois(ip, timeout=sc.timeout_sec, proxy_opener=cls.opener())
+        asn_data = obj.ipasn.lookup(inc_raw=True, retry_count=sc.retry_count)
+        registry = asn_data.get("asn_registry") or "arin"
+        reg = cls._get(registry)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            if lane == "main":
+                if reg.blocked_until - time.monotonic() > sc.main_max_wait_sec \
+                        or not reg.slots.acquire(timeout=sc.main_max_wait_sec):
+                    with cls._lock:
+                        reg.deferred += 1
+                    raise RdapDeferred(registry)
+            else:
+                wait = reg.blocked_until - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                reg.slots.acquire()
+            try:
+                rdap_data = RDAP(obj.net).lookup(
+                    inc_raw=True, retry_count=sc.retry_count, asn_data=asn_data, depth=depth,
+                    rate_limit_timeout=sc.base_backoff_sec
+                )
+                break
+            except RdapThrottled:
+                if lane == "main":
+                    with cls._lock:
+                        reg.deferred += 1
+                    raise RdapDeferred(registry)
+                if attempt >= sc.retry_attempts:
+                    raise
+            finally:
+                reg.slots.release()
+
+        cls._succeeded(registry)
+        results: Dict[str, Any] = {"nir": None, **asn_data, **rdap_data}
+        nir = {"JP": "jpnic", "KR": "krnic"}.get(asn_data.get("asn_country_code"))
+        if nir:
+            try:
+                results["nir"] = NIRWhois(obj.net).lookup(nir=nir, inc_raw=True, retry_count=sc.retry_count)
+            except Exception as e:
+                log.debug(f"[rdap] NIR lookup ({nir}) for {ip} failed: {e}")
+        return results
+
+    @classmethod
+    def stats(cls) -> Dict[str, Any]:
+        now = time.monotonic()
+        with cls._lock:
+            return {
+                name: {
+                    "rate_per_sec": reg.bucket.rate,
+                    "blocked_for_sec": round(max(0.0, reg.blocked_until - now), 1),
+                    "backoff_sec": reg.backoff,
+                    "requests": reg.requests,
+                    "throttled": reg.throttled,
+                    "deferred": reg.deferred,
+                }
+                for name, reg in cls._registries.items()
+            }
@@ -0,0 +1,266 @@
+from __future__ import annotations
+import json, os, threading, time
+from collections import OrderedDict
+from typing import Dict, List
+from config.loader import ConfigStore
+from logging_.engine_logger import get_engine_logger
+
+log = get_engine_logger()
+
+# meta активного запуска переписывается на диск не реже, чем раз в столько строк / секунд,
+# чтобы /runs/<id> на других gunicorn-воркерах видел прогресс
+_META_EVERY_ROWS = 100
+_META_EVERY_SEC = 2.0
+
+
+def _runs_dir() -> str:
+    path = os.path.join(ConfigStore.get().paths.data_dir, "runs")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _meta_path(run_id: str) -> str:
+    return os.path.join(_runs_dir(), f"{run_id}.meta.json")
+
+
+def _rows_path(run_id: str) -> str:
+    return os.path.join(_runs_dir(), f"{run_id}.rows.ndjson")
+
+
+class RunRegistry:
+    """
+    Реестр запусков с ограниченной памятью.
+
+    В памяти живут только активные запуски и небольшое окно последних
+    завершённых (LRU + возраст + бюджет памяти из `runs:` в app.yaml).
+    Строки результатов по мере поступления дописываются в
+    `<data_dir>/runs/<run_id>.rows.ndjson`, у активного запуска в памяти
+    остаётся только "хвост" строк. Всё, что вытеснено, читается с диска.
+    """
+    _active: Dict[str, dict] = {}
+    _recent: "OrderedDict[str, dict]" = OrderedDict()
+    _recent_bytes: int = 0
+    _last_prune: float = 0.0
+    _lock = threading.RLock()
+
+    @classmethod
+    def create(cls, run_id: str, kind: str, total: int, meta: dict | None = None,
+               archive: bool = True) -> dict:
+        """
+        Registers a new active run and writes its initial meta file.
+        archive=False: only counters are kept (no rows, nothing written to disk).
+        """
+        state = {
+            "run_id": run_id,
+            "kind": kind,
+            "status": "running",
+            "reason": None,
+            "total": total,
+            "done": 0,
+            "ok": 0,
+            "err": 0,
+            "rows": [],
+            "sizes": [],
+            "rows_offset": 0,  # индекс первой строки, которая ещё лежит в памяти
+            "bytes": 0,
+            "started_at": time.time(),
+            "finished_at": None,
+            "meta": meta or {},
+            "archive": archive,
+        }
+        with cls._lock:
+            # построчная буферизация: строки сразу видны читателям архива в других воркерах
+            state["_fh"] = open(_rows_path(run_id), "a", encoding="utf-8", buffering=1) if archive else None
+            cls._active[run_id] = state
+            cls._write_meta(state)
+            cls._evict()  # заодно вычищаем устаревшие завершённые запуски
+        return state
+
+    @classmethod
+    def append_row(cls, run_id: str, row: dict, ok: bool):
+        cfg = ConfigStore.get().runs
+        line = json.dumps(row, ensure_ascii=False)
+        with cls._lock:
+            st = cls._active.get(run_id)
+            if st is None:
+                log.warning(f"[{run_id}] append_row for unknown/finished run, row dropped.")
+                return
+            st["done"] += 1
+            st["ok" if ok else "err"] += 1
+            if not st["archive"]:
+                return
+            st["_fh"].write(line + "\n")
+            st["rows"].append(row)
+            st["sizes"].append(len(line))
+            st["bytes"] += len(line)
+
+            # у активного запуска держим в памяти только хвост строк
+            overflow = len(st["rows"]) - cfg.active_rows_window
+            if overflow > 0:
+                st["bytes"] -= sum(st["sizes"][:overflow])
+                del st["rows"][:overflow]
+                del st["sizes"][:overflow]
+                st["rows_offset"] += overflow
+
+            now = time.time()
+            if st["done"] - st["_meta_done"] >= _META_EVERY_ROWS or now - st["_meta_at"] >= _META_EVERY_SEC:
+                cls._write_meta(st)
+
+    @classmethod
+    def set_total(cls, run_id: str, total: int):
+        with cls._lock:
+            st = cls._active.get(run_id)
+            if st is not None:
+                st["total"] = total
+
+    @classmethod
+    def finish(cls, run_id: str, status: str = "finished", reason: str | None = None) -> dict:
+        """
+        Moves a run from the active set into the recent window
+        and flushes it to disk. Returns the final summary.
+        """
+        with cls._lock:
+            st = cls._active.pop(run_id, None)
+            if st is None:
+                return cls.get(run_id) or {}
+            st["status"] = status
+            st["reason"] = reason
+            st["finished_at"] = time.time()
+            try:
+                fh = st.pop("_fh")
+                if fh is not None:
+                    fh.close()
+            except Exception as e:
+                log.error(f"[{run_id}] Failed to close rows archive: {e}")
+            cls._write_meta(st)
+
+            cls._recent[run_id] = st
+            cls._recent_bytes += st["bytes"]
+            cls._evict()
+            summary = cls._summary(st)
+
+        cls._maybe_prune_archive()
+        return summary
+
+    @classmethod
+    def get(cls, run_id: str) -> dict | None:
+        """Returns run summary (without rows) from memory or from the on-disk archive."""
+        with cls._lock:
+            st = cls._active.get(run_id)
+            if st is None:
+                st = cls._recent.get(run_id)
+                if st is not None:
+                    cls._recent.move_to_end(run_id)
+            if st is not None:
+                return cls._summary(st)
+
+        try:
+            with open(_meta_path(run_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.error(f"[{run_id}] Failed to read run meta: {e}")
+            return None
+
+    @classmethod
+    def get_rows(cls, run_id: str, after: int = 0, limit: int = 500) -> List[dict]:
+        """
+        Returns rows with index in [after, after + limit).
+        Serves from memory when possible, falls back to the NDJSON archive.
+        """
+        after = max(after, 0)
+        with cls._lock:
+            st = cls._active.get(run_id) or cls._recent.get(run_id)
+            if st is not None:
+                if after >= st["rows_offset"]:
+                    start = after - st["rows_offset"]
+                    return st["rows"][start:start + limit]
+
+        rows = []
+        try:
+            with open(_rows_path(run_id), "r", encoding="utf-8") as f:
+                for i, line in enumerate(f):
+                    if i < after:
+                        continue
+                    if len(rows) >= limit:
+                        break
+                    try:
+                        rows.append(json.loads(line))
+                    except ValueError:
+                        break  # строка активного запуска, которую ещё дописывают
+        except FileNotFoundError:
+            pass
+        return rows
+
+    @classmethod
+    def _summary(cls, st: dict) -> dict:
+        return {
+            "run_id": st["run_id"],
+            "kind": st["kind"],
+            "status": st["status"],
+            "reason": st["reason"],
+            "total": st["total"],
+            "done": st["done"],
+            "totals": {"ok": st["ok"], "err": st["err"]},
+            "started_at": st["started_at"],
+            "finished_at": st["finished_at"],
+            "meta": st["meta"],
+        }
+
+    @classmethod
+    def _write_meta(cls, st: dict):
+        st["_meta_done"], st["_meta_at"] = st["done"], time.time()
+        if not st["archive"]:
+            return
+        path = _meta_path(st["run_id"])
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(cls._summary(st), f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except Exception as e:
+            log.error(f"[{st['run_id']}] Failed to write run meta: {e}")
+
+    @classmethod
+    def _evict(cls):
+        """Drops completed runs from memory by age, then LRU, until within budget."""
+        cfg = ConfigStore.get().runs
+        budget = cfg.memory_budget_mb * 1024 * 1024
+        now = time.time()
+
+        for run_id in list(cls._recent.keys()):
+            st = cls._recent[run_id]
+            if now - st["finished_at"] > cfg.recent_max_age_sec:
+                cls._drop_recent(run_id)
+
+        while cls._recent and (len(cls._recent) > cfg.recent_max_runs or cls._recent_bytes > budget):
+            cls._drop_recent(next(iter(cls._recent)))
+
+    @classmethod
+    def _drop_recent(cls, run_id: str):
+        st = cls._recent.pop(run_id)
+        cls._recent_bytes -= st["bytes"]
+        log.debug(f"[{run_id}] Evicted run from memory (rows stay in archive).")
+
+    @classmethod
+    def _maybe_prune_archive(cls):
+        """Removes archived runs older than retention. Runs at most once per hour."""
+        now = time.time()
+        if now - cls._last_prune < 3600:
+            return
+        cls._last_prune = now
+
+        max_age = ConfigStore.get().runs.archive_retention_days * 86400
+        runs_dir = _runs_dir()
+        removed = 0
+        for name in os.listdir(runs_dir):
+            path = os.path.join(runs_dir, name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.unlink(path)
+                    removed += 1
+            except OSError:
+                pass
+        if removed:
+            log.info(f"Pruned {removed} archived run files older than retention.")
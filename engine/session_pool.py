@@ -0,0 +1,71 @@
+from __future__ import annotations
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, List
+import requests
+from logging_.engine_logger import get_engine_logger
+
+log = get_engine_logger()
+
+# сколько разных прокси-ключей (proxy URL = логин + гео-пароль + порт) держим тёплыми
+MAX_KEYS = 64
+# сколько простаивающих сессий держим на один ключ
+MAX_IDLE_PER_KEY = 8
+
+
+class HttpSessionPool:
+    """
+    Пул requests.Session, сгруппированный по proxy URL.
+
+    Сессия (и её keep-alive соединения до шлюза SOAX) переиспользуется
+    следующими проверками с тем же гео, вместо Session() на каждый URL.
+    Одна сессия одновременно используется только одним потоком.
+    Ключи вытесняются по LRU, сессии после ошибок выбрасываются,
+    куки очищаются при возврате в пул - проверки остаются независимыми.
+    """
+    _idle: "OrderedDict[str, List[requests.Session]]" = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    @contextmanager
+    def checkout(cls, key: str, max_redirects: int = 5) -> Iterator[requests.Session]:
+        sess = None
+        with cls._lock:
+            sessions = cls._idle.get(key)
+            if sessions:
+                sess = sessions.pop()
+                cls._idle.move_to_end(key)
+
+        if sess is None:
+            sess = requests.Session()
+            sess.max_redirects = max_redirects
+
+        try:
+            yield sess
+        except Exception:
+            # после ошибки соединения могут быть в непонятном состоянии
+            sess.close()
+            raise
+
+        cls._checkin(key, sess)
+
+    @classmethod
+    def _checkin(cls, key: str, sess: requests.Session):
+        # куки сайта (consent, anti-bot) не должны попасть в следующую проверку
+        sess.cookies.clear()
+        to_close: List[requests.Session] = []
+        with cls._lock:
+            sessions = cls._idle.setdefault(key, [])
+            cls._idle.move_to_end(key)
+            if len(sessions) < MAX_IDLE_PER_KEY:
+                sessions.append(sess)
+            else:
+                to_close.append(sess)
+
+            while len(cls._idle) > MAX_KEYS:
+                _old_key, old_sessions = cls._idle.popitem(last=False)
+                to_close.extend(old_sessions)
+
+        for s in to_close:
+            s.close()
@@ -0,0 +1,88 @@
+from __future__ import annotations
+import urllib.parse
+from typing import Iterable
+
+
+def normalize_url_complex(raw_url: str) -> str:
+    """
+    Приводит домен к нижнему регистру, сохраняя регистр local path и параметров.
+    Domain.COM/LoCaL_PatH -> domain.com/LoCaL_PatH
+    """
+    url = raw_url.strip()
+    if not url:
+        return ""
+
+    # Добавляем временную схему, если её нет, для корректного парсинга
+    has_scheme = "://" in url
+    parse_url = url if has_scheme else f"http://{url}"
+
+    try:
+        parsed = urllib.parse.urlsplit(parse_url)
+        # собираем обратно: домен в lower, остальное как есть
+        netloc = parsed.netloc.lower()
+        path = parsed.path
+        query = parsed.query
+        fragment = parsed.fragment
+
+        # пересобираем без схемы, если её не было изначально
+        scheme = parsed.scheme + "://" if has_scheme else ""
+        new_url = f"{scheme}{netloc}{path}"
+        if query:
+            new_url += f"?{query}"
+        if fragment:
+            new_url += f"#{fragment}"
+        return new_url
+    except Exception:
+        # Если парсер упал, возвращаем как есть (fallback)
+        return url
+
+
+def parse_url_lines(lines: Iterable[str]) -> list[str]:
+    """Нормализует список URL и убирает дубликаты, сохраняя порядок."""
+    raw_list = [normalize_url_complex(u) for u in lines if u.strip()]
+    return [u for u in dict.fromkeys(raw_list) if u]
+
+
+def parse_multi_geo_lines(lines: Iterable[str]) -> list[dict]:
+    """
+    Разбирает строки формата `url cc` в задачи Multi-Geo.
+    Дубликаты (url, country) отбрасываются, строки с ошибкой формата
+    превращаются в задачи с `parsing_error` (тоже без дублей).
+    """
+    tasks = []
+    seen_tasks = set()
+    seen_errors = set()
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        parts = line.split()
+        if len(parts) >= 2:
+            # домен нормализуем, local path сохраняем
+            url = normalize_url_complex(parts[0])
+            country = parts[1].lower()  # гео в lower
+
+            task_key = (url, country)
+            if task_key not in seen_tasks:
+                tasks.append({
+                    "url": url,
+                    "country": country
+                })
+                seen_tasks.add(task_key)
+        else:
+            # Обработка ошибок формата
+            url_err = parts[0].lower() if parts else "Unknown"
+            err_msg = "Invalid format (expected: url cc)"
+
+            err_key = (url_err, err_msg)
+            if err_key not in seen_errors:
+                tasks.append({
+                    "url": url_err,
+                    "country": None,
+                    "parsing_error": err_msg
+                })
+                seen_errors.add(err_key)
+
+    return tasks
+
@@ -0,0 +1,135 @@
+from __future__ import annotations
+import gzip, json, os, threading, time
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+from config.loader import ConfigStore
+from logging_.engine_logger import get_engine_logger
+
+log = get_engine_logger()
+
+# сколько индексов держим в памяти для чтения (LRU по run_id)
+_READ_CACHE_RUNS = 8
+
+
+def _runs_dir() -> str:
+    path = os.path.join(ConfigStore.get().paths.data_dir, "runs")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _data_path(run_id: str) -> str:
+    return os.path.join(_runs_dir(), f"{run_id}.whois.ndjson.gz")
+
+
+def _index_path(run_id: str) -> str:
+    return os.path.join(_runs_dir(), f"{run_id}.whois.idx")
+
+
+class WhoisStore:
+    """
+    Сырые RDAP-ответы DNS-запуска в одном файле `<data_dir>/runs/<run_id>.whois.ndjson.gz`
+    (рядом с архивом запуска, чистится вместе с ним).
+
+    Каждая запись - отдельный gzip-member с одной JSON-строкой, поэтому файл
+    целиком - валидный .gz (zcat читает всё), а одну запись можно достать по
+    (offset, length) без распаковки остального. IP одной RDAP-сети ссылаются
+    на одну запись. Индекс - append-only NDJSON `<run_id>.whois.idx`:
+        {"ip": ..., "o": offset, "n": length}  /  {"domain": ..., "ip": ...}
+    """
+
+    def __init__(self, run_id: str):
+        self.run_id = run_id
+        self._lock = threading.Lock()
+        self._offsets: Dict[str, Tuple[int, int]] = {}   # ip -> (offset, length)
+        self._by_record: Dict[str, Tuple[int, int]] = {}  # ключ записи (сеть) -> (offset, length)
+        self._data = open(_data_path(run_id), "ab")
+        self._index = open(_index_path(run_id), "a", encoding="utf-8")
+
+    def append(self, ip: str, raw: Any, record_key: str | None = None, cached: bool = False):
+        """Сохраняет сырой ответ для IP; одинаковый record_key (CIDR сети) пишется один раз."""
+        with self._lock:
+            loc = self._by_record.get(record_key) if record_key else None
+            if loc is None:
+                line = json.dumps({"ip": ip, "network": record_key, "cached": cached,
+                                   "ts": int(time.time()), "raw": raw}, ensure_ascii=False)
+                member = gzip.compress(line.encode("utf-8") + b"\n")
+                offset = self._data.tell()
+                self._data.write(member)
+                self._data.flush()
+                loc = (offset, len(member))
+                if record_key:
+                    self._by_record[record_key] = loc
+            self._offsets[ip] = loc
+            self._index.write(json.dumps({"ip": ip, "o": loc[0], "n": loc[1]}) + "\n")
+            self._index.flush()
+
+    def has(self, ip: str) -> bool:
+        with self._lock:
+            return ip in self._offsets
+
+    def link(self, domain: str, ip: str):
+        with self._lock:
+            self._index.write(json.dumps({"domain": domain, "ip": ip}, ensure_ascii=False) + "\n")
+            self._index.flush()
+
+    def close(self):
+        with self._lock:
+            self._data.close()
+            self._index.close()
+
+    # ---- чтение (любой воркер) ----
+
+    _read_cache: "OrderedDict[str, Tuple[float, dict, dict]]" = OrderedDict()
+    _read_lock = threading.Lock()
+
+    @classmethod
+    def _load_index(cls, run_id: str) -> Tuple[dict, dict] | None:
+        path = _index_path(run_id)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        with cls._read_lock:
+            hit = cls._read_cache.get(run_id)
+            if hit is not None and hit[0] == mtime:
+                cls._read_cache.move_to_end(run_id)
+                return hit[1], hit[2]
+        ips: Dict[str, Tuple[int, int]] = {}
+        domains: Dict[str, str] = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    e = json.loads(line)
+                except ValueError:
+                    continue  # недописанная последняя строка у активного запуска
+                if "domain" in e:
+                    domains[e["domain"].lower()] = e["ip"]
+                else:
+                    ips[e["ip"]] = (e["o"], e["n"])
+        with cls._read_lock:
+            cls._read_cache[run_id] = (mtime, ips, domains)
+            cls._read_cache.move_to_end(run_id)
+            while len(cls._read_cache) > _READ_CACHE_RUNS:
+                cls._read_cache.popitem(last=False)
+        return ips, domains
+
+    @classmethod
+    def read(cls, run_id: str, domain: str | None = None, ip: str | None = None) -> dict | None:
+        """Одна запись по домену (его первый IP) или по IP; None, если нет."""
+        index = cls._load_index(run_id)
+        if index is None:
+            return None
+        ips, domains = index
+        if ip is None and domain:
+            ip = domains.get(domain.lower())
+        loc = ips.get(ip) if ip else None
+        if loc is None:
+            return None
+        with open(_data_path(run_id), "rb") as f:
+            f.seek(loc[0])
+            member = f.read(loc[1])
+        record = json.loads(gzip.decompress(member))
+        record["ip"] = ip
+        if domain:
+            record["domain"] = domain
+        return record
@@ -1,5 +1,6 @@
 from __future__ import annotations
 import os
+import re
 import socket
 import time
 import urllib.parse
@@ -7,10 +8,12 @@ import requests
 import threading
 from datetime import datetime
 from typing import Any
-from providers.soax import get_session, ProxySession
+from providers.soax import get_session, invalidate_session, release_session, ProxySession, ExitInfoCache
+from providers.proxy_health import ProxyHealth, ProxyUnhealthyError, health_key, is_proxy_fault
 from config.loader import ConfigStore
 from logging_.md_writer import ensure_day_dir, unique_file_path, render_md_card
 from logging_.engine_logger import get_engine_logger
+from .session_pool import HttpSessionPool
 
 try:
     from playwright.sync_api import sync_playwright
@@ -19,6 +22,9 @@ except Exception:
 
 log = get_engine_logger()
 
+# фразы шлюза SOAX о закончившемся трафике (целиком, не подстрокой)
+_GATEWAY_QUOTA_RE = re.compile(r"\b(?:traffic limit (?:exceeded|reached)|out of traffic)\b")
+
 screenshot_semaphore: threading.Semaphore | None = None
 _semaphore_lock = threading.Lock()  # lock для инициализации семафора
 
@@ -70,24 +76,25 @@ def _measure_http(url: str, proxies: dict, timeout_sec: int, max_redirects: int
 
     headers.update(cfg.http_client.custom_headers)
 
-    sess = requests.Session()
-    sess.max_redirects = max_redirects
-    sess.headers.update(headers)
     start = time.time()
     try:
-        resp = sess.get(url, proxies=proxies, timeout=timeout_sec, stream=True, allow_redirects=True)
-        http_status = resp.status_code
-        first_chunk = next(resp.iter_content(chunk_size=1024), b"")
-        ttfb = time.time() - start
-        timings["ttfb_ms"] = int(ttfb * 1000)
-        content = first_chunk + resp.content
-        bytes_count = len(content)
-
-        # берем историю редиректов из 'resp.history'.
-        # каждый 'r' в 'history' - это Response-объект редиректа.
-        redirects = []
-        for r in resp.history:
-            redirects.append((r.status_code, r.url, r.headers.get('Location', '')))
+        # сессии переиспользуются между проверками с тем же прокси (гео),
+        # чтобы не поднимать соединение до шлюза на каждый URL
+        with HttpSessionPool.checkout(proxies["https"], max_redirects) as sess:
+            resp = sess.get(url, headers=headers, proxies=proxies, timeout=timeout_sec,
+                            stream=True, allow_redirects=True)
+            http_status = resp.status_code
+            first_chunk = next(resp.iter_content(chunk_size=1024), b"")
+            ttfb = time.time() - start
+            timings["ttfb_ms"] = int(ttfb * 1000)
+            content = first_chunk + resp.content
+            bytes_count = len(content)
+
+            # берем историю редиректов из 'resp.history'.
+            # каждый 'r' в 'history' - это Response-объект редиректа.
+            redirects = []
+            for r in resp.history:
+                redirects.append((r.status_code, r.url, r.headers.get('Location', '')))
 
     except requests.exceptions.RequestException as e:
         end = time.time()
@@ -99,8 +106,21 @@ def _measure_http(url: str, proxies: dict, timeout_sec: int, max_redirects: int
 
 
 def _classify(exc: Exception | None, http_status: int | None, timeout_sec: int) -> str:
+    if isinstance(exc, ProxyUnhealthyError):
+        return "proxy_unhealthy"
+    # ответ самого шлюза SOAX: неверный логин/пароль или кончился трафик
+    if http_status == 407:
+        return "proxy_auth_error"
     if exc:
         s = str(exc).lower()
+        if "tunnel connection failed: 407" in s or "proxy authentication required" in s \
+                or ("socks" in s and "auth" in s):
+            return "proxy_auth_error"
+        # только сигналы самого шлюза: 402 на CONNECT или его фраза об исчерпанном трафике
+        # в ошибке прокси (текст ошибок сайта/TLS/HTTP-библиотек сюда не попадает)
+        if "tunnel connection failed: 402" in s \
+                or (is_proxy_fault(exc) and _GATEWAY_QUOTA_RE.search(s)):
+            return "proxy_quota_exceeded"
         if "name or service not known" in s or "nodename nor servname" in s or "dns" in s:
             return "dns_error"
         if "timed out" in s or "timeout" in s:
@@ -180,13 +200,15 @@ def execute_check(run_params: dict[str, Any]) -> dict:
                 screenshot_semaphore = threading.Semaphore(max_workers)
     # end semaphore init
 
+    # persist=False (мониторинг): .md-карточка не пишется, скриншоты тоже не делаются
+    persist = run_params.get("persist", True)
     logs_dir = cfg.paths.logs_dir
-    day_dir = ensure_day_dir(logs_dir)
-
-    target_dir = day_dir
-    if run_params.get("subfolder"):
-        target_dir = os.path.join(day_dir, run_params["subfolder"])
-        os.makedirs(target_dir, exist_ok=True)
+    target_dir = None
+    if persist:
+        target_dir = ensure_day_dir(logs_dir)
+        if run_params.get("subfolder"):
+            target_dir = os.path.join(target_dir, run_params["subfolder"])
+            os.makedirs(target_dir, exist_ok=True)
 
     run_id_for_log = run_params.get('run_id', 'NO_RUN_ID')
     url = run_params["url"]
@@ -194,7 +216,7 @@ def execute_check(run_params: dict[str, Any]) -> dict:
     log.debug(f"[{run_id_for_log}] execute_check started for {url}")
 
     timeout_sec = run_params["timeout_sec"]
-    make_screenshot = run_params["make_screenshot"]
+    make_screenshot = run_params["make_screenshot"] and persist
     debug_mode = run_params.get("debug_mode", False)
     dns_mode = run_params.get("dns_mode", "proxy")
 
@@ -208,10 +230,11 @@ def execute_check(run_params: dict[str, Any]) -> dict:
         # Стандартный режим (если гео не передано явно): 01-17-56_domain.com
         base_name = f"{ts}_{domain}"
 
-    md_path = unique_file_path(target_dir, base_name, "md")
+    md_path = unique_file_path(target_dir, base_name, "md") if persist else None
     png_path = None
 
     ps = None
+    hkey = None
     debug_data = None
     http_status = None
     bytes_count = None
@@ -226,7 +249,14 @@ def execute_check(run_params: dict[str, Any]) -> dict:
         ps = get_session(run_params)
         debug_data = ps.debug_info
 
+        hkey = health_key(ps.host, ps.port, run_params)
+        if not ProxyHealth.allow(hkey):
+            raise ProxyUnhealthyError(f"proxy exit {ps.host}:{ps.port} [{geo or '-'}] is unhealthy (circuit open), check skipped")
+
         proxies = _requests_proxies(ps, dns_mode)
+        if ps.session_id and cfg.proxy.exit_ip_lookup:
+            # для sticky-сессии exit один на весь TTL - узнаём его один раз
+            ExitInfoCache.resolve(ps, proxies, min(timeout_sec, 10))
         log.debug(f"[{run_id_for_log}] Calling _measure_http for {url}...")
         http_status, bytes_count, redirects, timings, sent_headers = _measure_http(url_full, proxies, timeout_sec)
     except Exception as e:
@@ -244,50 +274,74 @@ def execute_check(run_params: dict[str, Any]) -> dict:
     result = _classify(exc, http_status, timeout_sec)
     log.debug(f"[{run_id_for_log}] Result for {url}: {result}")
 
-    # логика скриншота, с семафором
-    if make_screenshot and result == "success":
-        png_path = unique_file_path(target_dir, base_name, "png")
-        screenshot_timeout = timeout_sec + cfg.screenshots.wait_after_load_sec + 5
-
-        log.info(f"Acquiring screenshot semaphore for {url}...")
-        with screenshot_semaphore:
-            log.info(f"[{run_id_for_log}] Semaphore acquired for {url}. Taking screenshot...")
-            ok, s_err = _take_screenshot(
-                ps, url_full, png_path, screenshot_timeout,
-                cfg.screenshots.width, cfg.screenshots.height
-            )
-            log.info(f"[{run_id_for_log}] Semaphore released for {url}.")
-
-        if not ok:
-            png_path = None  # don't link to failed screenshot !!!
-            if notes:
-                notes += f" | screenshot: {s_err}"
-            else:
-                notes = f"screenshot: {s_err}"
-
-    geo_str = f"{run_params.get('country') or '-'} / {run_params.get('region_code') or '(any)'} / {run_params.get('city') or '(any)'} / ISP: {run_params.get('isp') or '(any)'}"
-    proxy_str = f"SOAX Port-Mode, ext_ip: {ps.ext_ip if ps else '-'}"
-    md_text = render_md_card(
-        domain=domain,
-        started=datetime.now().isoformat(timespec="seconds"),
-        geo_str=geo_str,
-        proxy_str=proxy_str,
-        dns_mode=dns_mode,
-        timeout_sec=timeout_sec,
-        url_show=url_full,
-        redirects=redirects,
-        timings=timings,
-        http_status=http_status,
-        bytes_count=bytes_count,
-        result=result,
-        screenshot_name=os.path.basename(png_path) if png_path else None,
-        notes=notes,
-        debug_info=debug_data if debug_mode else None
-    )
-
-    log.debug(f"[{run_id_for_log}] Writing .md log for {url} to {md_path}")
-    with open(md_path, "w", encoding="utf-8") as f:
-        f.write(md_text)
+    try:
+        geo_mismatch = bool(ps and ps.ext_country and geo and ps.ext_country != geo.lower())
+        if geo_mismatch:
+            mismatch_note = f"exit country {ps.ext_country.upper()} != requested {geo.upper()}"
+            notes = f"{notes} | {mismatch_note}" if notes else mismatch_note
+
+        if hkey is not None and result != "proxy_unhealthy":
+            # в breaker идут только ошибки самого прокси, блокировки сайта - нет
+            outcome = "proxy_error" if result in ("connect_error", "timeout") and is_proxy_fault(exc) else result
+            ProxyHealth.record(hkey, outcome, timings.get("ttfb_ms"))
+
+        # sticky exit мог пропасть - следующая проверка этого гео возьмёт новую сессию
+        if ps and ps.session_id and exc is not None and result == "connect_error":
+            invalidate_session(ps)
+
+        # логика скриншота, с семафором
+        if make_screenshot and result == "success":
+            png_path = unique_file_path(target_dir, base_name, "png")
+            screenshot_timeout = timeout_sec + cfg.screenshots.wait_after_load_sec + 5
+
+            log.info(f"Acquiring screenshot semaphore for {url}...")
+            with screenshot_semaphore:
+                log.info(f"[{run_id_for_log}] Semaphore acquired for {url}. Taking screenshot...")
+                ok, s_err = _take_screenshot(
+                    ps, url_full, png_path, screenshot_timeout,
+                    cfg.screenshots.width, cfg.screenshots.height
+                )
+                log.info(f"[{run_id_for_log}] Semaphore released for {url}.")
+
+            if not ok:
+                png_path = None  # don't link to failed screenshot !!!
+                if notes:
+                    notes += f" | screenshot: {s_err}"
+                else:
+                    notes = f"screenshot: {s_err}"
+    finally:
+        # порт из диапазона (и его слот max_inflight) держим, пока через прокси идёт
+        # любой трафик проверки - HTTP-замер и скриншот
+        if ps:
+            release_session(ps)
+
+    if persist:
+        geo_str = f"{run_params.get('country') or '-'} / {run_params.get('region_code') or '(any)'} / {run_params.get('city') or '(any)'} / ISP: {run_params.get('isp') or '(any)'}"
+        proxy_mode = f"Sticky session {ps.session_id}" if ps and ps.session_id else "Port-Mode"
+        proxy_str = f"SOAX {proxy_mode}, ext_ip: {ps.ext_ip if ps and ps.ext_ip else '-'}"
+        if ps and ps.ext_country:
+            proxy_str += f" ({ps.ext_country.upper()})"
+        md_text = render_md_card(
+            domain=domain,
+            started=datetime.now().isoformat(timespec="seconds"),
+            geo_str=geo_str,
+            proxy_str=proxy_str,
+            dns_mode=dns_mode,
+            timeout_sec=timeout_sec,
+            url_show=url_full,
+            redirects=redirects,
+            timings=timings,
+            http_status=http_status,
+            bytes_count=bytes_count,
+            result=result,
+            screenshot_name=os.path.basename(png_path) if png_path else None,
+            notes=notes,
+            debug_info=debug_data if debug_mode else None
+        )
+
+        log.debug(f"[{run_id_for_log}] Writing .md log for {url} to {md_path}")
+        with open(md_path, "w", encoding="utf-8") as f:
+            f.write(md_text)
 
     return {
         "classification": result,
@@ -296,6 +350,8 @@ def execute_check(run_params: dict[str, Any]) -> dict:
         "timings": timings,
         "redirects": redirects,
         "proxy_ext_ip": ps.ext_ip if ps else None,
+        "proxy_ext_country": ps.ext_country if ps else None,
+        "geo_mismatch": geo_mismatch,
         "md_path": md_path,
         "png_path": png_path,
         "notes": notes
@@ -1,10 +1,14 @@
-import logging, os
+from __future__ import annotations
+import logging, os, sys
 from datetime import datetime
 from logging import Formatter
 from logging import FileHandler
-from flask import Flask, request, Response
+from typing import TYPE_CHECKING
 from config.loader import ConfigStore
 
+if TYPE_CHECKING:  # Flask нужен только веб-приложению, CLI его не импортирует
+    from flask import Flask, Response
+
 _engine_logger = None
 
 
@@ -25,6 +29,8 @@ def setup_loggers(app: Flask):
     Initializes and configures both 'engine' and 'access' loggers
     based on the global config.
     """
+    from flask import request
+
     cfg = ConfigStore.get()
     log_dir = cfg.paths.logs_dir
     os.makedirs(log_dir, exist_ok=True)
@@ -76,3 +82,21 @@ def setup_loggers(app: Flask):
         return response
 
     engine_logger.info(f"Loggers initialized. Engine log level set to {log_level_str}.")
+
+
+def setup_cli_logger(level: str | None = None):
+    """
+    Logger setup for the headless CLI (run_engine.py): engine log goes to stderr,
+    so stdout stays clean for NDJSON/CSV results.
+    """
+    cfg = ConfigStore.get()
+    log_level_str = (level or cfg.logging.level).upper()
+
+    engine_logger = get_engine_logger()
+    engine_logger.setLevel(getattr(logging, log_level_str, logging.INFO))
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(Formatter("%(asctime)s [%(levelname)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+    engine_logger.addHandler(handler)
+    engine_logger.propagate = False
+
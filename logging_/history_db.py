@@ -0,0 +1,140 @@
+from __future__ import annotations
+import os, sqlite3, threading, time
+import urllib.parse
+from typing import Any, Dict, List
+from config.loader import ConfigStore
+from logging_.engine_logger import get_engine_logger
+
+log = get_engine_logger()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id        INTEGER PRIMARY KEY,
+    run_id    TEXT NOT NULL,
+    kind      TEXT,
+    ts        REAL NOT NULL,
+    url       TEXT NOT NULL,
+    host      TEXT,
+    country   TEXT,
+    result    TEXT,
+    http_code INTEGER,
+    ttfb_ms   INTEGER,
+    ext_ip    TEXT,
+    md_name   TEXT,
+    png_name  TEXT,
+    notes     TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_results_url_country_ts ON results(url, country, ts);
+CREATE INDEX IF NOT EXISTS idx_results_host_country_ts ON results(host, country, ts);
+CREATE INDEX IF NOT EXISTS idx_results_country_result_ts ON results(country, result, ts);
+CREATE INDEX IF NOT EXISTS idx_results_result_ts ON results(result, ts);
+CREATE INDEX IF NOT EXISTS idx_results_ts ON results(ts);
+CREATE INDEX IF NOT EXISTS idx_results_run_id ON results(run_id);
+"""
+
+_COLUMNS = ("run_id", "kind", "ts", "url", "host", "country", "result",
+            "http_code", "ttfb_ms", "ext_ip", "md_name", "png_name", "notes")
+
+
+def _db_path() -> str:
+    path = os.path.join(ConfigStore.get().paths.data_dir, "history")
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, "results.db")
+
+
+def _host_of(url: str) -> str:
+    """domain.com/path -> domain.com (для запросов "по зеркалу")."""
+    parse_url = url if "://" in url else f"http://{url}"
+    try:
+        return urllib.parse.urlsplit(parse_url).netloc.lower()
+    except ValueError:
+        return url.lower()
+
+
+class HistoryStore:
+    """
+    Embedded SQLite history of every check row.
+    One connection per thread (sqlite3 objects can't be shared), WAL mode
+    so several gunicorn workers can write and read concurrently.
+    """
+    _local = threading.local()
+    _init_lock = threading.Lock()
+    _initialized_path: str | None = None
+
+    @classmethod
+    def _conn(cls) -> sqlite3.Connection:
+        path = _db_path()
+        conn = getattr(cls._local, "conn", None)
+        if conn is not None and getattr(cls._local, "path", None) == path:
+            return conn
+
+        conn = sqlite3.connect(path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with cls._init_lock:
+            if cls._initialized_path != path:
+                conn.executescript(_SCHEMA)
+                cls._initialized_path = path
+        cls._local.conn = conn
+        cls._local.path = path
+        return conn
+
+    @classmethod
+    def record_row(cls, run_id: str, kind: str, row: dict):
+        """Stores one check row. Errors are logged, never raised into the engine."""
+        url = row.get("url") or ""
+        values = (
+            run_id, kind, time.time(), url, _host_of(url),
+            (row.get("country") or "").lower() or None,
+            row.get("result"), row.get("http_code"), row.get("ttfb_ms"),
+            row.get("ext_ip"), row.get("md_name"), row.get("png_name"), row.get("notes"),
+        )
+        try:
+            conn = cls._conn()
+            with conn:
+                conn.execute(
+                    f"INSERT INTO results ({', '.join(_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' for _ in _COLUMNS)})",
+                    values
+                )
+        except Exception as e:
+            log.error(f"[{run_id}] Failed to write history row for {url}: {e}")
+
+    @classmethod
+    def query(cls, url: str | None = None, host: str | None = None,
+              country: str | None = None, result: str | None = None,
+              failed: bool = False, run_id: str | None = None,
+              since: float | None = None, until: float | None = None,
+              limit: int = 500) -> List[Dict[str, Any]]:
+        """
+        Filters history rows. All filters are optional and AND-ed.
+        `failed=True` means "everything except success".
+        Newest rows first.
+        """
+        where, args = [], []
+        if url:
+            where.append("url = ?"); args.append(url)
+        if host:
+            where.append("host = ?"); args.append(host.lower())
+        if country:
+            where.append("country = ?"); args.append(country.lower())
+        if result:
+            where.append("result = ?"); args.append(result)
+        elif failed:
+            where.append("result != 'success'")
+        if run_id:
+            where.append("run_id = ?"); args.append(run_id)
+        if since is not None:
+            where.append("ts >= ?"); args.append(since)
+        if until is not None:
+            where.append("ts < ?"); args.append(until)
+
+        sql = f"SELECT {', '.join(_COLUMNS)} FROM results"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ts DESC LIMIT ?"
+        args.append(limit)
+
+        rows = cls._conn().execute(sql, args).fetchall()
+        return [dict(r) for r in rows]
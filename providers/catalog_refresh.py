@@ -0,0 +1,185 @@
+from __future__ import annotations
+import json, os, threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from datetime import datetime
+from typing import Any, Dict, List
+from config.loader import ConfigStore
+from logging_.engine_logger import get_engine_logger
+from engine.filelock import file_lock
+from engine.ratelimit import TokenBucket
+from .soax import CatalogStore, _normalize_cities, _normalize_isps, _normalize_regions
+from .soax_api import SoaxApiClient
+
+log = get_engine_logger()
+
+
+def _progress_path() -> str:
+    path = os.path.join(ConfigStore.get().paths.data_dir, "catalog")
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, "soax_geo_refresh.json")
+
+
+class CatalogRefresher:
+    """
+    Обновление гео-каталога из SOAX API: страны параллельно (catalog_refresh.concurrency),
+    все запросы к API - через общий token bucket (catalog_refresh.rate_per_sec).
+    Страна, у которой regions/cities/isps не изменились, не трогается; если не
+    изменилось ничего, файл не перезаписывается и версия не растёт.
+    Один refresh на все воркеры (файловая блокировка soax_geo_refresh.lock). Под ней же
+    прогресс и события пишутся в catalog/soax_geo_refresh.json, поэтому статус и
+    поток /events/catalog отдаёт любой воркер.
+    """
+    _lock = threading.Lock()
+    _progress: Dict[str, Any] = {}  # прогресс текущего refresh этого воркера (пишет только он)
+
+    @classmethod
+    def status(cls) -> dict:
+        """Прогресс последнего refresh (из файла). running=False, если его воркер умер, не закончив."""
+        try:
+            with open(_progress_path(), "r", encoding="utf-8") as f:
+                st = json.load(f)
+        except FileNotFoundError:
+            return {"running": False, "events": []}
+        except Exception as e:
+            log.error(f"Failed to read catalog refresh progress: {e}")
+            return {"running": False, "events": []}
+        if st.get("running"):
+            with file_lock("soax_geo_refresh.lock", blocking=False) as acquired:
+                if acquired:
+                    st["running"] = False
+                    st["error"] = "refresh was interrupted"
+        return st
+
+    @classmethod
+    def start(cls, countries: List[str] | None = None) -> bool:
+        """Запускает обновление в фоне (все страны или только `countries`). False, если уже идёт в любом воркере."""
+        with cls._lock:
+            guard = ExitStack()
+            if not guard.enter_context(file_lock("soax_geo_refresh.lock", blocking=False)):
+                guard.close()
+                return False
+            cls._progress = {"id": uuid.uuid4().hex[:12], "running": True, "countries": countries,
+                             "started_at": time.time(), "events": []}
+            try:
+                cls._save_progress()
+            except Exception:
+                guard.close()
+                raise
+        # блокировка переходит потоку refresh и отпускается, когда он закончит
+        threading.Thread(target=cls._run, args=(countries, guard), daemon=True).start()
+        return True
+
+    @classmethod
+    def _save_progress(cls):
+        tmp = f"{_progress_path()}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(cls._progress, f, ensure_ascii=False)
+        os.replace(tmp, _progress_path())
+
+    @classmethod
+    def _event(cls, payload: dict, **state):
+        """Обновляет счётчики и дописывает событие в файл прогресса."""
+        cls._progress.update(state)
+        cls._progress["events"].append(payload)
+        cls._save_progress()
+
+    @classmethod
+    def _run(cls, countries: List[str] | None, guard: ExitStack):
+        with guard:
+            try:
+                cls._refresh(countries)
+            except Exception as e:
+                log.error(f"Catalog refresh failed: {e}", exc_info=True)
+                cls._event({"type": "catalog_refresh_failed", "error": str(e)}, error=str(e))
+            finally:
+                cls._progress.update({"running": False, "finished_at": time.time()})
+                try:
+                    cls._save_progress()
+                except Exception as e:
+                    log.error(f"Failed to save catalog refresh progress: {e}")
+
+    @classmethod
+    def _fetch(cls, api: SoaxApiClient, bucket: TokenBucket, code: str) -> Dict[str, list]:
+        """Свежие regions/cities/isps страны; поле, которое API не отдал, отсутствует."""
+        conn_type = ConfigStore.get().catalog_refresh.conn_type
+        calls = {
+            "regions": (lambda: api.get_regions(code, conn_type), _normalize_regions),
+            "cities": (lambda: api.get_cities(code, conn_type=conn_type), _normalize_cities),
+            "isps": (lambda: api.get_isps(code), _normalize_isps),
+        }
+        fresh = {}
+        for name, (call, normalize) in calls.items():
+            bucket.acquire()
+            raw = call()
+            if raw is not None:
+                fresh[name] = normalize(raw)
+        return fresh
+
+    @classmethod
+    def _refresh(cls, countries: List[str] | None):
+        api = SoaxApiClient()
+        if not api.is_configured():
+            raise RuntimeError("SOAX_API_KEY or SOAX_PACKAGE_KEY not set")
+
+        known = {c.get("code"): c for c in CatalogStore.load().get("countries", []) if c.get("code")}
+        codes = [c for c in (countries or list(known)) if c in known]
+        if not codes:
+            raise RuntimeError("no countries to refresh (soax_geo.json is empty or codes are unknown)")
+
+        rc = ConfigStore.get().catalog_refresh
+        started = time.time()
+        log.info(f"Catalog refresh started: {len(codes)} countries, "
+                 f"{rc.concurrency} in parallel at {rc.rate_per_sec} req/s.")
+        cls._event({"type": "catalog_refresh_started", "total": len(codes)},
+                   total=len(codes), done=0, changed=0, failed=0)
+
+        bucket = TokenBucket(rc.rate_per_sec, burst=max(1, rc.concurrency))
+        changes: Dict[str, Dict[str, list]] = {}
+        with ThreadPoolExecutor(max_workers=max(1, rc.concurrency), thread_name_prefix="catalog") as pool:
+            futures = {pool.submit(cls._fetch, api, bucket, code): code for code in codes}
+            for fut in as_completed(futures):
+                code = futures[fut]
+                error = None
+                try:
+                    fresh = fut.result()
+                except Exception as e:
+                    fresh, error = {}, str(e)
+                    log.error(f"Catalog refresh for {code} failed: {e}")
+                if not fresh and error is None:
+                    error = "SOAX API returned no data"
+                diff = {k: v for k, v in fresh.items() if known[code].get(k) != v}
+                if diff:
+                    changes[code] = diff
+                # as_completed отдаёт результаты в этом потоке, прогресс пишет только он
+                st = cls._progress
+                cls._event({
+                    "type": "catalog_country_done", "code": code, "changed": sorted(diff),
+                    "error": error, "done": st["done"] + 1, "total": len(codes),
+                }, done=st["done"] + 1, changed=st["changed"] + (1 if diff else 0),
+                   failed=st["failed"] + (1 if error else 0))
+
+        version = cls._apply(changes)
+        st = cls._progress
+        summary = {"total": len(codes), "changed": st["changed"], "failed": st["failed"],
+                   "version": version, "duration_sec": round(time.time() - started, 1)}
+        log.info(f"Catalog refresh finished: {summary}")
+        cls._event({"type": "catalog_refresh_finished", **summary}, version=version)
+
+    @classmethod
+    def _apply(cls, changes: Dict[str, Dict[str, list]]) -> int | None:
+        """Вливает изменения в актуальный каталог (список стран мог поменяться за время refresh)."""
+        if not changes:
+            log.info("Catalog refresh: no changes, soax_geo.json left as is.")
+            return CatalogStore.load().get("version")
+        data = CatalogStore._load_for_update()
+        now = datetime.now().isoformat(timespec="seconds")
+        for country in data.get("countries", []):
+            diff = changes.get(country.get("code"))
+            if diff:
+                country.update(diff)
+                country["updated_at"] = now
+        data["generated_at"] = now
+        data["version"] = data.get("version", 1) + 1
+        CatalogStore.save(data)
+        return data["version"]
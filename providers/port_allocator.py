@@ -0,0 +1,101 @@
+from __future__ import annotations
+import hashlib, threading
+from typing import Callable, Dict, List
+from logging_.engine_logger import get_engine_logger
+
+log = get_engine_logger()
+
+
+def parse_port_range(spec: str | None) -> List[int]:
+    """
+    "9001-9100" / "9001,9005,9010-9020" -> список портов (без дублей, в порядке записи).
+    Пустая строка или None -> [].
+    """
+    ports: List[int] = []
+    for part in (spec or "").replace(" ", "").split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = (int(x) for x in part.split("-", 1))
+            if start > end:
+                start, end = end, start
+            ports.extend(range(start, end + 1))
+        else:
+            ports.append(int(part))
+    return list(dict.fromkeys(ports))
+
+
+class PortAllocator:
+    """
+    Раскидывает проверки Port-mode по диапазону портов шлюза SOAX.
+
+    strategy="hash"         - порт по хэшу ключа (url + гео): повторные проверки
+                              одного и того же идут через один порт;
+    strategy="least_loaded" - порт с наименьшим числом проверок "в полёте".
+
+    max_inflight > 0 ограничивает число одновременных проверок на порт:
+    если все порты заняты, acquire() ждёт освобождения.
+    Порты, для которых `avoid(port)` == True (открытый circuit), пропускаются,
+    пока есть альтернатива.
+    """
+    _inflight: Dict[int, int] = {}
+    _cursor = 0
+    _cond = threading.Condition()
+
+    @classmethod
+    def acquire(cls, ports: List[int], key: str = "", strategy: str = "least_loaded",
+                max_inflight: int = 0, avoid: Callable[[int], bool] | None = None) -> int:
+        if not ports:
+            raise ValueError("PortAllocator.acquire() called with an empty port list")
+
+        healthy = [p for p in ports if not (avoid and avoid(p))] or ports
+        with cls._cond:
+            while True:
+                port = cls._pick(healthy, key, strategy, max_inflight)
+                if port is not None:
+                    cls._inflight[port] = cls._inflight.get(port, 0) + 1
+                    return port
+                cls._cond.wait()
+
+    @classmethod
+    def _pick(cls, ports: List[int], key: str, strategy: str, max_inflight: int) -> int | None:
+        def has_room(p: int) -> bool:
+            return max_inflight <= 0 or cls._inflight.get(p, 0) < max_inflight
+
+        n = len(ports)
+        if strategy == "hash":
+            start = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big") % n
+            # занятый порт -> ближайший следующий свободный
+            for i in range(n):
+                p = ports[(start + i) % n]
+                if has_room(p):
+                    return p
+            return None
+
+        # least_loaded; при равной загрузке идём по кругу, чтобы не долбить первый порт
+        best, best_load = None, None
+        for i in range(n):
+            p = ports[(cls._cursor + i) % n]
+            load = cls._inflight.get(p, 0)
+            if has_room(p) and (best_load is None or load < best_load):
+                best, best_load = p, load
+                if load == 0:
+                    break
+        if best is not None:
+            cls._cursor = (ports.index(best) + 1) % n
+        return best
+
+    @classmethod
+    def release(cls, port: int):
+        with cls._cond:
+            left = cls._inflight.get(port, 0) - 1
+            if left > 0:
+                cls._inflight[port] = left
+            else:
+                cls._inflight.pop(port, None)
+            cls._cond.notify()
+
+    @classmethod
+    def inflight(cls) -> Dict[int, int]:
+        with cls._cond:
+            return dict(cls._inflight)
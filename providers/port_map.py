@@ -0,0 +1,232 @@
+from __future__ import annotations
+import json, os, threading, time
+from datetime import datetime
+from typing import Any, Dict, List
+from config.loader import ConfigStore
+from logging_.engine_logger import get_engine_logger
+from engine.filelock import file_lock
+from engine.ratelimit import TokenBucket
+from .port_allocator import parse_port_range
+from .soax_probe import probe
+
+log = get_engine_logger()
+
+# как часто (в результатах) сбрасывать промежуточный map на диск во время обхода
+_FLUSH_EVERY = 200
+
+
+def _catalog_dir() -> str:
+    path = os.path.join(ConfigStore.get().paths.data_dir, "catalog")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _map_path() -> str:
+    return os.path.join(_catalog_dir(), "port_map.json")
+
+
+class PortMapStore:
+    """
+    Карта порт -> exit (`<data_dir>/catalog/port_map.json`):
+    {"updated_at": ..., "ports": {"9001": {ip, country, latency_ms, ok, last_seen, last_probe, error, fails}}}
+    Читается с диска только при изменении mtime (файл пишет любой воркер).
+    """
+    _data: dict | None = None
+    _mtime: float = 0.0
+    _lock = threading.Lock()
+
+    @classmethod
+    def load(cls) -> dict:
+        path = _map_path()
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return {"updated_at": None, "ports": {}}
+        with cls._lock:
+            if cls._data is None or mtime != cls._mtime:
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        cls._data = json.load(f)
+                    cls._mtime = mtime
+                except Exception as e:
+                    log.error(f"Failed to load port map {path}: {e}")
+                    return cls._data or {"updated_at": None, "ports": {}}
+            return cls._data
+
+    @classmethod
+    def merge(cls, updates: Dict[str, dict]):
+        """Вливает результаты проб в файл (read-modify-write под файловой блокировкой)."""
+        if not updates:
+            return
+        path = _map_path()
+        with file_lock("port_map.lock"):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                data = {"ports": {}}
+            except Exception as e:
+                log.error(f"Port map {path} is unreadable, starting a new one: {e}")
+                data = {"ports": {}}
+            data["ports"].update(updates)
+            data["updated_at"] = datetime.now().isoformat(timespec="seconds")
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, path)
+
+    @classmethod
+    def entries(cls, country: str | None = None, ok_only: bool = False) -> List[dict]:
+        out = []
+        for port, e in cls.load().get("ports", {}).items():
+            if country and e.get("country") != country.lower():
+                continue
+            if ok_only and not e.get("ok"):
+                continue
+            out.append({"port": int(port), **e})
+        out.sort(key=lambda e: e["port"])
+        return out
+
+    @classmethod
+    def ports_for(cls, country: str | None, max_age_sec: int) -> List[int]:
+        """Порты с живым exit'ом в нужной стране (свежие), быстрые первыми."""
+        now = time.time()
+        cc = (country or "").lower()
+        good = [
+            (e.get("latency_ms") or 0, int(port))
+            for port, e in cls.load().get("ports", {}).items()
+            if e.get("ok") and (not cc or e.get("country") == cc)
+            and now - (e.get("last_seen") or 0) <= max_age_sec
+        ]
+        good.sort()
+        return [p for _lat, p in good]
+
+
+def _updated_entry(prev: dict | None, res: Dict[str, Any], now: float) -> dict:
+    prev = prev or {}
+    if res["ok"]:
+        return {"ip": res["ip"], "country": res["country"], "latency_ms": res["latency_ms"],
+                "ok": True, "last_seen": now, "last_probe": now, "error": None, "fails": 0}
+    return {**prev, "ok": False, "last_probe": now, "error": res["error"],
+            "fails": prev.get("fails", 0) + 1}
+
+
+class PortMapSweeper:
+    """
+    Фоновый обход диапазона портов с ограничением скорости (token bucket).
+    Одновременно идёт только один обход на все gunicorn-воркеры (файловая блокировка).
+    """
+    _state: Dict[str, Any] = {"running": False}
+    _lock = threading.Lock()
+    _periodic_started = False
+
+    @classmethod
+    def status(cls) -> dict:
+        with cls._lock:
+            return dict(cls._state)
+
+    @classmethod
+    def _begin(cls) -> bool:
+        with cls._lock:
+            if cls._state.get("running"):
+                return False
+            cls._state = {"running": True}
+            return True
+
+    @classmethod
+    def start(cls, ports: List[int] | None = None) -> bool:
+        """Запускает обход в фоне. False, если обход уже идёт в этом процессе."""
+        if not cls._begin():
+            return False
+        threading.Thread(target=cls._run, args=(ports,), daemon=True).start()
+        return True
+
+    @classmethod
+    def start_periodic(cls):
+        """Периодический обход раз в port_map.interval_sec (0 - только вручную)."""
+        with cls._lock:
+            if cls._periodic_started or ConfigStore.get().port_map.interval_sec <= 0:
+                return
+            cls._periodic_started = True
+
+        def loop():
+            while True:
+                interval = ConfigStore.get().port_map.interval_sec
+                data = PortMapStore.load()
+                last = max((e.get("last_probe") or 0 for e in data.get("ports", {}).values()), default=0)
+                if time.time() - last >= interval and cls._begin():
+                    cls._run(None)
+                time.sleep(max(60, interval // 10))
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    @classmethod
+    def _run(cls, ports: List[int] | None):
+        try:
+            with file_lock("port_map_sweep.lock", blocking=False) as acquired:
+                if not acquired:
+                    log.info("[port-map] Sweep already running in another worker, skipped.")
+                    return
+                cls._sweep(ports)
+        except Exception as e:
+            log.error(f"[port-map] Sweep failed: {e}", exc_info=True)
+        finally:
+            with cls._lock:
+                cls._state["running"] = False
+                cls._state["finished_at"] = time.time()
+
+    @classmethod
+    def _sweep(cls, ports: List[int] | None):
+        cfg = ConfigStore.get()
+        pm = cfg.port_map
+        if ports is None:
+            ports = parse_port_range(pm.port_range or cfg.soax.port_range)
+        if not ports:
+            log.warning("[port-map] No port range configured (port_map.port_range / SOAX_PORT_RANGE).")
+            return
+        if not cfg.soax.port_login:
+            log.warning("[port-map] SOAX_PORT_LOGIN is not set, sweep skipped.")
+            return
+
+        with cls._lock:
+            cls._state.update({"total": len(ports), "done": 0, "ok": 0, "started_at": time.time()})
+        log.info(f"[port-map] Sweep started: {len(ports)} ports at {pm.rate_per_sec}/s.")
+
+        bucket = TokenBucket(pm.rate_per_sec, burst=max(1, pm.concurrency))
+        it = iter(ports)
+        it_lock = threading.Lock()
+        known = PortMapStore.load().get("ports", {})
+        updates: Dict[str, dict] = {}
+        upd_lock = threading.Lock()
+
+        def worker():
+            while True:
+                with it_lock:
+                    port = next(it, None)
+                if port is None:
+                    return
+                bucket.acquire()
+                proxy = f"http://{cfg.soax.port_login}:{pm.probe_password}@{cfg.soax.host}:{port}"
+                res = probe(proxy, port, pm.timeout_sec, reuse=False)  # каждый порт - один раз за обход
+                key = str(port)
+                batch = None
+                with upd_lock:
+                    updates[key] = _updated_entry(known.get(key), res, time.time())
+                    if len(updates) >= _FLUSH_EVERY:
+                        batch = dict(updates)
+                        updates.clear()
+                with cls._lock:
+                    cls._state["done"] += 1
+                    cls._state["ok"] += 1 if res["ok"] else 0
+                if batch:
+                    PortMapStore.merge(batch)
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, pm.concurrency))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        PortMapStore.merge(updates)
+
+        st = cls.status()
+        log.info(f"[port-map] Sweep finished: {st.get('ok')}/{st.get('total')} ports with a live exit.")
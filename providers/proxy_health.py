@@ -0,0 +1,181 @@
+from __future__ import annotations
+import threading, time
+import requests
+from collections import deque
+from typing import Any, Deque, Dict, List, Tuple
+from config.loader import ConfigStore
+from logging_.engine_logger import get_engine_logger
+
+log = get_engine_logger()
+
+# исходы, за которые отвечает прокси: ошибка самого шлюза/туннеля (см. is_proxy_fault).
+# connect_error/timeout сайта (блокировка, сброс соединения) - это то, что мы и меряем,
+# на здоровье прокси они не влияют. http_error - ответ сайта, прокси отработал нормально.
+PROXY_FAILURES = frozenset({"proxy_error"})
+PROXY_OK = frozenset({"success", "http_error"})
+
+# признаки ошибки на стороне прокси в тексте исключения requests/urllib3
+_PROXY_FAULT_MARKERS = (
+    "tunnel connection failed", "unable to connect to proxy", "cannot connect to proxy",
+    "error connecting to socks", "socks5 proxy server", "socks4 proxy server",
+)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class ProxyUnhealthyError(Exception):
+    """Circuit для exit'а открыт, проверка не выполнялась."""
+
+
+def is_proxy_fault(exc: Exception | None) -> bool:
+    """True, если запрос не дошёл до сайта по вине прокси (ProxyError, туннель, шлюз недоступен)."""
+    if exc is None:
+        return False
+    if isinstance(exc, requests.exceptions.ProxyError):
+        return True
+    s = str(exc).lower()
+    return any(m in s for m in _PROXY_FAULT_MARKERS)
+
+
+def health_key(host: str, port: int, params: Dict[str, Any]) -> Tuple:
+    """Ключ exit'а: порт шлюза + гео-параметры (без session id - он меняется)."""
+    return (
+        host, int(port),
+        params.get("connection_type", "wifi"),
+        (params.get("country") or "").lower(),
+        params.get("region_code") or "",
+        params.get("city") or "",
+        params.get("isp") or "",
+    )
+
+
+class _Exit:
+    __slots__ = ("outcomes", "errors", "latency_ms", "state", "opened_at",
+                 "cooldown_sec", "probe_started_at")
+
+    def __init__(self, window: int):
+        self.outcomes: Deque[bool] = deque(maxlen=window)
+        self.errors: Dict[str, int] = {}
+        self.latency_ms: float | None = None  # EWMA по ttfb успешных ответов
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.cooldown_sec = 0.0
+        self.probe_started_at: float | None = None
+
+
+class ProxyHealth:
+    """
+    Реестр здоровья прокси-exit'ов (порт + гео) с circuit breaker'ом.
+
+    closed    - всё ок, считаем скользящий success rate по последним `window` исходам;
+    open      - exit больной, проверки сразу получают `proxy_unhealthy`;
+    half_open - после cooldown пропускаем одну пробную проверку:
+                успех -> closed, ошибка -> снова open с удвоенным cooldown.
+
+    Состояние живёт в памяти процесса (у каждого gunicorn-воркера своё).
+    """
+    _exits: Dict[Tuple, _Exit] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def allow(cls, key: Tuple) -> bool:
+        cfg = ConfigStore.get().proxy_health
+        if not cfg.enabled:
+            return True
+        now = time.time()
+        with cls._lock:
+            ex = cls._exits.get(key)
+            if ex is None or ex.state == CLOSED:
+                return True
+            if ex.state == OPEN:
+                if now - ex.opened_at < ex.cooldown_sec:
+                    return False
+                ex.state = HALF_OPEN
+                ex.probe_started_at = None
+            # half_open: одна пробная проверка за раз (зависшая проба не блокирует навсегда)
+            if ex.probe_started_at is None or now - ex.probe_started_at > ex.cooldown_sec:
+                ex.probe_started_at = now
+                log.info(f"[proxy-health] Half-open probe for {key}.")
+                return True
+            return False
+
+    @classmethod
+    def record(cls, key: Tuple, classification: str, latency_ms: int | None = None):
+        cfg = ConfigStore.get().proxy_health
+        if not cfg.enabled:
+            return
+        if classification in PROXY_OK:
+            ok = True
+        elif classification in PROXY_FAILURES:
+            ok = False
+        else:
+            return  # ошибки на стороне сайта (dns/tls/блокировка) про прокси ничего не говорят
+
+        now = time.time()
+        with cls._lock:
+            ex = cls._exits.get(key)
+            if ex is None:
+                ex = cls._exits[key] = _Exit(cfg.window)
+            ex.outcomes.append(ok)
+            if ok:
+                if latency_ms is not None:
+                    ex.latency_ms = latency_ms if ex.latency_ms is None else 0.8 * ex.latency_ms + 0.2 * latency_ms
+            else:
+                ex.errors[classification] = ex.errors.get(classification, 0) + 1
+
+            if ex.state == HALF_OPEN:
+                if ok:
+                    ex.state = CLOSED
+                    ex.outcomes.clear()
+                    ex.outcomes.append(True)
+                    ex.cooldown_sec = 0.0
+                    log.info(f"[proxy-health] Exit {key} recovered, circuit closed.")
+                else:
+                    cls._open(ex, key, now, min(ex.cooldown_sec * 2, cfg.max_cooldown_sec))
+                ex.probe_started_at = None
+                return
+
+            if ex.state == CLOSED and len(ex.outcomes) >= cfg.min_samples:
+                fail_ratio = ex.outcomes.count(False) / len(ex.outcomes)
+                if fail_ratio >= cfg.failure_ratio:
+                    cls._open(ex, key, now, cfg.cooldown_sec)
+
+    @classmethod
+    def _open(cls, ex: _Exit, key: Tuple, now: float, cooldown: float):
+        ex.state = OPEN
+        ex.opened_at = now
+        ex.cooldown_sec = cooldown
+        log.warning(f"[proxy-health] Circuit OPEN for {key} "
+                    f"({ex.outcomes.count(False)}/{len(ex.outcomes)} failed, cooldown {int(cooldown)}s).")
+
+    @classmethod
+    def is_open(cls, key: Tuple) -> bool:
+        """
+        True, если allow() сейчас отказал бы (для выбора альтернативного порта).
+        Exit с истёкшим cooldown считается доступным - туда уйдёт пробная проверка.
+        """
+        now = time.time()
+        with cls._lock:
+            ex = cls._exits.get(key)
+            if ex is None or ex.state == CLOSED:
+                return False
+            if ex.state == OPEN:
+                return now - ex.opened_at < ex.cooldown_sec
+            return ex.probe_started_at is not None and now - ex.probe_started_at <= ex.cooldown_sec
+
+    @classmethod
+    def snapshot(cls) -> List[dict]:
+        with cls._lock:
+            out = []
+            for key, ex in cls._exits.items():
+                n = len(ex.outcomes)
+                out.append({
+                    "host": key[0], "port": key[1], "connection_type": key[2],
+                    "country": key[3], "region": key[4], "city": key[5], "isp": key[6],
+                    "state": ex.state,
+                    "samples": n,
+                    "success_rate": round(ex.outcomes.count(True) / n, 3) if n else None,
+                    "latency_ms": int(ex.latency_ms) if ex.latency_ms is not None else None,
+                    "errors": dict(ex.errors),
+                })
+            return out
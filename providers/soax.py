@@ -1,15 +1,25 @@
 from __future__ import annotations
-import os, json, time
+import copy, os, json, time, threading, uuid
+import requests
 from dataclasses import dataclass, field
 from typing import Any, Dict, List
 from datetime import datetime
+from types import MappingProxyType
 from config.loader import ConfigStore
+from engine.filelock import file_lock
 from logging_.engine_logger import get_engine_logger
 from .soax_api import SoaxApiClient
+from .port_allocator import PortAllocator, parse_port_range
+from .proxy_health import ProxyHealth, health_key
+from .soax_probe import IPINFO_URL
+from .port_map import PortMapStore
 
 log = get_engine_logger()
 CATALOG_PATH = None
 
+# если определить exit не удалось, повторяем не раньше чем через столько секунд
+_EXIT_LOOKUP_RETRY_SEC = 30
+
 
 def _catalog_path() -> str:
     """Gets the path to the geo catalog, respecting config."""
@@ -61,63 +71,264 @@ def _normalize_isps(api_isps: List[str]) -> List[str]:
     return [isp for isp in api_isps if isinstance(isp, str)]
 
 
-class CatalogStore:
-    _cache: dict | None = None
+class CatalogSnapshot:
+    """
+    Неизменяемый снимок soax_geo.json с индексами по коду страны.
+    Снимок не мутируется: save() и перечитывание файла подменяют его целиком,
+    поэтому читатели работают без блокировок. Списки - кортежи; сами записи
+    (dict) разделяются между запросами, менять их нельзя.
+    """
+    __slots__ = ("data", "countries", "regions", "cities", "region_cities", "isps")
+
+    def __init__(self, data: dict):
+        self.data = data
+        countries, regions, cities, region_cities, isps = [], {}, {}, {}, {}
+        for c in data.get("countries", []):
+            code = c.get("code")
+            if not code:
+                continue
+            if c.get("name"):
+                countries.append({"code": code, "name": c["name"]})
+            regions[code] = tuple(c.get("regions") or ())
+            cities[code] = tuple(c.get("cities") or ())
+            isps[code] = tuple(c.get("isps") or ())
+            # города по регионам, если каталог их знает: {"region_cities": {region: [cities]}}
+            for region, items in (c.get("region_cities") or {}).items():
+                region_cities[(code, region)] = tuple(items or ())
+        self.countries = tuple(countries)
+        self.regions = MappingProxyType(regions)
+        self.cities = MappingProxyType(cities)
+        self.region_cities = MappingProxyType(region_cities)
+        self.isps = MappingProxyType(isps)
+
+
+_EMPTY_CATALOG = {"version": 0, "countries": []}
+
+
+def _scoped_path() -> str:
+    return os.path.join(os.path.dirname(_catalog_path()), "soax_geo_scoped.json")
+
+
+class ScopedGeoCache:
+    """
+    Города региона и ISP региона/города (`<data_dir>/catalog/soax_geo_scoped.json`):
+    {"cities": {"kz|almaty": {fetched_at, items}}, "isps": {"kz|almaty|": {...}}}.
+    Запрашиваются у SOAX API лениво - при первом обращении из UI - и живут
+    catalog_refresh.scoped_ttl_sec. Одновременные запросы одного ключа ждут
+    один вызов API. Файл общий для воркеров: перечитывается по mtime,
+    новые записи сливаются под файловой блокировкой.
+    """
+    _data: Dict[str, dict] = {"cities": {}, "isps": {}}
+    _stamp: tuple | None = None
+    _inflight: Dict[tuple, threading.Event] = {}
+    _lock = threading.Lock()
+    _api: SoaxApiClient | None = None
+    _api_version = -1
 
     @classmethod
-    def _load_or_cache(cls, force_reload: bool = False) -> dict:
-        if cls._cache and not force_reload:
-            return cls._cache
+    def _reload(cls):
+        try:
+            st = os.stat(_scoped_path())
+        except FileNotFoundError:
+            return
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == cls._stamp:
+            return
         try:
-            with open(_catalog_path(), "r", encoding="utf-8") as f:
-                cls._cache = json.load(f)
-                return cls._cache
+            with open(_scoped_path(), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            cls._data = {"cities": data.get("cities", {}), "isps": data.get("isps", {})}
+            cls._stamp = stamp
         except Exception as e:
-            log.error(f"Failed to load soax_geo.json from {_catalog_path()}: {e}")
-            return {"version": 0, "countries": []}
+            log.error(f"Failed to load {_scoped_path()}: {e}")
+
+    @classmethod
+    def _store(cls, kind: str, key: str, entry: dict):
+        rc = ConfigStore.get().catalog_refresh
+        path = _scoped_path()
+        with file_lock("soax_geo_scoped.lock"):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                data = {}
+            except Exception as e:
+                log.error(f"{path} is unreadable, starting a new one: {e}")
+                data = {}
+            now = time.time()
+            for k in ("cities", "isps"):
+                data[k] = {ck: e for ck, e in data.get(k, {}).items()
+                           if now - e.get("fetched_at", 0) < rc.scoped_ttl_sec}
+            data[kind][key] = entry
+            if len(data[kind]) > rc.scoped_max_entries:
+                newest = sorted(data[kind].items(), key=lambda kv: kv[1]["fetched_at"])[-rc.scoped_max_entries:]
+                data[kind] = dict(newest)
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, path)
+            st = os.stat(path)
+        with cls._lock:
+            cls._data, cls._stamp = {"cities": data["cities"], "isps": data["isps"]}, (st.st_mtime_ns, st.st_size)
+
+    @classmethod
+    def _client(cls) -> SoaxApiClient | None:
+        cfg = ConfigStore.get()
+        if not (cfg.soax.api_key and cfg.soax.package_key):
+            return None
+        with cls._lock:
+            # ключи/таймаут могли поменяться через Settings
+            if cls._api is None or cls._api_version != ConfigStore.version():
+                cls._api = SoaxApiClient(timeout=cfg.catalog_refresh.scoped_timeout_sec)
+                cls._api_version = ConfigStore.version()
+            return cls._api
+
+    @classmethod
+    def get(cls, kind: str, scope: tuple) -> list | None:
+        """
+        Список для scope: ("kz", "almaty") для cities, ("kz", "almaty", "almaty") для isps.
+        None - API недоступен и в кэше ничего нет (вызывающий берёт список по стране).
+        """
+        key = "|".join(v or "" for v in scope)
+        ttl = ConfigStore.get().catalog_refresh.scoped_ttl_sec
+        with cls._lock:
+            cls._reload()
+            hit = cls._data[kind].get(key)
+            if hit is not None and time.time() - hit.get("fetched_at", 0) < ttl:
+                return hit["items"]
+            event = cls._inflight.get((kind, key))
+            owner = event is None
+            if owner:
+                event = cls._inflight[(kind, key)] = threading.Event()
+        if not owner:
+            event.wait(ConfigStore.get().catalog_refresh.scoped_timeout_sec * 2)
+            with cls._lock:
+                fresh = cls._data[kind].get(key)
+            return fresh["items"] if fresh is not None else None
+
+        try:
+            items = cls._fetch(kind, scope)
+            if items is None:
+                return hit["items"] if hit is not None else None  # лучше устаревший список, чем по всей стране
+            cls._store(kind, key, {"fetched_at": time.time(), "items": items})
+            log.debug(f"Scoped geo {kind} for {key} fetched: {len(items)} items.")
+            return items
+        except Exception as e:
+            log.error(f"Scoped geo {kind} for {key} failed: {e}")
+            return hit["items"] if hit is not None else None
+        finally:
+            with cls._lock:
+                cls._inflight.pop((kind, key), None)
+            event.set()
+
+    @classmethod
+    def _fetch(cls, kind: str, scope: tuple) -> list | None:
+        api = cls._client()
+        if api is None:
+            return None
+        if kind == "cities":
+            country, region = scope
+            raw = api.get_cities(country, region, conn_type=ConfigStore.get().catalog_refresh.conn_type)
+            return _normalize_cities(raw) if raw is not None else None
+        country, region, city = scope
+        raw = api.get_isps(country, region or None, city or None)
+        return _normalize_isps(raw) if raw is not None else None
+
+
+
+class CatalogStore:
+    """
+    Гео-каталог SOAX (`<data_dir>/catalog/soax_geo.json`).
+    Файл перечитывается только при изменении mtime/размера - save() из любого
+    воркера (атомарно, tmp + os.replace) подхватывают все остальные.
+    """
+    _snapshot: CatalogSnapshot | None = None
+    _stamp: tuple | None = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def snapshot(cls) -> CatalogSnapshot:
+        path = _catalog_path()
+        try:
+            st = os.stat(path)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            stamp = None
+        snap = cls._snapshot
+        if snap is not None and stamp == cls._stamp:
+            return snap
+        with cls._lock:
+            if cls._snapshot is not None and stamp == cls._stamp:
+                return cls._snapshot
+            data = _EMPTY_CATALOG
+            if stamp is not None:
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                except Exception as e:
+                    log.error(f"Failed to load soax_geo.json from {path}: {e}")
+                    if cls._snapshot is not None:
+                        return cls._snapshot  # битый файл - остаёмся на предыдущем снимке
+            cls._snapshot, cls._stamp = CatalogSnapshot(data), stamp
+            return cls._snapshot
+
+    @classmethod
+    def load(cls) -> dict:
+        """Текущий каталог как dict (только для чтения)."""
+        return cls.snapshot().data
+
+    @classmethod
+    def _load_for_update(cls) -> dict:
+        """Глубокая копия каталога для изменения и последующего save()."""
+        return copy.deepcopy(cls.snapshot().data)
 
     @classmethod
     def get_countries(cls) -> list[dict]:
-        data = cls._load_or_cache()
-        return [{"code": c.get("code"), "name": c.get("name")}
-                for c in data.get("countries", [])
-                if c.get("code") and c.get("name")]
+        return list(cls.snapshot().countries)
 
     @classmethod
     def get_regions(cls, country_code: str) -> list[dict]:
-        data = cls._load_or_cache()
-        for c in data.get("countries", []):
-            if c.get("code") == country_code:
-                return c.get("regions", [])
-        return []
+        return list(cls.snapshot().regions.get(country_code, ()))
 
     @classmethod
     def get_cities(cls, country_code: str, region_code: str | None = None) -> list[dict]:
-        data = cls._load_or_cache()
-        for c in data.get("countries", []):
-            if c.get("code") == country_code:
-                return c.get("cities", [])
-        return []
+        """Города страны; с region_code - города региона (каталог, затем ScopedGeoCache/API)."""
+        snap = cls.snapshot()
+        if region_code:
+            scoped = snap.region_cities.get((country_code, region_code))
+            if scoped is None:
+                scoped = ScopedGeoCache.get("cities", (country_code, region_code))
+            if scoped is not None:
+                return list(scoped)
+        return list(snap.cities.get(country_code, ()))
 
     @classmethod
-    def get_isps(cls, country_code: str) -> list[str]:
-        data = cls._load_or_cache()
-        for c in data.get("countries", []):
-            if c.get("code") == country_code:
-                return c.get("isps", [])
-        return []
+    def get_isps(cls, country_code: str, region_code: str | None = None,
+                 city_code: str | None = None) -> list[str]:
+        """ISP страны; с region_code/city_code - ISP региона/города через ScopedGeoCache."""
+        if region_code or city_code:
+            scoped = ScopedGeoCache.get("isps", (country_code, region_code, city_code))
+            if scoped is not None:
+                return list(scoped)
+        return list(cls.snapshot().isps.get(country_code, ()))
 
     @classmethod
     def save(cls, data: dict):
-        """Saves data back to the JSON file."""
+        """Атомарно сохраняет каталог (tmp + os.replace под блокировкой soax_geo.lock)."""
+        path = _catalog_path()
         try:
-            with open(_catalog_path(), "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            cls._cache = None  # Invalidate cache
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with file_lock("soax_geo.lock"):
+                tmp = f"{path}.{os.getpid()}.tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
+                os.replace(tmp, path)
+                st = os.stat(path)
+            with cls._lock:
+                cls._snapshot, cls._stamp = CatalogSnapshot(data), (st.st_mtime_ns, st.st_size)
             log.info("CatalogStore.save() successful.")
         except Exception as e:
-            log.error(f"Failed to save soax_geo.json to {_catalog_path()}: {e}")
-
+            log.error(f"Failed to save soax_geo.json to {path}: {e}")
 
     @classmethod
     def update_country_list(cls, final_codes: list[str]):
@@ -127,7 +338,7 @@ class CatalogStore:
         """
         log.info(f"Updating catalog country list with {len(final_codes)} codes...")
         try:
-            data = cls._load_or_cache(force_reload=True)
+            data = cls._load_for_update()
 
             # Create a lookup map of old data
             old_countries_map = {
@@ -165,108 +376,229 @@ class CatalogStore:
             log.error(f"Failed to run update_country_list: {e}", exc_info=True)
 
 
-    @classmethod
-    def update_catalog_from_api(cls):
-        """
-        Основная логика обновления каталога.
-        Проходит по *существующим* странам в JSON и обновляет их данные.
-        """
-        log.info("Starting SOAX catalog refresh...")
-        api = SoaxApiClient()
-        if not api.is_configured():
-            log.error("Catalog refresh failed: SOAX_API_KEY or SOAX_PACKAGE_KEY not set.")
-            return
+@dataclass
+class ProxySession:
+    type: str
+    host: str
+    port: int
+    username: str
+    password: str
+    session_id: str | None
+    ext_ip: str | None
+    debug_info: Dict[str, Any] = field(default_factory=dict)
+    expires_at: float | None = None
+    sticky_key: tuple | None = None
+    ext_country: str | None = None
+    leased_port: int | None = None  # порт из диапазона, вернуть через release_session()
 
-        data = cls._load_or_cache(force_reload=True)
-        countries_to_update = data.get("countries", [])
-        if not countries_to_update:
-            log.warning("Catalog refresh failed: soax_geo.json is empty or has no countries.")
-            return
 
-        conn_type = "wifi"
+class StickySessionCache:
+    """
+    Sticky session ID на (run_id, гео). Все проверки запуска с одинаковым гео
+    в пределах TTL идут через один и тот же exit IP. Когда до конца сессии
+    остаётся меньше, чем нужно на одну проверку, выдаём новый ID.
+    """
+    _sessions: Dict[tuple, tuple[str, float]] = {}
+    _lock = threading.Lock()
 
-        for country in countries_to_update:
-            code = country.get("code")
-            if not code:
-                continue
+    @classmethod
+    def acquire(cls, key: tuple, ttl_sec: int, min_remaining_sec: float) -> tuple[str, float]:
+        now = time.time()
+        with cls._lock:
+            cur = cls._sessions.get(key)
+            if cur and cur[1] - now > min_remaining_sec:
+                return cur
+
+            session_id = uuid.uuid4().hex[:12]
+            cls._sessions[key] = (session_id, now + ttl_sec)
+            # чистим протухшие сессии (завершённые запуски)
+            for k in [k for k, (_sid, exp) in cls._sessions.items() if exp <= now]:
+                del cls._sessions[k]
+
+        if cur:
+            log.info(f"[{key[0]}] Sticky session {cur[0]} expiring, renewed as {session_id} (ttl {ttl_sec}s).")
+        else:
+            log.info(f"[{key[0]}] New sticky session {session_id} for {key[1:]} (ttl {ttl_sec}s).")
+        return session_id, now + ttl_sec
 
-            log.info(f"Fetching geo data for country: {code}...")
+    @classmethod
+    def invalidate(cls, key: tuple, session_id: str):
+        """Выбрасывает сессию (например, exit IP пропал), следующая проверка получит новую."""
+        with cls._lock:
+            cur = cls._sessions.get(key)
+            if cur and cur[0] == session_id:
+                del cls._sessions[key]
+                log.info(f"[{key[0]}] Sticky session {session_id} invalidated.")
+        ExitInfoCache.forget(session_id)
+
+
+def lookup_exit(proxies: dict, timeout_sec: float) -> tuple[str | None, str | None]:
+    """(ip, country_code) exit'а через SOAX IP-info. (None, None), если не вышло."""
+    try:
+        resp = requests.get(IPINFO_URL, proxies=proxies, timeout=timeout_sec)
+        if resp.ok:
+            data = resp.json().get("data") or {}
+            return data.get("ip"), (data.get("country_code") or "").lower() or None
+        log.warning(f"Exit IP lookup returned HTTP {resp.status_code}")
+    except (requests.exceptions.RequestException, ValueError) as e:
+        log.warning(f"Exit IP lookup failed: {e}")
+    return None, None
 
-            # Получаем регионы
-            api_regions = api.get_regions(code, conn_type)
-            if api_regions is not None:
-                country["regions"] = _normalize_regions(api_regions)
 
-            # Получаем города
-            api_cities = api.get_cities(code, conn_type=conn_type)
-            if api_cities is not None:
-                country["cities"] = _normalize_cities(api_cities)
+class ExitInfoCache:
+    """
+    Exit IP/страна sticky-сессии: определяется один раз на сессию и живёт
+    до её истечения. Параллельные проверки той же сессии ждут первый запрос,
+    а не шлют свои.
+    """
+    _info: Dict[str, tuple[str | None, str | None, float]] = {}  # session_id -> (ip, cc, valid_until)
+    _locks: Dict[str, threading.Lock] = {}
+    _lock = threading.Lock()
 
-            # Получаем ISPs
-            api_isps = api.get_isps(code)
-            if api_isps is not None:
-                country["isps"] = _normalize_isps(api_isps)
+    @classmethod
+    def resolve(cls, ps: ProxySession, proxies: dict, timeout_sec: float):
+        """Заполняет ps.ext_ip / ps.ext_country (только для sticky-сессий)."""
+        if not ps.session_id:
+            return
+        sid = ps.session_id
+        with cls._lock:
+            lock = cls._locks.setdefault(sid, threading.Lock())
+        with lock:
+            now = time.time()
+            cached = cls._info.get(sid)
+            if cached is None or cached[2] <= now:
+                ip, cc = lookup_exit(proxies, timeout_sec)
+                valid_until = ps.expires_at if ip else now + _EXIT_LOOKUP_RETRY_SEC
+                cached = (ip, cc, valid_until or now)
+                with cls._lock:
+                    cls._info[sid] = cached
+                    # чистим сессии, которые уже истекли
+                    for k in [k for k, v in cls._info.items() if v[2] <= now and k != sid]:
+                        cls._info.pop(k, None)
+                        cls._locks.pop(k, None)
+                if ip:
+                    log.info(f"Sticky session {sid} exit: {ip} ({cc or '?'})")
+        ps.ext_ip, ps.ext_country = cached[0], cached[1]
 
-            time.sleep(1.0)
+    @classmethod
+    def forget(cls, session_id: str):
+        with cls._lock:
+            cls._info.pop(session_id, None)
 
-        data["generated_at"] = datetime.now().isoformat(timespec="seconds")
-        data["version"] = data.get("version", 1) + 1
 
-        cls.save(data)
-        log.info("SOAX catalog refresh finished successfully.")
+_sticky_warned = False
 
 
-# функция запуска в фоновом потоке (интересно, взлетит или буду ипацца два дня?) :)
-def refresh_catalog_data():
-    """Точка входа для Thread, вызывает обновление."""
-    try:
-        CatalogStore.update_catalog_from_api()
-    except Exception as e:
-        log.error(f"Unhandled exception in refresh_catalog_data thread: {e}", exc_info=True)
+def _sticky_login(package_id: str, country: str | None, region: str, city: str, isp: str,
+                  session_id: str, ttl_sec: int) -> str:
+    parts = [f"package-{package_id}"]
+    if country:
+        parts.append(f"country-{country}")
+    if region:
+        parts.append(f"region-{region}")
+    if city:
+        parts.append(f"city-{city}")
+    if isp:
+        parts.append(f"isp-{isp}")
+    parts.append(f"sessionid-{session_id}")
+    parts.append(f"sessionlength-{ttl_sec}")
+    return "-".join(parts)
 
 
-@dataclass
-class ProxySession:
-    type: str
-    host: str
-    port: int
-    username: str
-    password: str
-    session_id: str | None
-    ext_ip: str | None
-    debug_info: Dict[str, Any] = field(default_factory=dict)
+def _mask(value: str) -> str:
+    return f"{value[:4]}...{value[-4:]}" if value and len(value) > 8 else "(masked)"
 
 
 def get_session(params: dict[str, Any]) -> ProxySession:
+    """
+    Sticky-режим (params["sticky"] + SOAX_PACKAGE_ID/SOAX_SESSION_PASSWORD):
+    логин со sessionid/sessionlength на порту port_sticky, ID переиспользуется
+    в пределах TTL. Иначе - Port-mode с ротацией exit IP на каждом соединении.
+    """
+    global _sticky_warned
     cfg = ConfigStore.get().soax
-    login = cfg.port_login
-    if not login:
-        raise ValueError("SOAX_PORT_LOGIN is not set in .env")
     host = params.get("proxy_host") or cfg.host
     port_str = params.get("proxy_port")
-    port = int(port_str) if port_str else cfg.port_default_port
     p_conn = params.get("connection_type", "wifi")
     p_country = params.get("country")
     p_isp = params.get("isp") or ""
     p_region = params.get("region_code") or ""
     p_city = params.get("city") or ""
     p_isp = p_isp.replace(" ", "+")
+    source_params = {
+        "country": p_country,
+        "region": p_region,
+        "city": p_city,
+        "isp": p_isp,
+        "conn_type": p_conn,
+        "host_override": params.get("proxy_host"),
+        "port_override": params.get("proxy_port"),
+    }
+
+    if params.get("sticky"):
+        if cfg.package_id and cfg.session_password:
+            ttl = int(params.get("sticky_ttl_sec") or ConfigStore.get().proxy.sticky_ttl_sec)
+            timeout = int(params.get("timeout_sec") or ConfigStore.get().execution.timeout_sec)
+            key = (params.get("run_id") or "-", p_conn, p_country, p_region, p_city, p_isp)
+            session_id, expires_at = StickySessionCache.acquire(key, ttl, min(timeout, ttl / 2))
+            port = int(port_str) if port_str else cfg.port_sticky
+            username = _sticky_login(cfg.package_id, p_country, p_region, p_city, p_isp, session_id, ttl)
+            debug_data = {
+                "mode": "Sticky-session",
+                "raw_login": username.replace(cfg.package_id, _mask(cfg.package_id)),
+                "raw_host": host,
+                "raw_port": port,
+                "session_id": session_id,
+                "session_expires_at": datetime.fromtimestamp(expires_at).isoformat(timespec="seconds"),
+                "source_params": source_params,
+            }
+            return ProxySession(
+                type=params.get("proxy_type", "http"),
+                host=host,
+                port=port,
+                username=username,
+                password=cfg.session_password,
+                session_id=session_id,
+                ext_ip=None,
+                debug_info=debug_data,
+                expires_at=expires_at,
+                sticky_key=key,
+            )
+        if not _sticky_warned:
+            _sticky_warned = True
+            log.warning("Sticky session requested but SOAX_PACKAGE_ID / SOAX_SESSION_PASSWORD "
+                        "are not set, falling back to Port-mode (rotating exit IP).")
+
+    login = cfg.port_login
+    if not login:
+        raise ValueError("SOAX_PORT_LOGIN is not set in .env")
+    leased_port = None
+    port_range: List[int] = []
+    if not port_str:
+        if cfg.port_strategy == "map":
+            # порты, где проба недавно видела живой exit в нужной стране
+            port_range = PortMapStore.ports_for(p_country, ConfigStore.get().port_map.max_age_sec)
+        port_range = port_range or _port_range(cfg.port_range)
+    if port_range:
+        leased_port = PortAllocator.acquire(
+            port_range,
+            key=f"{p_country}|{params.get('url') or ''}",
+            strategy="least_loaded" if cfg.port_strategy == "map" else cfg.port_strategy,
+            max_inflight=cfg.port_max_inflight,
+            avoid=lambda p: ProxyHealth.is_open(health_key(host, p, params)),
+        )
+        port = leased_port
+    else:
+        port = int(port_str) if port_str else cfg.port_default_port
     password_string = f"{p_conn};{p_country};{p_isp};{p_region};{p_city}"
     debug_data = {
         "mode": "Port-mode",
-        "raw_login": f"{login[:4]}...{login[-4:]}" if login and len(login) > 8 else "(login masked)",
+        "raw_login": _mask(login),
         "raw_password": password_string,
         "raw_host": host,
         "raw_port": port,
-        "source_params": {
-            "country": p_country,
-            "region": p_region,
-            "city": p_city,
-            "isp": p_isp,
-            "conn_type": p_conn,
-            "host_override": params.get("proxy_host"),
-            "port_override": params.get("proxy_port"),
-        }
+        "port_range": cfg.port_range if leased_port else None,
+        "source_params": source_params,
     }
     return ProxySession(
         type=params.get("proxy_type", "http"),
@@ -276,5 +608,33 @@ def get_session(params: dict[str, Any]) -> ProxySession:
         password=password_string,
         session_id=None,
         ext_ip=None,
-        debug_info=debug_data
+        debug_info=debug_data,
+        leased_port=leased_port
     )
+
+
+_port_range_cache: tuple[str | None, List[int]] = (None, [])
+
+
+def _port_range(spec: str | None) -> List[int]:
+    global _port_range_cache
+    if _port_range_cache[0] != spec:
+        try:
+            _port_range_cache = (spec, parse_port_range(spec))
+        except ValueError:
+            log.error(f"Invalid SOAX port range '{spec}', using the default port.")
+            _port_range_cache = (spec, [])
+    return _port_range_cache[1]
+
+
+def release_session(ps: ProxySession):
+    """Возвращает порт из диапазона после проверки (no-op для остальных сессий)."""
+    if ps.leased_port is not None:
+        PortAllocator.release(ps.leased_port)
+        ps.leased_port = None
+
+
+def invalidate_session(ps: ProxySession):
+    """Сбрасывает sticky-сессию после ошибки соединения через прокси."""
+    if ps.session_id and ps.sticky_key:
+        StickySessionCache.invalidate(ps.sticky_key, ps.session_id)
@@ -15,8 +15,9 @@ class SoaxApiClient:
     Это НЕ клиент для *использования* прокси (proxy.soax.com).
     """
 
-    def __init__(self):
+    def __init__(self, timeout: float = 30):
         cfg = ConfigStore.get()
+        self.timeout = timeout
         self.api_key = cfg.soax.api_key
         self.package_key = cfg.soax.package_key
 
@@ -43,7 +44,7 @@ class SoaxApiClient:
         params["package_key"] = self.package_key
 
         try:
-            response = self.session.get(f"{BASE_URL}{endpoint}", params=params, timeout=30)
+            response = self.session.get(f"{BASE_URL}{endpoint}", params=params, timeout=self.timeout)
 
             # проверяем на ошибки 4xx/5xx
             response.raise_for_status()
@@ -0,0 +1,74 @@
+from __future__ import annotations
+import threading, time
+from typing import Any, Dict
+import requests
+
+# отдаёт IP и страну, с которых пришёл запрос (т.е. exit прокси)
+IPINFO_URL = "https://checker.soax.com/api/ipinfo"
+
+_local = threading.local()
+
+# сколько прокси (портов) держит keep-alive соединения в одной Session потока;
+# HTTPAdapter.proxy_manager сам ничего не выбрасывает, а каждый порт - отдельный прокси
+_MAX_PROXIES_PER_SESSION = 8
+
+
+def _session(reuse: bool) -> requests.Session:
+    """reuse=True: одна Session (и её keep-alive соединения) на поток."""
+    if reuse:
+        sess = getattr(_local, "session", None)
+        if sess is None:
+            sess = _local.session = requests.Session()
+        return sess
+    return requests.Session()
+
+
+def _trim_proxy_managers(sess: requests.Session, keep: str):
+    """Закрывает самые старые proxy-пулы Session сверх _MAX_PROXIES_PER_SESSION (кроме текущего)."""
+    for adapter in sess.adapters.values():
+        managers = getattr(adapter, "proxy_manager", None)
+        if not managers:
+            continue
+        while len(managers) > _MAX_PROXIES_PER_SESSION:
+            oldest = next((k for k in managers if k != keep), None)
+            if oldest is None:
+                break
+            managers.pop(oldest).clear()
+
+
+def probe(proxy: str, port: int, timeout: float, reuse: bool = False,
+          url: str = IPINFO_URL) -> Dict[str, Any]:
+    """
+    Один запрос к IP-info через прокси. Всегда возвращает dict:
+    {port, ok, ip, country, latency_ms, error, detail}; при ошибке ok=False.
+    """
+    result: Dict[str, Any] = {"port": port, "ok": False, "ip": None, "country": None,
+                              "latency_ms": None, "error": None, "detail": None}
+    sess = _session(reuse)
+    start = time.monotonic()
+    try:
+        response = sess.get(url, proxies={"http": proxy, "https": proxy}, timeout=timeout)
+        result["latency_ms"] = int((time.monotonic() - start) * 1000)
+        if not response.ok:
+            result["error"] = f"http_{response.status_code}"
+            return result
+        data = response.json().get("data") or {}
+        result["ip"] = data.get("ip")
+        result["country"] = (data.get("country_code") or "").lower() or None
+        result["ok"] = bool(result["ip"])
+        if not result["ok"]:
+            result["error"] = "bad_response"
+    except requests.exceptions.Timeout as e:
+        result["error"], result["detail"] = "timeout", str(e)
+    except requests.exceptions.ProxyError as e:
+        result["error"], result["detail"] = "proxy_error", str(e)
+    except requests.exceptions.RequestException as e:
+        result["error"], result["detail"] = "connect_error", str(e)
+    except ValueError as e:
+        result["error"], result["detail"] = "bad_response", str(e)
+    finally:
+        if reuse:
+            _trim_proxy_managers(sess, proxy)
+        else:
+            sess.close()
+    return result
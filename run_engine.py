@@ -0,0 +1,186 @@
+"""
+Headless batch runner: the same orchestrator pipeline as the web UI,
+without Flask/gevent/Jinja.
+
+    python run_engine.py urls.txt --country kz
+    python run_engine.py pairs.txt --multi-geo --format csv -o results.csv
+    cat urls.txt | python run_engine.py - --country ru --concurrency 10
+
+Exit codes:
+    0 - all checks succeeded
+    1 - run finished, some checks failed
+    2 - usage / config / input error
+    3 - run could not be completed
+"""
+from __future__ import annotations
+import argparse
+import csv
+import json
+import sys
+
+EXIT_OK = 0
+EXIT_CHECKS_FAILED = 1
+EXIT_USAGE = 2
+EXIT_RUN_FAILED = 3
+
+CSV_FIELDS = ["url", "country", "result", "http_code", "ttfb_ms", "ext_ip", "ext_country", "geo_mismatch", "md_name", "png_name", "notes"]
+
+
+def _parse_args(argv: list[str] | None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="DO Checker headless batch runner")
+    p.add_argument("input", help="URL file ('-' for stdin). One URL per line, or 'url cc' with --multi-geo")
+    p.add_argument("--multi-geo", action="store_true", help="input lines are 'url country_code' pairs")
+    p.add_argument("--country", help="ISO-2 country for plain URL lists")
+    p.add_argument("--region", dest="region_code")
+    p.add_argument("--city")
+    p.add_argument("--isp")
+    p.add_argument("--connection-type", default="wifi")
+    p.add_argument("--proxy-type", choices=["http", "socks5"])
+    p.add_argument("--dns-mode", choices=["proxy", "local"])
+    p.add_argument("--proxy-host")
+    p.add_argument("--proxy-port")
+    p.add_argument("--timeout", type=int, dest="timeout_sec")
+    p.add_argument("--sticky-policy", choices=["auto", "on", "off"])
+    p.add_argument("--screenshots", action="store_true")
+    p.add_argument("--debug", action="store_true", help="include debug info in .md cards")
+    p.add_argument("--concurrency", type=int, help="override execution.max_concurrency")
+    p.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    p.add_argument("-o", "--output", default="-", help="output file ('-' for stdout)")
+    p.add_argument("--log-level", default="WARNING", help="engine log level (goes to stderr)")
+    return p.parse_args(argv)
+
+
+def _read_lines(path: str) -> list[str]:
+    if path == "-":
+        return sys.stdin.read().splitlines()
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().splitlines()
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = _parse_args(argv)
+
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+
+    from config.loader import ConfigStore
+    from logging_.engine_logger import setup_cli_logger
+
+    try:
+        ConfigStore.init()
+    except Exception as e:
+        print(f"Config error: {e}", file=sys.stderr)
+        return EXIT_USAGE
+
+    cfg = ConfigStore.get()
+    setup_cli_logger(args.log_level)
+    if args.concurrency:
+        cfg.execution.max_concurrency = args.concurrency
+
+    # движок импортируем только после инициализации конфига и логгера
+    from engine.orchestrator import start_run, start_multi_geo_run, _resolve_sticky
+    from engine.url_utils import parse_url_lines, parse_multi_geo_lines
+
+    try:
+        lines = _read_lines(args.input)
+    except OSError as e:
+        print(f"Cannot read input: {e}", file=sys.stderr)
+        return EXIT_USAGE
+
+    run_params = {
+        "proxy_type": args.proxy_type or cfg.proxy.type,
+        "dns_mode": args.dns_mode or cfg.proxy.dns_mode,
+        "connection_type": args.connection_type,
+        "proxy_host": args.proxy_host,
+        "proxy_port": args.proxy_port,
+        "timeout_sec": args.timeout_sec or cfg.execution.timeout_sec,
+        "make_screenshot": args.screenshots,
+        "debug_mode": args.debug,
+    }
+
+    if args.multi_geo:
+        tasks = parse_multi_geo_lines(lines)
+        if not tasks:
+            print("No valid 'url cc' lines in input", file=sys.stderr)
+            return EXIT_USAGE
+        run_params["tasks"] = tasks
+        run_params["multi_geo"] = True
+        starter = start_multi_geo_run
+    else:
+        if not args.country:
+            print("--country is required for plain URL lists (or use --multi-geo)", file=sys.stderr)
+            return EXIT_USAGE
+        urls = parse_url_lines(lines)
+        if not urls:
+            print("No URLs in input", file=sys.stderr)
+            return EXIT_USAGE
+        run_params.update({
+            "urls": urls,
+            "country": args.country.lower(),
+            "region_code": args.region_code,
+            "city": args.city,
+            "isp": args.isp,
+            "sticky_policy": args.sticky_policy or cfg.proxy.sticky_policy,
+            "sticky_ttl_sec": cfg.proxy.sticky_ttl_sec,
+        })
+        starter = start_run
+
+    # без учётки прокси каждая проверка упадёт: это ошибка конфигурации, а не "проверки не прошли"
+    n_checks = len(run_params["tasks"]) if args.multi_geo else len(run_params["urls"])
+    sticky_ok = bool(cfg.soax.package_id and cfg.soax.session_password) and _resolve_sticky(run_params, n_checks)
+    if not cfg.soax.port_login and not sticky_ok:
+        print("Config error: SOAX_PORT_LOGIN is not set (or SOAX_PACKAGE_ID / SOAX_SESSION_PASSWORD "
+              "for sticky runs)", file=sys.stderr)
+        return EXIT_USAGE
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8", newline="")
+    csv_writer = None
+    if args.format == "csv":
+        csv_writer = csv.DictWriter(out, fieldnames=CSV_FIELDS, extrasaction="ignore")
+        csv_writer.writeheader()
+
+    failed = 0
+
+    def on_row(row: dict):
+        nonlocal failed
+        if row.get("result") != "success":
+            failed += 1
+        if csv_writer:
+            csv_writer.writerow(row)
+        else:
+            out.write(json.dumps(row, ensure_ascii=False) + "\n")
+        out.flush()
+
+    try:
+        run_id = starter(run_params, on_row=on_row, background=False)
+    except KeyboardInterrupt:
+        print("Interrupted", file=sys.stderr)
+        return EXIT_RUN_FAILED
+    except Exception as e:
+        print(f"Run failed: {e}", file=sys.stderr)
+        return EXIT_RUN_FAILED
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    from engine.orchestrator import get_run_state
+    state = get_run_state(run_id) or {}
+    totals = state.get("totals", {})
+    print(
+        f"[{run_id}] {state.get('status', 'unknown')}: "
+        f"ok={totals.get('ok', 0)} err={totals.get('err', 0)} total={state.get('total', 0)}",
+        file=sys.stderr
+    )
+    if state.get("reason"):
+        print(f"[{run_id}] reason: {state['reason']}", file=sys.stderr)
+
+    if state.get("status") != "finished":
+        return EXIT_RUN_FAILED
+    return EXIT_CHECKS_FAILED if failed else EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,6 +17,7 @@ class ProxySession:
     password: str
     session_id: str | None
     ext_ip: str | None
+    ext_country: str | None
 
 class CheckInput:
     url: str                # как введено юзером (может быть без schema)
@@ -34,13 +35,16 @@ class CheckResult:
     classification: Literal[
         "success","http_error",
         "dns_error","connect_error",
-        "tls_error","timeout"
+        "tls_error","timeout",
+        "proxy_unhealthy","proxy_auth_error","proxy_quota_exceeded"
     ]
     http_code: int | None
     bytes_count: int | None
     timings: Timings
     redirects: list[tuple[int,str,str]]  # [(code, from, to)]
     proxy_ext_ip: str | None
+    proxy_ext_country: str | None
+    geo_mismatch: bool
     md_path: str
     png_path: str | None
 
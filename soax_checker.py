@@ -1,104 +1,265 @@
-import requests
-import logging
-import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+"""
+SOAX pool benchmark: N requests to the SOAX IP-info endpoint spread over a
+port range, with bounded concurrency.
+
+    python soax_checker.py --ports 9001-9100 -n 2000 --login "$SOAX_PORT_LOGIN" --password "wifi;kz;;;"
+    python soax_checker.py --ports 9001-9010 -n 500 -c 50 --reuse thread --json results.json
+
+Reports success rate, unique/duplicate exit IPs, geo distribution, latency
+percentiles and histogram, and per-country / per-port breakdowns.
+`--json -` prints the report as JSON instead of text.
+"""
+from __future__ import annotations
 import argparse
-import json
 import getpass
+import json
+import logging
+import math
+import os
 import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Any, Dict, List
 
-logger = logging.getLogger(__name__)
-file_handler = logging.FileHandler("errors.log")
-file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
-logger.addHandler(file_handler)
-logger.setLevel(logging.ERROR)
+from providers.port_allocator import parse_port_range
+from providers.soax_probe import IPINFO_URL, probe
 
-def make_request(url, proxy):
-    try:
-        with requests.Session() as session:
-            response = session.get(url, proxies={"http": proxy, "https": proxy}, timeout=20)
-        if response.ok:
-            data = response.json()
-            ip = data["data"]["ip"]
-            country_code = data["data"]["country_code"]
-            latency = response.elapsed.total_seconds()
-            return ip, country_code, latency
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error for proxy {proxy}: {e}")
-        return None, None, None
-
-def main():
-    ports_range = input("Ports range (e.g. 9001-49998): ")
-    try:
-        start_port, end_port = map(int, ports_range.split('-'))
-    except (ValueError, AttributeError):
-        print("Error: Invalid ports range format. Use the format 'start-end'.")
-        sys.exit(1)
+DEFAULT_HOST = "proxy.soax.com"
+# верхние границы корзин гистограммы задержек, мс (последняя - всё остальное)
+HISTOGRAM_BUCKETS_MS = [100, 250, 500, 1000, 2000, 5000, 10000]
+PERCENTILES = (50, 90, 95, 99)
 
-    num_of_requests = input("Requests to make: ")
-    login = input("Login: ")
-    password = input("Password: ")
+logger = logging.getLogger("soax_checker")
 
-    try:
-        num_of_requests = int(num_of_requests)
-    except ValueError:
-        print("Error: Please enter a valid number for the number of requests.")
-        sys.exit(1)
 
-    url = "https://checker.soax.com/api/ipinfo"
-    host = "proxy.soax.com"
+def run_benchmark(args: argparse.Namespace, ports: List[int]) -> List[Dict[str, Any]]:
+    """
+    `concurrency` потоков, в пул подаётся не больше 2 * concurrency задач сразу
+    (как в оркестраторе): память и число потоков не зависят от `--requests`.
+    """
+    results: List[Dict[str, Any]] = []
+    concurrency = max(1, min(args.concurrency, args.requests))
+    window = concurrency * 2
 
-    results = []
-    country_codes = {}
-    errors = []
-    all_ips = []
+    def proxy_for(port: int) -> str:
+        return f"{args.scheme}://{args.login}:{args.password}@{args.host}:{port}"
 
-    time_start = time.monotonic()
+    def one(i: int) -> Dict[str, Any]:
+        port = ports[i % len(ports)]
+        return probe(proxy_for(port), port, args.timeout, args.reuse == "thread", args.url)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending: set[Future] = set()
+        next_i = 0
+        while next_i < args.requests or pending:
+            while next_i < args.requests and len(pending) < window:
+                pending.add(executor.submit(one, next_i))
+                next_i += 1
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                res = fut.result()
+                if not res["ok"]:
+                    logger.error(f"Port {res['port']}: {res['error']} {res.get('detail') or ''}")
+                results.append(res)
+                if args.progress and len(results) % args.progress == 0:
+                    print(f"... {len(results)}/{args.requests}", file=sys.stderr)
+    return results
+
+
+def percentile(sorted_values: List[int], p: float) -> int | None:
+    """Nearest-rank percentile по уже отсортированному списку."""
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
 
-    with ThreadPoolExecutor(max_workers=20000) as executor:
-        ports = list(range(start_port, end_port + 1))
-        for i in range(num_of_requests):
-            proxy = f"http://{login}:{password}@{host}:{ports[i % len(ports)]}"
-            future = executor.submit(make_request, url, proxy)
-            results.append(future)
-
-    success_count = 0
-    latencies = []
-
-    for future in as_completed(results):
-        ip, country_code, latency = future.result()
-        if ip:
-            success_count += 1
-            all_ips.append(ip)
-            if country_code in country_codes:
-                country_codes[country_code] += 1
-            else:
-                country_codes[country_code] = 1
-            latencies.append(latency)
+
+def latency_stats(latencies: List[int]) -> Dict[str, Any]:
+    lat = sorted(latencies)
+    if not lat:
+        return {"count": 0}
+    stats: Dict[str, Any] = {
+        "count": len(lat),
+        "min_ms": lat[0],
+        "max_ms": lat[-1],
+        "mean_ms": int(sum(lat) / len(lat)),
+    }
+    for p in PERCENTILES:
+        stats[f"p{p}_ms"] = percentile(lat, p)
+    return stats
+
+
+def histogram(latencies: List[int]) -> List[Dict[str, Any]]:
+    counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+    for v in latencies:
+        for b, upper in enumerate(HISTOGRAM_BUCKETS_MS):
+            if v <= upper:
+                counts[b] += 1
+                break
         else:
-            errors.append(latency)
+            counts[-1] += 1
+    out = []
+    lower = 0
+    for b, upper in enumerate(HISTOGRAM_BUCKETS_MS):
+        out.append({"range_ms": f"{lower}-{upper}", "count": counts[b]})
+        lower = upper
+    out.append({"range_ms": f">{lower}", "count": counts[-1]})
+    return out
+
+
+def _group_stats(results: List[Dict[str, Any]], key: str) -> Dict[str, Dict[str, Any]]:
+    groups: Dict[Any, List[Dict[str, Any]]] = {}
+    for r in results:
+        groups.setdefault(r.get(key), []).append(r)
+    out = {}
+    for k, rows in sorted(groups.items(), key=lambda kv: str(kv[0])):
+        ok = [r for r in rows if r["ok"]]
+        lat = sorted(r["latency_ms"] for r in ok if r["latency_ms"] is not None)
+        out[str(k)] = {
+            "requests": len(rows),
+            "ok": len(ok),
+            "errors": len(rows) - len(ok),
+            "unique_ips": len({r["ip"] for r in ok}),
+            "p50_ms": percentile(lat, 50),
+            "p95_ms": percentile(lat, 95),
+        }
+    return out
+
+
+def build_report(args: argparse.Namespace, ports: List[int], results: List[Dict[str, Any]],
+                 elapsed_sec: float) -> Dict[str, Any]:
+    ok = [r for r in results if r["ok"]]
+    ips = [r["ip"] for r in ok]
+    latencies = [r["latency_ms"] for r in ok if r["latency_ms"] is not None]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    countries: Dict[str, int] = {}
+    for r in ok:
+        countries[r["country"] or "?"] = countries.get(r["country"] or "?", 0) + 1
+
+    report = {
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "params": {
+            "host": args.host, "ports": f"{ports[0]}-{ports[-1]}" if len(ports) > 1 else str(ports[0]),
+            "port_count": len(ports), "requests": args.requests, "concurrency": args.concurrency,
+            "timeout_sec": args.timeout, "reuse": args.reuse, "url": args.url,
+        },
+        "elapsed_sec": round(elapsed_sec, 2),
+        "requests_per_sec": round(len(results) / elapsed_sec, 2) if elapsed_sec else None,
+        "success": len(ok),
+        "errors": len(results) - len(ok),
+        "success_rate": round(len(ok) / len(results) * 100, 2) if results else 0.0,
+        "error_classes": errors,
+        "unique_ips": len(set(ips)),
+        "duplicate_ips": len(ips) - len(set(ips)),
+        "countries": countries,
+        "latency": latency_stats(latencies),
+        "histogram": histogram(latencies),
+        "by_country": _group_stats(ok, "country"),
+        "by_port": _group_stats(results, "port"),
+    }
+    if args.expect_country:
+        expected = args.expect_country.lower()
+        report["geo_accuracy"] = round(countries.get(expected, 0) / len(ok) * 100, 2) if ok else 0.0
+    return report
 
-    time_end = time.monotonic()
 
-    unique_ips = set(all_ips)
-    duplicate_ips = len(all_ips) - len(unique_ips)
+def print_report(report: Dict[str, Any], top_ports: int):
+    lat = report["latency"]
+    print(f"Successful requests: {report['success']}")
+    print(f"Errors: {report['errors']} {report['error_classes'] or ''}")
+    print(f"Success Rate: {report['success_rate']:.2f}%")
+    print(f"Unique IPs: {report['unique_ips']}")
+    print(f"Duplicate IPs: {report['duplicate_ips']}")
+    print("Geo distribution: " + " / ".join(f"{c}:{n}" for c, n in report["countries"].items()))
+    if "geo_accuracy" in report:
+        print(f"Geo accuracy: {report['geo_accuracy']:.2f}%")
+    if lat["count"]:
+        print("Latency (ms): " + ", ".join(
+            f"{k[:-3]}={lat[k]}" for k in ("min_ms", "p50_ms", "p90_ms", "p95_ms", "p99_ms", "max_ms", "mean_ms")
+        ))
+        peak = max(b["count"] for b in report["histogram"]) or 1
+        for b in report["histogram"]:
+            print(f"  {b['range_ms']:>12} | {'#' * int(40 * b['count'] / peak):<40} {b['count']}")
+    print("By country:")
+    for cc, st in report["by_country"].items():
+        print(f"  {cc}: {st['ok']} ok, unique IPs {st['unique_ips']}, p50 {st['p50_ms']} ms, p95 {st['p95_ms']} ms")
+    worst = sorted(report["by_port"].items(), key=lambda kv: (kv[1]["ok"] / kv[1]["requests"], -kv[1]["errors"]))
+    print(f"Worst ports (of {len(report['by_port'])}):")
+    for port, st in worst[:top_ports]:
+        print(f"  {port}: {st['ok']}/{st['requests']} ok, p50 {st['p50_ms']} ms")
+    print(f"Time to run: {report['elapsed_sec']:.2f} seconds ({report['requests_per_sec']} req/s)")
 
-    success_rate = (success_count / num_of_requests) * 100
-    geo_accuracy_representation = " / ".join("{}:{}".format(code, count) for code, count in country_codes.items())
 
-    print("Successful requests: {}".format(success_count))
-    print("Errors: {}".format(len(errors)))
-    print("Success Rate: {:.2f}%".format(success_rate))
-    print("Unique IPs: {}".format(len(unique_ips)))
-    print("Duplicate IPs: {}".format(duplicate_ips))
-    print("Geo accuracy: {}".format(geo_accuracy_representation))
+def _parse_args(argv: List[str] | None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="SOAX pool benchmark (exit IPs, geo accuracy, latency)")
+    p.add_argument("--ports", required=True, help="port range, e.g. 9001-49998 or 9001,9005,9010-9020")
+    p.add_argument("-n", "--requests", type=int, required=True, help="number of requests")
+    p.add_argument("-c", "--concurrency", type=int, default=50, help="requests in flight (default 50)")
+    p.add_argument("--login", default=os.environ.get("SOAX_PORT_LOGIN"), help="default: $SOAX_PORT_LOGIN")
+    p.add_argument("--password", default=os.environ.get("SOAX_CHECK_PASSWORD"),
+                   help="port-mode password, e.g. 'wifi;kz;;;' (default: $SOAX_CHECK_PASSWORD)")
+    p.add_argument("--host", default=os.environ.get("SOAX_HOST", DEFAULT_HOST))
+    p.add_argument("--scheme", choices=["http", "socks5h"], default="http")
+    p.add_argument("--url", default=IPINFO_URL)
+    p.add_argument("--timeout", type=float, default=20)
+    p.add_argument("--reuse", choices=["none", "thread"], default="none",
+                   help="'thread': keep-alive session per worker thread (last 8 ports); 'none': new connection per request")
+    p.add_argument("--expect-country", help="ISO-2 code to compute geo accuracy against")
+    p.add_argument("--json", dest="json_out", help="write JSON report to file ('-' for stdout instead of text)")
+    p.add_argument("--top-ports", type=int, default=10, help="worst ports to show in text output")
+    p.add_argument("--progress", type=int, default=0, help="print progress to stderr every N requests")
+    p.add_argument("--error-log", help="log individual request errors to this file")
+    return p.parse_args(argv)
+
+
+def main(argv: List[str] | None = None) -> int:
+    args = _parse_args(argv)
+
+    try:
+        ports = parse_port_range(args.ports)
+    except ValueError:
+        print("Error: Invalid ports range format. Use 'start-end' or a comma-separated list.", file=sys.stderr)
+        return 2
+    if not ports:
+        print("Error: empty port range.", file=sys.stderr)
+        return 2
+    if args.requests <= 0 or args.concurrency <= 0:
+        print("Error: --requests and --concurrency must be positive.", file=sys.stderr)
+        return 2
+    if not args.login:
+        print("Error: --login (or SOAX_PORT_LOGIN) is required.", file=sys.stderr)
+        return 2
+    if not args.password:
+        if not sys.stdin.isatty():
+            print("Error: --password (or SOAX_CHECK_PASSWORD) is required.", file=sys.stderr)
+            return 2
+        args.password = getpass.getpass("Password: ")
+
+    if args.error_log:
+        handler = logging.FileHandler(args.error_log)
+        handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.ERROR)
+    logger.propagate = False
+
+    time_start = time.monotonic()
+    results = run_benchmark(args, ports)
+    report = build_report(args, ports, results, time.monotonic() - time_start)
 
-    if latencies:
-        print("Fastest latency: {:.2f} seconds".format(min(latencies)))
-        print("Longest latency: {:.2f} seconds".format(max(latencies)))
-        print("Average latency: {:.2f} seconds".format(sum(latencies) / len(latencies)))
+    if args.json_out == "-":
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        print_report(report, args.top_ports)
+        if args.json_out:
+            with open(args.json_out, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0 if report["success"] else 1
 
-    print("Time to run: {:.2f} seconds".format(time_end - time_start))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())